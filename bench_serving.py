@@ -0,0 +1,301 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+from aiohttp import web
+
+
+def percentile(values, p):
+    """Linearly interpolated percentile of an already sorted list."""
+    if not values:
+        return float("nan")
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def load_dataset(path, max_tokens):
+    """Chat requests from a JSONL file, one {"messages": [...], ...} per line."""
+    requests = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if "messages" not in data:
+                continue
+            requests.append((data["messages"], data.get("max_tokens") or data.get("max_new_tokens") or max_tokens))
+    if not requests:
+        raise ValueError(f"no chat requests with messages in {path}")
+    return requests
+
+
+def synthetic_requests(num_requests, input_len, output_len, len_range, seed):
+    """Prompts of roughly `input_len` tokens asking for `output_len` tokens, both varied by +-len_range."""
+    rng = random.Random(seed)
+    words = ["the", "of", "model", "data", "time", "system", "value", "number", "world", "question"]
+
+    def sample(n):
+        return max(1, int(n * rng.uniform(1 - len_range, 1 + len_range)))
+
+    requests = []
+    for _ in range(num_requests):
+        prompt = " ".join(rng.choice(words) for _ in range(sample(input_len)))
+        requests.append(([{"role": "user", "content": prompt}], sample(output_len)))
+    return requests
+
+
+def make_payload(args, messages, max_tokens):
+    payload = {"messages": messages, "stream": args.stream}
+    if args.api == "vllm":
+        payload.update(model=args.model, max_tokens=max_tokens, ignore_eos=args.ignore_eos)
+    else:
+        # openai_api.py takes GenerationConfig names
+        payload.update(max_new_tokens=max_tokens)
+    return payload
+
+
+class RequestResult:
+    def __init__(self):
+        self.ok = False
+        self.error = None
+        self.start = None
+        self.ttft = None
+        self.latency = None
+        self.itl = []
+        self.chunks = 0
+        self.output_tokens = None
+        self.text = ""
+
+
+async def send_request(session, args, payload):
+    result = RequestResult()
+    result.start = time.perf_counter()
+    last = result.start
+    try:
+        async with session.post(args.url, json=payload) as response:
+            if response.status != 200:
+                result.error = f"HTTP {response.status}: {(await response.text())[:200]}"
+                return result
+            if not args.stream:
+                data = await response.json()
+                result.text = data["choices"][0]["message"]["content"] or ""
+                usage = data.get("usage") or {}
+                result.output_tokens = usage.get("completion_tokens")
+            else:
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    line = line[5:].strip()
+                    if line == b"[DONE]":
+                        break
+                    data = json.loads(line)
+                    # a failure after the 200 status line: openai_api.py sends {"error": {...}}, vLLM its ErrorResponse
+                    if "error" in data or data.get("object") == "error":
+                        error = data.get("error", data)
+                        message = error.get("message") if isinstance(error, dict) else error
+                        result.error = f"stream error: {str(message)[:200]}"
+                        return result
+                    if data.get("usage"):
+                        result.output_tokens = data["usage"].get("completion_tokens")
+                    for choice in data.get("choices", []):
+                        text = (choice.get("delta") or {}).get("content")
+                        if not text:
+                            continue
+                        now = time.perf_counter()
+                        if result.ttft is None:
+                            result.ttft = now - result.start
+                        else:
+                            result.itl.append(now - last)
+                        last = now
+                        result.chunks += 1
+                        result.text += text
+        result.latency = time.perf_counter() - result.start
+        result.ok = True
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_load(args, requests):
+    """Send every request, either at `args.qps` (Poisson or evenly spaced) or keeping `args.concurrency` in flight."""
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    semaphore = asyncio.Semaphore(args.concurrency) if args.concurrency else None
+    rng = random.Random(args.seed)
+
+    async def one(payload):
+        if semaphore is None:
+            return await send_request(session, args, payload)
+        async with semaphore:
+            return await send_request(session, args, payload)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = []
+        start = time.perf_counter()
+        for i, (messages, max_tokens) in enumerate(requests):
+            tasks.append(asyncio.ensure_future(one(make_payload(args, messages, max_tokens))))
+            if args.qps and i < len(requests) - 1:
+                interval = rng.expovariate(args.qps) if args.arrival == "poisson" else 1 / args.qps
+                await asyncio.sleep(interval)
+        results = await asyncio.gather(*tasks)
+        duration = time.perf_counter() - start
+    return results, duration
+
+
+def count_output_tokens(results, tokenizer):
+    for result in results:
+        if not result.ok or result.output_tokens is not None:
+            continue
+        if tokenizer is not None:
+            result.output_tokens = len(tokenizer.encode(result.text))
+        elif result.chunks:
+            # vLLM streams about one token per chunk
+            result.output_tokens = result.chunks
+
+
+def report(args, results, duration):
+    ok = [r for r in results if r.ok]
+    failed = [r for r in results if not r.ok]
+    print(f"requests:       {len(ok)} ok, {len(failed)} failed in {duration:.2f}s ({len(ok) / duration:.2f} req/s)")
+    for r in failed[:5]:
+        print(f"  error: {r.error}")
+    counted = [r.output_tokens for r in ok if r.output_tokens is not None]
+    if counted:
+        note = "" if len(counted) == len(ok) else f" ({len(ok) - len(counted)} requests without a count)"
+        print(f"output tokens:  {sum(counted)} ({sum(counted) / duration:.1f} tokens/s){note}")
+    else:
+        print("output tokens:  unknown, the server reports no usage; pass --tokenizer to count them")
+
+    metrics = [("e2e latency", sorted(r.latency for r in ok))]
+    if args.stream:
+        metrics.insert(0, ("ttft", sorted(r.ttft for r in ok if r.ttft is not None)))
+        metrics.insert(1, ("itl", sorted(t for r in ok for t in r.itl)))
+    print(f"{'metric (ms)':<14} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, values in metrics:
+        if not values:
+            continue
+        mean = sum(values) / len(values)
+        row = [mean] + [percentile(values, p) for p in (50, 95, 99)] + [values[-1]]
+        print(f"{name:<14} " + " ".join(f"{v * 1000:>9.1f}" for v in row))
+
+
+async def stub_chat_completion(request):
+    """Stand-in for /v1/chat/completions: echoes `max_tokens` tokens after `--stub-ttft-ms`, one per `--stub-token-ms`."""
+    args = request.app["args"]
+    data = await request.json()
+    num_tokens = data.get("max_tokens") or data.get("max_new_tokens") or 16
+    prompt_tokens = sum(len(m.get("content", "").split()) for m in data.get("messages", []))
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": num_tokens, "total_tokens": prompt_tokens + num_tokens}
+    await asyncio.sleep(args.stub_ttft_ms / 1000)
+    if not data.get("stream", False):
+        await asyncio.sleep((num_tokens - 1) * args.stub_token_ms / 1000)
+        return web.json_response({
+            "model": "stub",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " tok" * num_tokens}, "finish_reason": "length"}],
+            "usage": usage,
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    async def send(delta, finish_reason=None, **extra):
+        chunk = {"object": "chat.completion.chunk", "model": "stub",
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+    await send({"role": "assistant"})
+    for i in range(num_tokens):
+        if i:
+            await asyncio.sleep(args.stub_token_ms / 1000)
+        await send({"content": " tok"})
+    await send({}, finish_reason="length", usage=usage)
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def stub_list_models(request):
+    return web.json_response({"object": "list", "data": [{"id": "stub", "object": "model",
+                                                          "max_model_len": request.app["args"].stub_max_model_len}]})
+
+
+async def start_stub(args):
+    app = web.Application()
+    app["args"] = args
+    app.router.add_post("/v1/chat/completions", stub_chat_completion)
+    app.router.add_get("/v1/models", stub_list_models)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.stub_port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+async def main(args):
+    if args.dataset:
+        dataset = load_dataset(args.dataset, args.output_len)
+        rng = random.Random(args.seed)
+        requests = [rng.choice(dataset) for _ in range(args.num_requests)] if args.shuffle else \
+            [dataset[i % len(dataset)] for i in range(args.num_requests)]
+    else:
+        requests = synthetic_requests(args.num_requests, args.input_len, args.output_len, args.len_range, args.seed)
+
+    stub = None
+    if args.stub:
+        stub, args.url = await start_stub(args)
+        if args.stub_only:
+            print(f"stub backend listening on {args.url}")
+            await asyncio.Event().wait()
+
+    mode = f"{args.qps} qps ({args.arrival})" if args.qps else f"concurrency {args.concurrency}"
+    print(f"sending {len(requests)} {'streaming' if args.stream else 'non-streaming'} requests to {args.url} at {mode}")
+    try:
+        results, duration = await run_load(args, requests)
+    finally:
+        if stub is not None:
+            await stub.cleanup()
+
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    count_output_tokens(results, tokenizer)
+    report(args, results, duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for openai_api.py and the vLLM chat endpoint.')
+    parser.add_argument('--url', default='http://localhost:8360/v1/chat/completions')
+    parser.add_argument('--api', choices=['zhinao', 'vllm'], default='zhinao',
+                        help='request dialect: openai_api.py takes max_new_tokens, vLLM needs model and max_tokens')
+    parser.add_argument('--model', default='360Zhinao-7B-Chat-4K', help='served model name sent to vLLM')
+    parser.add_argument('--stream', action='store_true', help='stream responses and measure ttft and inter-token latency')
+    parser.add_argument('--num-requests', type=int, default=200)
+    parser.add_argument('--qps', type=float, default=0, help='open-loop arrival rate, 0 sends as fast as --concurrency allows')
+    parser.add_argument('--arrival', choices=['poisson', 'constant'], default='poisson')
+    parser.add_argument('--concurrency', type=int, default=0, help='max requests in flight, 0 for no limit')
+    parser.add_argument('--dataset', default=None, help='JSONL of chat requests to replay, one {"messages": [...]} per line')
+    parser.add_argument('--shuffle', action='store_true', help='sample dataset lines at random instead of in order')
+    parser.add_argument('--input-len', type=int, default=512, help='synthetic prompt length in words')
+    parser.add_argument('--output-len', type=int, default=128, help='max tokens of synthetic requests and of dataset lines without one')
+    parser.add_argument('--len-range', type=float, default=0.0, help='vary synthetic lengths uniformly by this fraction')
+    parser.add_argument('--ignore-eos', action='store_true', help='ask vLLM to always generate max_tokens')
+    parser.add_argument('--tokenizer', default=None, help='count output tokens with this tokenizer when the server reports no usage')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub', action='store_true', help='benchmark a local stub backend instead of --url')
+    parser.add_argument('--stub-only', action='store_true', help='with --stub, only serve the stub backend')
+    parser.add_argument('--stub-port', type=int, default=0, help='port of the stub backend, 0 picks a free one')
+    parser.add_argument('--stub-ttft-ms', type=float, default=50, help='stub delay before the first token')
+    parser.add_argument('--stub-token-ms', type=float, default=20, help='stub delay between tokens')
+    parser.add_argument('--stub-max-model-len', type=int, default=4096, help='context length the stub reports at /v1/models')
+    args = parser.parse_args()
+    if not args.qps and not args.concurrency:
+        parser.error('set --qps, --concurrency or both')
+    asyncio.run(main(args))
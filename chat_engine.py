@@ -0,0 +1,436 @@
+import copy
+import time
+import queue
+import functools
+import threading
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+DEFAULT_SYSTEM = "You are a helpful assistant."
+
+GENERATION_PARAMS = ['max_new_tokens', 'do_sample', 'top_k', 'top_p', 'temperature', 'repetition_penalty']
+
+
+def make_chat_input_ids(tokenizer, messages, system=DEFAULT_SYSTEM):
+    """Lay out a conversation the same way finetune.py does and open the assistant turn."""
+    im_start_id = [tokenizer.im_start_id]
+    im_end_id = [tokenizer.im_end_id]
+    br_id = tokenizer.encode('\n')
+
+    if not messages or messages[0]["role"] != "system":
+        messages = [{"role": "system", "content": system}] + list(messages)
+
+    input_ids = []
+    for message in messages:
+        input_ids += im_start_id + tokenizer.encode(message["role"]) + br_id + tokenizer.encode(message["content"]) + im_end_id + br_id
+    input_ids += im_start_id + tokenizer.encode("assistant") + br_id
+    return input_ids
+
+
+def get_stop_token_ids(tokenizer, generation_config):
+    eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = []
+    elif isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    return set(eos_token_id) | {tokenizer.im_end_id}
+
+
+def truncate_at_stop(token_ids, stop_token_ids):
+    for i, token_id in enumerate(token_ids):
+        if token_id in stop_token_ids:
+            return token_ids[:i]
+    return token_ids
+
+
+class GenerationConfigCache:
+    """Validated GenerationConfigs built from the defaults plus request overrides.
+
+    Configs are cached by the sorted tuple of overrides; the returned objects are
+    shared between requests and must not be modified.
+    """
+
+    def __init__(self, default_config, maxsize=256):
+        self.default_config = default_config
+        self._get = functools.lru_cache(maxsize=maxsize)(self._build)
+
+    def _build(self, params):
+        config = copy.deepcopy(self.default_config)
+        config.update(**dict(params))
+        self._check(config)
+        config.validate()
+        return config
+
+    @staticmethod
+    def _check(config):
+        # catch what would otherwise only fail inside generate() and take the whole batch down
+        if not isinstance(config.max_new_tokens, int) or isinstance(config.max_new_tokens, bool) or config.max_new_tokens <= 0:
+            raise ValueError(f"max_new_tokens must be a positive integer, got {config.max_new_tokens!r}")
+        if not isinstance(config.do_sample, bool):
+            raise TypeError(f"do_sample must be a boolean, got {config.do_sample!r}")
+        if config.top_k is not None and (not isinstance(config.top_k, int) or config.top_k < 0):
+            raise ValueError(f"top_k must be a non-negative integer, got {config.top_k!r}")
+        for name in ['top_p', 'temperature', 'repetition_penalty']:
+            value = getattr(config, name)
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0):
+                raise ValueError(f"{name} must be a non-negative number, got {value!r}")
+        if config.top_p is not None and config.top_p > 1:
+            raise ValueError(f"top_p must be in [0, 1], got {config.top_p!r}")
+        if config.do_sample and config.temperature is not None and config.temperature <= 0:
+            raise ValueError(f"temperature must be positive when sampling, got {config.temperature!r}")
+
+    def get(self, data):
+        """Raises TypeError or ValueError for invalid settings."""
+        params = tuple(sorted((k, data[k]) for k in GENERATION_PARAMS if data.get(k, None) is not None))
+        return self._get(params)
+
+
+class GenerationJob:
+    def __init__(self, input_ids, generation_config, stream=False, session_id=None):
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        # chat session whose KV cache the job resumes from and updates, if the scheduler keeps one
+        self.session_id = session_id
+        # configs come from a cache, so equal settings share one object
+        self.key = id(generation_config)
+        self.enqueue_time = time.monotonic()
+        # estimated prompt + new tokens, set by the scheduler for load accounting
+        self.work = 0
+        # seconds the request may take, set by AdmissionController.submit
+        self.deadline_s = None
+        self.response = None
+        self.error = None
+        self._done = threading.Event()
+        self._deltas = queue.Queue() if stream else None
+        self._streamed_text = ""
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop streaming to this job; the batch stops early once all its jobs are cancelled."""
+        self.cancelled = True
+
+    def put_delta(self, text):
+        if self._deltas is not None and text and not self.cancelled:
+            self._streamed_text += text
+            self._deltas.put(text)
+
+    def set_result(self, response):
+        self.response = response
+        if response.startswith(self._streamed_text):
+            self.put_delta(response[len(self._streamed_text):])
+        self._done.set()
+        if self._deltas is not None:
+            self._deltas.put(None)
+
+    def set_exception(self, error):
+        self.error = error
+        self._done.set()
+        if self._deltas is not None:
+            self._deltas.put(None)
+
+    def stream(self):
+        """Yield text deltas as they are generated. Only valid for jobs submitted with stream=True."""
+        while True:
+            text = self._deltas.get()
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise self.error
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("generation job timed out")
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class _AllCancelled(StoppingCriteria):
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return all(job.cancelled for job in self.jobs)
+
+
+class BatchStreamer(BaseStreamer):
+    """Routes the tokens of each batch row to the job that owns the row."""
+
+    def __init__(self, jobs, tokenizer, stop_token_ids):
+        self.jobs = jobs
+        self.tokenizer = tokenizer
+        self.stop_token_ids = stop_token_ids
+        self.token_ids = [[] for _ in jobs]
+        self.texts = [""] * len(jobs)
+        self.finished = [False] * len(jobs)
+        self.prompt_seen = False
+
+    def put(self, value):
+        # the first call carries the (padded) prompt
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, token_id in enumerate(value.view(-1).tolist()):
+            if self.finished[row]:
+                continue
+            if token_id in self.stop_token_ids:
+                self.finished[row] = True
+                continue
+            self.token_ids[row].append(token_id)
+            text = self.tokenizer.decode(self.token_ids[row], skip_special_tokens=True)
+            # wait for the rest of a multi-byte character
+            if text.endswith("\ufffd") or len(text) <= len(self.texts[row]):
+                continue
+            self.jobs[row].put_delta(text[len(self.texts[row]):])
+            self.texts[row] = text
+
+    def end(self):
+        pass
+
+
+class SchedulerStats:
+    """Load figures of a BatchScheduler, used for admission control and metrics."""
+
+    def __init__(self, ema=0.2):
+        self.ema = ema
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.running = 0
+        self.outstanding_tokens = 0
+        self.tokens_per_second = None
+        self.avg_new_tokens = None
+        self.completed = 0
+        self.failed = 0
+        self.queue_wait_sum = 0.0
+        self.queue_wait_max = 0.0
+        self.generation_time_sum = 0.0
+
+    def _smooth(self, old, new):
+        return new if old is None else (1 - self.ema) * old + self.ema * new
+
+    def expected_work(self, prompt_len, generation_config):
+        new_tokens = generation_config.max_new_tokens or 0
+        if self.avg_new_tokens is not None:
+            new_tokens = min(new_tokens, self.avg_new_tokens)
+        return prompt_len + new_tokens
+
+    def estimated_wait(self, extra_tokens=0):
+        """Seconds until `extra_tokens` more work would be done, None before the first batch."""
+        if not self.tokens_per_second:
+            return None
+        return (self.outstanding_tokens + extra_tokens) / self.tokens_per_second
+
+    def on_submit(self, job):
+        with self.lock:
+            self.queue_depth += 1
+            self.outstanding_tokens += job.work
+
+    def on_start(self, jobs):
+        now = time.monotonic()
+        with self.lock:
+            self.queue_depth -= len(jobs)
+            self.running += len(jobs)
+            for job in jobs:
+                wait = now - job.enqueue_time
+                self.queue_wait_sum += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def on_finish(self, jobs, new_tokens, duration):
+        with self.lock:
+            self.running -= len(jobs)
+            self.outstanding_tokens -= sum(job.work for job in jobs)
+            self.generation_time_sum += duration * len(jobs)
+            if new_tokens is None:
+                self.failed += len(jobs)
+                return
+            self.completed += len(jobs)
+            done_tokens = sum(len(job.input_ids) for job in jobs) + sum(new_tokens)
+            if duration > 0:
+                self.tokens_per_second = self._smooth(self.tokens_per_second, done_tokens / duration)
+            for n in new_tokens:
+                self.avg_new_tokens = self._smooth(self.avg_new_tokens, n)
+
+
+class AdmissionController:
+    """Rejects requests early instead of letting them time out in the queue.
+
+    A request is refused with 503 when the queue is full, and with 429 when the
+    estimated wait (outstanding tokens over measured tokens/s) exceeds its deadline.
+    """
+
+    def __init__(self, scheduler, max_queue_depth=64, default_deadline_s=60):
+        self.scheduler = scheduler
+        self.stats = scheduler.stats
+        self.max_queue_depth = max_queue_depth
+        self.default_deadline_s = default_deadline_s
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        # admission and enqueueing are one step, or a burst of requests all passes the depth check
+        self._lock = threading.Lock()
+
+    def _check(self, prompt_len, generation_config, deadline_s):
+        with self.stats.lock:
+            queue_depth = self.stats.queue_depth
+            estimated_wait = self.stats.estimated_wait(self.stats.expected_work(prompt_len, generation_config))
+        if queue_depth >= self.max_queue_depth:
+            self.rejected_queue_full += 1
+            return 503, f"server overloaded: {queue_depth} requests queued"
+        if estimated_wait is not None and estimated_wait > deadline_s:
+            self.rejected_deadline += 1
+            return 429, f"estimated completion in {estimated_wait:.1f}s exceeds the {deadline_s}s deadline"
+        return None
+
+    def submit(self, input_ids, generation_config, deadline_s=None, stream=False):
+        """Return (job, None) for an admitted and queued request, or (None, (status_code, message))."""
+        if deadline_s is None:
+            deadline_s = self.default_deadline_s
+        with self._lock:
+            rejection = self._check(len(input_ids), generation_config, deadline_s)
+            if rejection is not None:
+                return None, rejection
+            job = self.scheduler.submit(input_ids, generation_config, stream=stream)
+            self.admitted += 1
+        job.deadline_s = deadline_s
+        return job, None
+
+
+class BatchScheduler:
+    """Collects concurrent chat requests and runs them as left-padded `generate` batches.
+
+    Jobs are grouped by their generation settings, since one `generate` call can
+    only use one set of sampling parameters.
+
+    With a `prefix_cache` (a prefix_cache.PrefixKVCache), the KV cache of jobs that carry a
+    session id is kept after their batch, and a job whose session has at least
+    `min_prefix_tokens` cached runs on its own from that cache instead of in a batch.
+    """
+
+    def __init__(self, model, tokenizer, generation_config, max_batch_size=8, max_wait_ms=10,
+                 prefix_cache=None, min_prefix_tokens=512):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.generation_config = generation_config
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.prefix_cache = prefix_cache
+        self.min_prefix_tokens = min_prefix_tokens
+        self.stop_token_ids = get_stop_token_ids(tokenizer, generation_config)
+        self.pad_token_id = tokenizer.pad_token_id
+        if self.pad_token_id is None:
+            self.pad_token_id = tokenizer.im_end_id
+
+        self.stats = SchedulerStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids, generation_config=None, stream=False, session_id=None):
+        job = GenerationJob(input_ids, generation_config or self.generation_config, stream=stream, session_id=session_id)
+        job.work = self.stats.expected_work(len(input_ids), job.generation_config)
+        self.stats.on_submit(job)
+        self._queue.put(job)
+        return job
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _resumes_session(self, job):
+        # a long cached prefix saves more prefill than batching the job would
+        return (self.prefix_cache is not None and job.session_id is not None
+                and self.prefix_cache.prefix_length(job.session_id, job.input_ids) >= self.min_prefix_tokens)
+
+    def _loop(self):
+        while True:
+            groups = {}
+            resumed = []
+            for job in self._next_batch():
+                if job.cancelled:
+                    # its client gave up, e.g. at the deadline, while it was queued
+                    self._run([job], self._run_cancelled)
+                elif self._resumes_session(job):
+                    resumed.append(job)
+                else:
+                    groups.setdefault(job.key, []).append(job)
+            for jobs in groups.values():
+                self._run(jobs, self._run_batch)
+            for job in resumed:
+                self._run([job], self._run_resumed)
+
+    def _run(self, jobs, run):
+        self.stats.on_start(jobs)
+        start = time.monotonic()
+        try:
+            new_tokens = run(jobs)
+        except Exception as e:
+            new_tokens = None
+            for job in jobs:
+                job.set_exception(e)
+        if torch.backends.mps.is_available():
+            torch.mps.empty_cache()
+        self.stats.on_finish(jobs, new_tokens, time.monotonic() - start)
+
+    def _run_cancelled(self, jobs):
+        raise RuntimeError("generation job cancelled before it started")
+
+    def _run_resumed(self, jobs):
+        # imported here, prefix_cache imports this module
+        from prefix_cache import generate_ids
+        job = jobs[0]
+        streamer = None
+        if job._deltas is not None:
+            streamer = BatchStreamer(jobs, self.tokenizer, self.stop_token_ids)
+        sequence = generate_ids(self.model, job.input_ids, job.generation_config, self.prefix_cache, job.session_id,
+                                streamer, StoppingCriteriaList([_AllCancelled(jobs)]))
+        token_ids = truncate_at_stop(sequence[len(job.input_ids):], self.stop_token_ids)
+        job.set_result(self.tokenizer.decode(token_ids, skip_special_tokens=True))
+        return [len(token_ids)]
+
+    def _run_batch(self, jobs):
+        max_len = max(len(job.input_ids) for job in jobs)
+        input_ids = torch.full((len(jobs), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(jobs), max_len), dtype=torch.long)
+        for row, job in enumerate(jobs):
+            input_ids[row, max_len - len(job.input_ids):] = torch.tensor(job.input_ids, dtype=torch.long)
+            attention_mask[row, max_len - len(job.input_ids):] = 1
+
+        streamer = None
+        if any(job._deltas is not None for job in jobs):
+            streamer = BatchStreamer(jobs, self.tokenizer, self.stop_token_ids)
+        sessions = []
+        if self.prefix_cache is not None:
+            sessions = [(row, job.session_id, max_len - len(job.input_ids))
+                        for row, job in enumerate(jobs) if job.session_id is not None]
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+                generation_config=jobs[0].generation_config,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([_AllCancelled(jobs)]),
+                return_dict_in_generate=bool(sessions),
+            )
+        sequences = outputs
+        if sessions:
+            sequences = outputs.sequences
+            self.prefix_cache.store_rows(sessions, sequences, getattr(outputs, "past_key_values", None))
+
+        new_tokens = []
+        for row, job in enumerate(jobs):
+            token_ids = truncate_at_stop(sequences[row, max_len:].tolist(), self.stop_token_ids)
+            new_tokens.append(len(token_ids))
+            job.set_result(self.tokenizer.decode(token_ids, skip_special_tokens=True))
+        return new_tokens
@@ -1,28 +1,16 @@
 import os
+import time
 import torch
 import platform
 import subprocess
 from colorama import Fore, Style
 from tempfile import NamedTemporaryFile
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers.generation.utils import GenerationConfig
-
-MODEL_NAME_OR_PATH = "qihoo360/360Zhinao-7B-Chat-4K"
-
-def load_model_tokenizer():
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        device_map="auto",
-        trust_remote_code=True
-    )
-    tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        use_fast=False,
-        trust_remote_code=True
-    )
-    generation_config = GenerationConfig.from_pretrained(MODEL_NAME_OR_PATH)
-    return model, tokenizer, generation_config
+from snapshot import load_model_tokenizer
+from prefix_cache import PrefixKVCache, chat
 
+# a hub id, a local checkpoint, or a directory written by snapshot.py
+MODEL_NAME_OR_PATH = os.environ.get("MODEL_NAME_OR_PATH", "qihoo360/360Zhinao-7B-Chat-4K")
+SESSION_ID = "cli"
 
 def clear_screen():
     if platform.system() == "Windows":
@@ -33,6 +21,34 @@ def clear_screen():
     return []
 
 
+class StreamRenderer:
+    """Writes only the newly generated suffix of each accumulated response and times the turn."""
+
+    def __init__(self):
+        self.response = ""
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+
+    def update(self, response):
+        if self.first_token_time is None and response:
+            self.first_token_time = time.perf_counter()
+        if response.startswith(self.response):
+            print(response[len(self.response):], end='', flush=True)
+        else:
+            print("\n" + response, end='', flush=True)
+        self.response = response
+
+    def summary(self, tokenizer):
+        if self.first_token_time is None:
+            return ""
+        end_time = time.perf_counter()
+        num_tokens = len(tokenizer.encode(self.response))
+        ttft = self.first_token_time - self.start_time
+        decode_time = end_time - self.first_token_time
+        tokens_per_second = (num_tokens - 1) / decode_time if decode_time > 0 else 0.0
+        return "(首字延迟 {:.2f}s，{} tokens，{:.1f} tokens/s)".format(ttft, num_tokens, tokens_per_second)
+
+
 def vim_input():
     with NamedTemporaryFile() as tempfile:
         tempfile.close()
@@ -42,7 +58,8 @@ def vim_input():
 
 
 def main(stream=True):
-    model, tokenizer, generation_config = load_model_tokenizer()
+    model, tokenizer, generation_config = load_model_tokenizer(MODEL_NAME_OR_PATH)
+    cache = PrefixKVCache()
 
     messages = clear_screen()
     while True:
@@ -51,6 +68,7 @@ def main(stream=True):
             if prompt.strip() == "exit":
                 break
             if prompt.strip() == "clear":
+                cache.evict(SESSION_ID)
                 messages = clear_screen()
                 continue
             if prompt.strip() == 'vim':
@@ -65,21 +83,21 @@ def main(stream=True):
             print(Fore.YELLOW + "({}流式生成)\n".format("开启" if stream else "关闭"), end='')
             continue
         if stream:
+            renderer = StreamRenderer()
             try:
                 messages.append({"role": "user", "content": prompt})
-                for response in model.chat(tokenizer=tokenizer, messages=messages, stream=stream, generation_config=generation_config):
-                    clear_screen()
-                    print(Fore.GREEN + Style.BRIGHT + "\n>用户：" + Style.NORMAL + prompt, flush=True)
-                    print(Fore.BLUE + Style.BRIGHT + "\n>助手：" + Style.NORMAL + response, end='', flush=True)
+                for response in chat(model, tokenizer, messages, generation_config, cache=cache, session_id=SESSION_ID, stream=stream):
+                    renderer.update(response)
                     if torch.backends.mps.is_available():
                         torch.mps.empty_cache()
                 messages.append({"role": "assistant", "content": response})
             except KeyboardInterrupt:
                 pass
             print()
+            print(Fore.YELLOW + renderer.summary(tokenizer), end='')
         else:
             messages.append({"role": "user", "content": prompt})
-            response = model.chat(tokenizer=tokenizer, messages=messages, stream=stream, generation_config=generation_config)
+            response = chat(model, tokenizer, messages, generation_config, cache=cache, session_id=SESSION_ID, stream=stream)
             messages.append({"role": "assistant", "content": response})
             print(Style.NORMAL + response)
             if torch.backends.mps.is_available():
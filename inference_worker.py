@@ -0,0 +1,298 @@
+"""Shared inference process for web_demo.py.
+
+The worker owns the model and serves chat jobs from any number of demo sessions
+over a local multiprocessing connection. Jobs from all sessions go through one
+BatchScheduler, and generated text is streamed back to the session as it arrives.
+Each chat session's KV cache is kept, so a long conversation only prefills its new turn.
+
+    python inference_worker.py --max-batch-size 8 --max-wait-ms 10 --prefix-cache-gb 4
+
+Connections are authenticated with a random key the worker writes, readable only by
+its user, to ~/.cache/360zhinao/inference_worker_<port>.key (or ZHINAO_WORKER_KEY_FILE)
+on every launch; the demo reads it from there.
+"""
+import os
+import sys
+import time
+import uuid
+import queue
+import secrets
+import argparse
+import threading
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from snapshot import load_model_tokenizer
+from chat_engine import BatchScheduler, GenerationConfigCache, make_chat_input_ids
+from prefix_cache import PrefixKVCache
+
+# a hub id, a local checkpoint, or a directory written by snapshot.py
+MODEL_NAME_OR_PATH = os.environ.get("MODEL_NAME_OR_PATH", "qihoo360/360Zhinao-7B-Chat-4K")
+ADDRESS = ("127.0.0.1", 8361)
+
+
+def authkey_file(address):
+    default = os.path.join(os.path.expanduser("~"), ".cache", "360zhinao", f"inference_worker_{address[1]}.key")
+    return os.environ.get("ZHINAO_WORKER_KEY_FILE", default)
+
+
+def write_authkey(path):
+    """Create a fresh key for this launch; the file is only readable by the worker's user."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    authkey = secrets.token_bytes(32)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    os.replace(tmp_path, path)
+    return authkey
+
+
+def read_authkey(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class _Session:
+    """One client connection on the worker side."""
+
+    def __init__(self, conn, scheduler, tokenizer, config_cache):
+        self.conn = conn
+        self.scheduler = scheduler
+        self.tokenizer = tokenizer
+        self.config_cache = config_cache
+        # forward threads remove their job when it ends
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+    def send(self, *msg):
+        with self.send_lock:
+            self.conn.send(msg)
+
+    def serve(self):
+        try:
+            while True:
+                msg = None
+                try:
+                    msg = self.conn.recv()
+                    self.handle(msg)
+                except (EOFError, OSError):
+                    raise
+                except Exception as e:
+                    # a malformed message fails its own job, not the connection every session shares
+                    job_id = msg[1] if isinstance(msg, tuple) and len(msg) > 1 else None
+                    self.send(job_id, "error", f"{type(e).__name__}: {e}")
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.jobs_lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                job.cancel()
+            self.conn.close()
+
+    def handle(self, msg):
+        if msg[0] == "chat":
+            self.start_job(*msg[1:])
+        elif msg[0] == "cancel":
+            with self.jobs_lock:
+                job = self.jobs.get(msg[1])
+            if job is not None:
+                job.cancel()
+        elif msg[0] == "evict":
+            if self.scheduler.prefix_cache is not None:
+                self.scheduler.prefix_cache.evict(msg[1])
+        else:
+            raise ValueError(f"unknown message {msg[0]!r}")
+
+    def start_job(self, job_id, messages, params, session_id=None):
+        try:
+            generation_config = self.config_cache.get(params)
+        except (TypeError, ValueError) as e:
+            self.send(job_id, "error", f"invalid generation parameters: {e}")
+            return
+        input_ids = make_chat_input_ids(self.tokenizer, messages)
+        job = self.scheduler.submit(input_ids, generation_config, stream=True, session_id=session_id)
+        with self.jobs_lock:
+            self.jobs[job_id] = job
+        threading.Thread(target=self.forward, args=(job_id, job), daemon=True).start()
+
+    def forward(self, job_id, job):
+        try:
+            for text in job.stream():
+                self.send(job_id, "delta", text)
+            self.send(job_id, "done", job.response)
+        except (EOFError, OSError):
+            job.cancel()
+        except Exception as e:
+            try:
+                self.send(job_id, "error", str(e))
+            except (EOFError, OSError):
+                pass
+        finally:
+            with self.jobs_lock:
+                self.jobs.pop(job_id, None)
+
+
+def serve(address=ADDRESS, max_batch_size=8, max_wait_ms=10, prefix_cache_gb=4, min_prefix_tokens=512):
+    model, tokenizer, generation_config = load_model_tokenizer(MODEL_NAME_OR_PATH)
+    prefix_cache = PrefixKVCache(int(prefix_cache_gb * 1024 ** 3)) if prefix_cache_gb > 0 else None
+    scheduler = BatchScheduler(model, tokenizer, generation_config, max_batch_size, max_wait_ms,
+                               prefix_cache, min_prefix_tokens)
+    config_cache = GenerationConfigCache(generation_config)
+
+    # connections are pickled both ways, so only clients holding the key may connect
+    authkey = write_authkey(authkey_file(address))
+    with Listener(address, authkey=authkey) as listener:
+        print(f"inference worker listening on {address[0]}:{address[1]}", flush=True)
+        while True:
+            conn = listener.accept()
+            session = _Session(conn, scheduler, tokenizer, config_cache)
+            threading.Thread(target=session.serve, daemon=True).start()
+
+
+class InferenceClient:
+    """Client side of the worker, shared by all sessions of a demo process.
+
+    If the connection drops (say the worker was restarted), the jobs on it fail and the next
+    `chat` connects again, spawning a new worker if needed.
+    """
+
+    def __init__(self, address=ADDRESS, spawn=True, timeout=1800):
+        self.address = address
+        self.spawn = spawn
+        self.timeout = timeout
+        self.conn = None
+        self.connect_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # job id -> (connection, queue of replies)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self._ensure_connected()
+
+    @staticmethod
+    def _connect(address, spawn, timeout):
+        deadline = time.monotonic() + timeout
+        process = None
+        while True:
+            authkey = read_authkey(authkey_file(address))
+            try:
+                if authkey is None:
+                    raise ConnectionRefusedError(f"no key file at {authkey_file(address)}")
+                return Client(address, authkey=authkey)
+            except ConnectionRefusedError:
+                if not spawn:
+                    raise
+            except AuthenticationError:
+                # a worker is listening but has not written its new key yet
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(1)
+                continue
+            if process is None:
+                worker = os.path.abspath(__file__)
+                process = subprocess.Popen([sys.executable, worker, "--host", address[0], "--port", str(address[1])],
+                                           cwd=os.path.dirname(worker))
+            elif process.poll() is not None:
+                raise RuntimeError(f"inference worker exited with code {process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError("inference worker did not come up in time")
+            time.sleep(1)
+
+    def _ensure_connected(self):
+        with self.connect_lock:
+            if self.conn is None:
+                conn = self._connect(self.address, self.spawn, self.timeout)
+                threading.Thread(target=self._dispatch, args=(conn,), daemon=True).start()
+                self.conn = conn
+            return self.conn
+
+    def _send(self, conn, *msg):
+        with self.send_lock:
+            conn.send(msg)
+
+    def _dispatch(self, conn):
+        while True:
+            try:
+                job_id, kind, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.jobs_lock:
+                entry = self.jobs.get(job_id)
+            if entry is not None:
+                entry[1].put((kind, payload))
+        with self.connect_lock:
+            if self.conn is conn:
+                self.conn = None
+        # closed before collecting, so a job registered after this fails on its own send
+        conn.close()
+        with self.jobs_lock:
+            lost = [deltas for job_conn, deltas in self.jobs.values() if job_conn is conn]
+        for deltas in lost:
+            deltas.put(("error", "inference worker connection lost"))
+
+    def chat(self, messages, params=None, session_id=None):
+        """Yield the accumulated response text, like `model.chat(..., stream=True)`.
+
+        Turns sent with the same `session_id` reuse the KV cache of the conversation so far.
+        """
+        conn = self._ensure_connected()
+        job_id = uuid.uuid4().hex
+        deltas = queue.Queue()
+        with self.jobs_lock:
+            self.jobs[job_id] = (conn, deltas)
+        response = ""
+        done = False
+        try:
+            try:
+                self._send(conn, "chat", job_id, messages, params or {}, session_id)
+            except (EOFError, OSError):
+                done = True
+                raise RuntimeError("inference worker connection lost")
+            while True:
+                kind, payload = deltas.get()
+                if kind == "delta":
+                    response += payload
+                    yield response
+                elif kind == "done":
+                    done = True
+                    if payload != response:
+                        yield payload
+                    break
+                else:
+                    done = True
+                    raise RuntimeError(payload)
+        finally:
+            with self.jobs_lock:
+                self.jobs.pop(job_id, None)
+            if not done:
+                try:
+                    self._send(conn, "cancel", job_id)
+                except (EOFError, OSError):
+                    pass
+
+    def evict(self, session_id):
+        """Drop the session's KV cache, e.g. when its conversation is cleared."""
+        try:
+            self._send(self._ensure_connected(), "evict", session_id)
+        except (EOFError, OSError):
+            # the worker is gone, and its caches with it
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=ADDRESS[0])
+    parser.add_argument("--port", type=int, default=ADDRESS[1])
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--prefix-cache-gb", type=float, default=4, help="KV cache kept for chat sessions, 0 to disable")
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=512,
+                        help="cached prefix length from which a turn runs alone from its cache instead of batched")
+    args = parser.parse_args()
+
+    serve((args.host, args.port), args.max_batch_size, args.max_wait_ms, args.prefix_cache_gb, args.prefix_cache_min_tokens)
@@ -1,11 +1,17 @@
-import sys
-from flask import Flask, request, jsonify
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers.generation.utils import GenerationConfig
+import os
+import json
+import time
+import uuid
+import argparse
+from flask import Flask, Response, request, jsonify, stream_with_context
+from snapshot import load_model_tokenizer
+from chat_engine import AdmissionController, BatchScheduler, GenerationConfigCache, make_chat_input_ids
+from response_cache import ResponseCache, make_cache_key
 
 app = Flask(__name__)
 
-MODEL_NAME_OR_PATH = "qihoo360/360Zhinao-7B-Chat-4K"
+# a hub id, a local checkpoint, or a directory written by snapshot.py
+MODEL_NAME_OR_PATH = os.environ.get("MODEL_NAME_OR_PATH", "qihoo360/360Zhinao-7B-Chat-4K")
 
 class InvalidAPIUsage(Exception):
     status_code = 400
@@ -28,21 +34,62 @@ def invalid_api_usage(e):
     return jsonify(e.to_dict()), e.status_code
 
 
-def load_model_tokenizer():
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        device_map="auto",
-        trust_remote_code=True
-    )
-    tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        use_fast=False,
-        trust_remote_code=True
-    )
-    generation_config = GenerationConfig.from_pretrained(MODEL_NAME_OR_PATH)
-    return model, tokenizer, generation_config
+model, tokenizer, generation_config = load_model_tokenizer(MODEL_NAME_OR_PATH)
+scheduler = BatchScheduler(model, tokenizer, generation_config)
+admission = AdmissionController(scheduler)
+
+config_cache = GenerationConfigCache(generation_config)
+# enabled from the command line, see --response-cache-mb
+response_cache = None
+
+
+def request_generation_config(data):
+    try:
+        return config_cache.get(data)
+    except (TypeError, ValueError) as e:
+        raise InvalidAPIUsage(f"invalid generation parameters: {e}")
+
+
+def make_chunk(completion_id, created, delta, finish_reason=None):
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": MODEL_NAME_OR_PATH,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_chat_completion(job=None, cached_response=None, cache_key=None):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def generate():
+        yield make_chunk(completion_id, created, {"role": "assistant"})
+        if cached_response is not None:
+            yield make_chunk(completion_id, created, {"content": cached_response})
+            yield make_chunk(completion_id, created, {}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+            return
+        try:
+            for text in job.stream():
+                yield make_chunk(completion_id, created, {"content": text})
+            if cache_key is not None:
+                response_cache.put(cache_key, job.response)
+            yield make_chunk(completion_id, created, {}, finish_reason="stop")
+        except Exception as e:
+            app.logger.exception("stream error in %s", completion_id)
+            # the status line is long gone, so report the failure in-band; OpenAI clients raise on an "error" event
+            error = {"error": {"message": str(e), "type": type(e).__name__, "code": 500}}
+            yield f"data: {json.dumps(error, ensure_ascii=False)}\n\n"
+        finally:
+            # the client went away or the stream ended, either way nobody reads this job any more
+            job.cancel()
+        yield "data: [DONE]\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
-model, tokenizer, generation_config = load_model_tokenizer()
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completion():
@@ -50,22 +97,40 @@ def chat_completion():
         data = request.get_json()
         messages = data.get('messages', [])
         
-        if data.get('max_new_tokens', None) is not None:
-            generation_config.max_new_tokens = data.get('max_new_tokens', None)
-        if data.get('do_sample', None) is not None:
-            generation_config.do_sample = data.get('do_sample', None)
-        if data.get('top_k', None) is not None:
-            generation_config.top_k = data.get('top_k', None)
-        if data.get('top_p', None) is not None:
-            generation_config.top_p = data.get('top_p', None)
-        if data.get('temperature', None) is not None:
-            generation_config.temperature = data.get('temperature', None)
-        if data.get('repetition_penalty', None) is not None:
-            generation_config.repetition_penalty = data.get('repetition_penalty', None)
-        
-        print("generation_config: ", generation_config)
-
-        response = model.chat(tokenizer=tokenizer, messages=messages, stream=False, generation_config=generation_config)
+        request_config = request_generation_config(data)
+        print("generation_config: ", request_config)
+
+        cache_key = None
+        if response_cache is not None and not request_config.do_sample:
+            cache_key = make_cache_key(MODEL_NAME_OR_PATH, messages, request_config)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                if data.get('stream', False):
+                    return stream_chat_completion(cached_response=cached_response)
+                return jsonify({
+                    "model": MODEL_NAME_OR_PATH,
+                    "choices": [{"message": {"role": "assistant", "content": cached_response}}]
+                })
+
+        input_ids = make_chat_input_ids(tokenizer, messages)
+        deadline_s = data.get('timeout', None)
+        if deadline_s is not None and (not isinstance(deadline_s, (int, float)) or deadline_s <= 0):
+            raise InvalidAPIUsage(f"timeout must be a positive number of seconds, got {deadline_s!r}")
+        job, rejection = admission.submit(input_ids, request_config, deadline_s, stream=data.get('stream', False))
+        if rejection is not None:
+            status_code, message = rejection
+            raise InvalidAPIUsage(message, status_code=status_code)
+
+        if data.get('stream', False):
+            return stream_chat_completion(job, cache_key=cache_key)
+        try:
+            response = job.wait(job.deadline_s)
+        except TimeoutError:
+            # dropped if still queued; a batch stops early once none of its jobs is wanted
+            job.cancel()
+            raise InvalidAPIUsage(f"generation did not finish within the {job.deadline_s}s deadline", status_code=504)
+        if cache_key is not None:
+            response_cache.put(cache_key, response)
 
         response_data = {
             "model": MODEL_NAME_OR_PATH,
@@ -76,13 +141,84 @@ def chat_completion():
 
         return jsonify(response_data)
 
+    except InvalidAPIUsage:
+        raise
     except Exception as e:
         raise InvalidAPIUsage(str(e), status_code=500)
 
 
-if __name__ == '__main__':
-    port = 8360
-    if len(sys.argv) >= 2:
-        port = int(sys.argv[1])
+@app.route('/v1/models', methods=['GET'])
+def list_models():
+    # the same listing vLLM serves, which clients and router.py use to find the model name
+    return jsonify({
+        "object": "list",
+        "data": [{
+            "id": MODEL_NAME_OR_PATH,
+            "object": "model",
+            "owned_by": "qihoo360",
+            "max_model_len": getattr(model.config, "max_position_embeddings", None),
+        }]
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = scheduler.stats
+    lines = []
+
+    def metric(name, kind, help_text, value, labels=""):
+        if not any(line.startswith(f"# TYPE {name} ") for line in lines):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{labels} {value}")
+
+    with stats.lock:
+        metric("zhinao_queue_depth", "gauge", "Requests waiting for a batch.", stats.queue_depth)
+        metric("zhinao_running_requests", "gauge", "Requests in the current generate call.", stats.running)
+        metric("zhinao_outstanding_tokens", "gauge", "Estimated prompt and new tokens of unfinished requests.", stats.outstanding_tokens)
+        metric("zhinao_tokens_per_second", "gauge", "Smoothed processed tokens per second.", stats.tokens_per_second or 0)
+        metric("zhinao_estimated_wait_seconds", "gauge", "Estimated time to drain outstanding work.", stats.estimated_wait() or 0)
+        finished = stats.completed + stats.failed
+        metric("zhinao_queue_wait_seconds_sum", "counter", "Total time requests spent queued.", stats.queue_wait_sum)
+        metric("zhinao_queue_wait_seconds_count", "counter", "Requests that left the queue.", finished + stats.running)
+        metric("zhinao_queue_wait_seconds_max", "gauge", "Longest time a request spent queued.", stats.queue_wait_max)
+        metric("zhinao_generation_seconds_sum", "counter", "Total time requests spent in generate.", stats.generation_time_sum)
+        metric("zhinao_generation_seconds_count", "counter", "Requests that finished generating.", finished)
+        metric("zhinao_requests_total", "counter", "Requests by outcome.", stats.completed, '{outcome="completed"}')
+        metric("zhinao_requests_total", "counter", "Requests by outcome.", stats.failed, '{outcome="failed"}')
+    metric("zhinao_admission_total", "counter", "Admission decisions.", admission.admitted, '{decision="admitted"}')
+    metric("zhinao_admission_total", "counter", "Admission decisions.", admission.rejected_queue_full, '{decision="queue_full"}')
+    metric("zhinao_admission_total", "counter", "Admission decisions.", admission.rejected_deadline, '{decision="deadline"}')
+    if response_cache is not None:
+        metric("zhinao_response_cache_total", "counter", "Response cache lookups by result.", response_cache.hits, '{result="hit"}')
+        metric("zhinao_response_cache_total", "counter", "Response cache lookups by result.", response_cache.disk_hits, '{result="disk_hit"}')
+        metric("zhinao_response_cache_total", "counter", "Response cache lookups by result.", response_cache.misses, '{result="miss"}')
+        metric("zhinao_response_cache_entries", "gauge", "Responses held in memory.", len(response_cache))
+        metric("zhinao_response_cache_bytes", "gauge", "Size of the responses held in memory.", response_cache.total_bytes)
+        metric("zhinao_response_cache_disk_bytes", "gauge", "Size of the cache files on disk.", response_cache.disk_bytes)
+
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', nargs='?', type=int, default=8360)
+    parser.add_argument('--max-batch-size', type=int, default=8, help='max requests per generate call')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='how long to wait for a batch to fill')
+    parser.add_argument('--max-queue-depth', type=int, default=64, help='reject with 503 beyond this many queued requests')
+    parser.add_argument('--default-deadline', type=float, default=60, help='seconds a request may take unless it sets "timeout"')
+    parser.add_argument('--response-cache-mb', type=float, default=0, help='cache greedy (do_sample=false) responses, 0 disables')
+    parser.add_argument('--response-cache-ttl', type=float, default=3600, help='seconds a cached response stays valid')
+    parser.add_argument('--response-cache-dir', default=None, help='also keep cached responses on disk in this directory')
+    parser.add_argument('--response-cache-disk-mb', type=float, default=1024, help='size limit of --response-cache-dir')
+    args = parser.parse_args()
+
+    scheduler.max_batch_size = args.max_batch_size
+    scheduler.max_wait_ms = args.max_wait_ms
+    admission.max_queue_depth = args.max_queue_depth
+    admission.default_deadline_s = args.default_deadline
+    if args.response_cache_mb > 0:
+        response_cache = ResponseCache(int(args.response_cache_mb * 1024 ** 2), args.response_cache_ttl, args.response_cache_dir,
+                                       int(args.response_cache_disk_mb * 1024 ** 2))
+
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
@@ -0,0 +1,193 @@
+import threading
+from collections import OrderedDict
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from chat_engine import get_stop_token_ids, make_chat_input_ids, truncate_at_stop
+
+
+def _to_legacy(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _crop(past_key_values, length):
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+def _cache_length(past_key_values):
+    return past_key_values[0][0].shape[2]
+
+
+def _cache_bytes(past_key_values):
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+class PrefixKVCache:
+    """Keeps the KV cache of each chat session so a new turn only prefills what was appended.
+
+    Sessions are keyed by an arbitrary id and evicted least-recently-used first once
+    the cached tensors exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _match(self, session_id, input_ids):
+        with self._lock:
+            if session_id not in self._sessions:
+                return None, 0
+            self._sessions.move_to_end(session_id)
+            token_ids, past_key_values, _ = self._sessions[session_id]
+
+        prefix_len = 0
+        for a, b in zip(token_ids, input_ids[:-1]):
+            if a != b:
+                break
+            prefix_len += 1
+        return past_key_values, prefix_len
+
+    def prefix_length(self, session_id, input_ids):
+        """Number of leading tokens of `input_ids` that `lookup` would return a cache for."""
+        return self._match(session_id, input_ids)[1]
+
+    def lookup(self, session_id, input_ids):
+        """Return (past_key_values, prefix_len) covering the longest cached prefix of `input_ids`.
+
+        At least one token is always left uncached so `generate` has something to feed.
+        """
+        past_key_values, prefix_len = self._match(session_id, input_ids)
+        if prefix_len == 0:
+            return None, 0
+        return _crop(past_key_values, prefix_len), prefix_len
+
+    def store(self, session_id, token_ids, past_key_values):
+        nbytes = _cache_bytes(past_key_values)
+        with self._lock:
+            self._evict(session_id)
+            self._sessions[session_id] = (token_ids, past_key_values, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and len(self._sessions) > 1:
+                self._evict(next(iter(self._sessions)))
+
+    def store_rows(self, rows, sequences, past_key_values):
+        """Store the sessions of a left-padded batch; `rows` holds (row, session_id, first prompt column).
+
+        The model takes positions from the attention mask, so a row's cache without its padding
+        columns is the one an unpadded run would have left.
+        """
+        if past_key_values is None:
+            return
+        past_key_values = _to_legacy(past_key_values)
+        length = _cache_length(past_key_values)
+        for row, session_id, start in rows:
+            # copies, so the cache does not pin the tensors of the whole batch
+            row_cache = tuple((k[row:row + 1, :, start:length].clone(), v[row:row + 1, :, start:length].clone())
+                              for k, v in past_key_values)
+            self.store(session_id, sequences[row, start:length].tolist(), row_cache)
+
+    def evict(self, session_id):
+        with self._lock:
+            self._evict(session_id)
+
+    def _evict(self, session_id):
+        if session_id in self._sessions:
+            self.total_bytes -= self._sessions.pop(session_id)[2]
+
+
+class _StopOnEvent(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def _prefill(model, input_ids, cache, session_id):
+    past_key_values, prefix_len = cache.lookup(session_id, input_ids)
+    if past_key_values is None:
+        return None
+    # bring the cache up to everything but the last prompt token, generate() feeds that one
+    if prefix_len < len(input_ids) - 1:
+        with torch.no_grad():
+            outputs = model(
+                input_ids=torch.tensor([input_ids[prefix_len:-1]], device=model.device),
+                attention_mask=torch.ones((1, len(input_ids) - 1), dtype=torch.long, device=model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        past_key_values = _to_legacy(outputs.past_key_values)
+    return past_key_values
+
+
+def generate_ids(model, input_ids, generation_config, cache, session_id, streamer=None, stopping_criteria=None):
+    """Run `generate` on one prompt, resuming from the session's cache, and return the full sequence."""
+    past_key_values = _prefill(model, input_ids, cache, session_id) if cache is not None else None
+
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long, device=model.device),
+            past_key_values=past_key_values,
+            generation_config=generation_config,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+            return_dict_in_generate=True,
+        )
+    sequence = outputs.sequences[0].tolist()
+
+    if cache is not None and getattr(outputs, "past_key_values", None) is not None:
+        past_key_values = _to_legacy(outputs.past_key_values)
+        cache.store(session_id, sequence[:_cache_length(past_key_values)], past_key_values)
+    return sequence
+
+
+def _generate(model, tokenizer, messages, generation_config, cache, session_id, streamer=None, stopping_criteria=None):
+    input_ids = make_chat_input_ids(tokenizer, messages)
+    sequence = generate_ids(model, input_ids, generation_config, cache, session_id, streamer, stopping_criteria)
+    token_ids = truncate_at_stop(sequence[len(input_ids):], get_stop_token_ids(tokenizer, generation_config))
+    return tokenizer.decode(token_ids, skip_special_tokens=True)
+
+
+def _chat_stream(model, tokenizer, messages, generation_config, cache, session_id):
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop_event = threading.Event()
+    stopping_criteria = StoppingCriteriaList([_StopOnEvent(stop_event)])
+    result = {}
+
+    def run():
+        try:
+            result["response"] = _generate(model, tokenizer, messages, generation_config, cache, session_id,
+                                           streamer, stopping_criteria)
+        except Exception as e:
+            result["error"] = e
+            streamer.end()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    response = ""
+    try:
+        for text in streamer:
+            response += text
+            yield response
+    finally:
+        # stop generating as soon as the consumer goes away, e.g. a Ctrl-C or a Streamlit rerun
+        stop_event.set()
+        thread.join()
+    if "error" in result:
+        raise result["error"]
+    if result["response"] != response:
+        yield result["response"]
+
+
+def chat(model, tokenizer, messages, generation_config, cache=None, session_id=None, stream=False):
+    """Drop-in replacement for `model.chat` that reuses the session's KV cache across turns.
+
+    With stream=True, yields the accumulated response text like `model.chat` does.
+    """
+    if stream:
+        return _chat_stream(model, tokenizer, messages, generation_config, cache, session_id)
+    return _generate(model, tokenizer, messages, generation_config, cache, session_id)
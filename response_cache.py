@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model_name, messages, generation_config):
+    """Canonical hash of a greedy request. Sampling-only settings do not change greedy output."""
+    payload = {
+        "model": model_name,
+        "messages": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+        "max_new_tokens": generation_config.max_new_tokens,
+        "repetition_penalty": generation_config.repetition_penalty,
+    }
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache of responses to deterministic (do_sample=False) requests.
+
+    The in-memory tier is bounded by the UTF-8 size of the cached responses. With
+    `cache_dir` set, entries are also written to disk as one JSON file per key, so
+    they survive restarts; disk entries obey the same TTL, are deleted once found
+    expired, and the least recently used files go when they exceed `disk_max_bytes`.
+    Disk errors are logged and otherwise ignored: the cache never fails a request.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, ttl=3600, cache_dir=None, disk_max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.total_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # key -> file size of the entries on disk, least recently used first
+        self._disk = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan_disk()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, created, _ = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                self._pop(key)
+
+        entry = self._read_disk(key, now)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._insert(key, entry["response"], entry["created"])
+            return entry["response"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, response):
+        created = time.time()
+        with self._lock:
+            self._insert(key, response, created)
+        self._write_disk(key, response, created)
+
+    def _insert(self, key, response, created):
+        self._pop(key)
+        nbytes = len(response.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (response, created, nbytes)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)[2]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _scan_disk(self):
+        """Index the files an earlier run left, oldest first, deleting expired entries and stray tmp files."""
+        now = time.time()
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > (60 if name.endswith(".tmp") else self.ttl):
+                    _unlink(path)
+                elif name.endswith(".json"):
+                    files.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        with self._lock:
+            for _, key, nbytes in sorted(files):
+                self._disk[key] = nbytes
+                self.disk_bytes += nbytes
+            self._trim_disk()
+
+    def _remove_disk(self, key):
+        with self._lock:
+            if key in self._disk:
+                self.disk_bytes -= self._disk.pop(key)
+        _unlink(self._path(key))
+
+    def _trim_disk(self):
+        while self.disk_bytes > self.disk_max_bytes:
+            key, nbytes = self._disk.popitem(last=False)
+            self.disk_bytes -= nbytes
+            _unlink(self._path(key))
+
+    def _read_disk(self, key, now):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+            if now - entry["created"] <= self.ttl:
+                with self._lock:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                return entry
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        # expired or unreadable
+        self._remove_disk(key)
+        return None
+
+    def _write_disk(self, key, response, created):
+        if not self.cache_dir:
+            return
+        data = json.dumps({"response": response, "created": created}, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # disk full, read-only or no permission: keep serving from memory
+            logger.warning("could not write response cache entry %s: %s", path, e)
+            _unlink(tmp_path)
+            return
+        with self._lock:
+            if key in self._disk:
+                self.disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(data)
+            self.disk_bytes += len(data)
+            self._trim_disk()
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
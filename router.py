@@ -0,0 +1,256 @@
+import asyncio
+import argparse
+import aiohttp
+from aiohttp import web
+
+
+def estimate_tokens(text):
+    """Rough token count: about one token per CJK character and per four bytes of other text."""
+    # CJK characters take three UTF-8 bytes, ASCII one
+    cjk = (len(text.encode("utf-8")) - len(text)) // 2
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+# RFC 7230 hop-by-hop headers, plus those aiohttp sets for the proxied request itself
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+                      "transfer-encoding", "upgrade", "host", "content-length", "content-type", "accept-encoding"}
+
+
+def forwarded_headers(headers):
+    """Client headers to pass on to a backend, e.g. the Authorization a vLLM --api-key server checks."""
+    connection = {name.strip().lower() for name in headers.get("Connection", "").split(",")}
+    return [(name, value) for name, value in headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in connection]
+
+
+def error_response(message, status_code):
+    # same body as openai_api.py's errors
+    return web.json_response({"status_code": status_code, "msg": message}, status=status_code)
+
+
+class Backend:
+    def __init__(self, spec):
+        url, _, max_model_len = spec.partition("=")
+        self.url = url.rstrip("/")
+        self.configured_max_len = int(max_model_len) if max_model_len else None
+        self.max_model_len = self.configured_max_len
+        self.model = None
+        self.healthy = False
+        self.in_flight = 0
+        self.outstanding_tokens = 0
+        self.requests = 0
+        self.failures = 0
+
+
+class Router:
+    """Proxies /v1/chat/completions to the backend with the fewest outstanding tokens that fits the request.
+
+    A request needs its estimated prompt tokens plus max_tokens of context, so long-context requests only
+    go to replicas whose max_model_len is large enough; among equally loaded backends the one with the
+    smaller context wins, which keeps the long-context replicas free for the requests only they can serve.
+    """
+
+    def __init__(self, backends, default_max_len=4096, default_max_tokens=512, tokenizer=None,
+                 health_interval=5, health_timeout=5, max_connections=100, keepalive=60, backend_api_key=None):
+        self.backends = backends
+        self.default_max_len = default_max_len
+        self.default_max_tokens = default_max_tokens
+        self.tokenizer = tokenizer
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        # vLLM's --api-key also guards /v1/models; proxied requests carry the client's own Authorization
+        self.health_headers = {"Authorization": f"Bearer {backend_api_key}"} if backend_api_key else {}
+        self.session = None
+        self._health_task = None
+
+    async def start(self, app):
+        # one pooled session, so requests reuse keep-alive connections to the backends
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_connections, keepalive_timeout=self.keepalive)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_connect=10))
+        await self.check_all()
+        self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def stop(self, app):
+        self._health_task.cancel()
+        await self.session.close()
+
+    async def check(self, backend):
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.health_timeout)
+            async with self.session.get(backend.url + "/v1/models", timeout=timeout,
+                                        headers=self.health_headers) as response:
+                if response.status != 200:
+                    raise ValueError(f"HTTP {response.status}")
+                card = (await response.json())["data"][0]
+            backend.model = card.get("id")
+            backend.max_model_len = backend.configured_max_len or card.get("max_model_len") or self.default_max_len
+            if not backend.healthy:
+                print(f"backend up: {backend.url} ({backend.model}, max_model_len {backend.max_model_len})")
+            backend.healthy = True
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, IndexError, TypeError) as e:
+            if backend.healthy:
+                print(f"backend down: {backend.url}: {type(e).__name__}: {e}")
+            backend.healthy = False
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_all()
+
+    async def estimate_prompt_tokens(self, messages):
+        texts = [str(m.get("content") or "") for m in messages if isinstance(m, dict)]
+        if self.tokenizer is None:
+            tokens = sum(estimate_tokens(text) for text in texts)
+        else:
+            # long contexts take a while to tokenize, keep the event loop free
+            loop = asyncio.get_running_loop()
+            tokens = await loop.run_in_executor(None, lambda: sum(len(self.tokenizer.encode(text)) for text in texts))
+        # role and <|im_start|>/<|im_end|> markers
+        return tokens + 4 * len(texts) + 3
+
+    def choose(self, required_tokens, exclude=()):
+        candidates = [b for b in self.backends
+                      if b.healthy and b not in exclude and (b.max_model_len or self.default_max_len) >= required_tokens]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.outstanding_tokens, b.max_model_len, b.in_flight))
+
+    async def chat_completions(self, request):
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError("the request body must be a JSON object")
+        except ValueError as e:
+            return error_response(f"invalid JSON body: {e}", 400)
+        prompt_tokens = await self.estimate_prompt_tokens(data.get("messages") or [])
+        max_tokens = data.get("max_tokens") or data.get("max_new_tokens") or self.default_max_tokens
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1:
+            return error_response(f"max_tokens must be a positive integer, got {max_tokens!r}", 400)
+        required_tokens = prompt_tokens + max_tokens
+
+        tried = []
+        while True:
+            backend = self.choose(required_tokens, tried)
+            if backend is None:
+                if tried:
+                    return error_response(f"all backends that fit {required_tokens} tokens failed", 502)
+                if not any(b.healthy for b in self.backends):
+                    return error_response("no healthy backend", 503)
+                if not any(b.max_model_len and b.max_model_len >= required_tokens for b in self.backends):
+                    return error_response(f"about {required_tokens} tokens (prompt and max_tokens) exceed "
+                                          f"the context of every backend", 400)
+                return error_response(f"no healthy backend fits about {required_tokens} tokens", 503)
+            tried.append(backend)
+            if backend.model is not None:
+                # vLLM only accepts its own served model name
+                data["model"] = backend.model
+            try:
+                return await self._proxy(request, backend, data, required_tokens)
+            except aiohttp.ClientConnectionError as e:
+                # nothing reached the client yet, try the next backend
+                print(f"backend failed: {backend.url}: {type(e).__name__}: {e}")
+                backend.failures += 1
+                backend.healthy = False
+
+    async def _proxy(self, request, backend, data, required_tokens):
+        backend.in_flight += 1
+        backend.outstanding_tokens += required_tokens
+        backend.requests += 1
+        try:
+            async with self.session.post(backend.url + "/v1/chat/completions", json=data,
+                                         headers=forwarded_headers(request.headers)) as upstream:
+                content_type = upstream.headers.get("Content-Type", "application/json")
+                if not content_type.startswith("text/event-stream"):
+                    try:
+                        body = await upstream.read()
+                    except aiohttp.ClientPayloadError as e:
+                        # the backend dropped mid-body; it may have run the request, so it is not retried
+                        print(f"backend failed: {backend.url}: {type(e).__name__}: {e}")
+                        backend.failures += 1
+                        backend.healthy = False
+                        return error_response(f"backend {backend.url} closed the connection mid-response", 502)
+                    return web.Response(status=upstream.status, body=body, headers={"Content-Type": content_type})
+                response = web.StreamResponse(status=upstream.status, headers={"Content-Type": content_type})
+                await response.prepare(request)
+                try:
+                    async for chunk in upstream.content.iter_any():
+                        await response.write(chunk)
+                    await response.write_eof()
+                except (ConnectionResetError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # leaving the block closes the upstream connection, which aborts the request there
+                    print(f"stream from {backend.url} ended early: {type(e).__name__}: {e}")
+                return response
+        finally:
+            backend.in_flight -= 1
+            backend.outstanding_tokens -= required_tokens
+
+    async def list_models(self, request):
+        cards = {}
+        for backend in self.backends:
+            if backend.healthy and backend.model is not None:
+                card = cards.setdefault(backend.model, {"id": backend.model, "object": "model", "owned_by": "qihoo360",
+                                                        "max_model_len": backend.max_model_len})
+                card["max_model_len"] = max(card["max_model_len"], backend.max_model_len)
+        return web.json_response({"object": "list", "data": list(cards.values())})
+
+    async def metrics(self, request):
+        lines = []
+
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for backend, value in values:
+                lines.append(f'{name}{{backend="{backend.url}"}} {value}')
+
+        metric("zhinao_router_backend_healthy", "gauge", "Whether the last health check passed.",
+               [(b, int(b.healthy)) for b in self.backends])
+        metric("zhinao_router_in_flight_requests", "gauge", "Requests being proxied to the backend.",
+               [(b, b.in_flight) for b in self.backends])
+        metric("zhinao_router_outstanding_tokens", "gauge", "Estimated prompt and max tokens of in-flight requests.",
+               [(b, b.outstanding_tokens) for b in self.backends])
+        metric("zhinao_router_requests_total", "counter", "Requests routed to the backend.",
+               [(b, b.requests) for b in self.backends])
+        metric("zhinao_router_failures_total", "counter", "Connection failures while proxying.",
+               [(b, b.failures) for b in self.backends])
+        return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.list_models)
+        app.router.add_get("/metrics", self.metrics)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Route chat completions across Zhinao replicas.')
+    parser.add_argument('--backend', action='append', required=True,
+                        help='backend base url, optionally with its context length: http://host:8360=4096')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--default-max-len', type=int, default=4096,
+                        help='context length of backends that neither set one nor report max_model_len')
+    parser.add_argument('--default-max-tokens', type=int, default=512, help='assumed max_tokens of requests without one')
+    parser.add_argument('--tokenizer', default=None, help='count prompt tokens with this tokenizer instead of estimating')
+    parser.add_argument('--health-interval', type=float, default=5, help='seconds between /v1/models health checks')
+    parser.add_argument('--max-connections', type=int, default=100, help='pooled connections per backend')
+    parser.add_argument('--keepalive', type=float, default=60, help='seconds an idle pooled connection is kept')
+    parser.add_argument('--backend-api-key', default=None,
+                        help='--api-key of the backends, for the health checks; clients send their own')
+    args = parser.parse_args()
+
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    router = Router([Backend(spec) for spec in args.backend], args.default_max_len, args.default_max_tokens,
+                    tokenizer, args.health_interval, max_connections=args.max_connections, keepalive=args.keepalive,
+                    backend_api_key=args.backend_api_key)
+    web.run_app(router.make_app(), host=args.host, port=args.port)
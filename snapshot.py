@@ -0,0 +1,148 @@
+"""Fast model start-up from a pre-converted local snapshot.
+
+Create a snapshot once:
+
+    python snapshot.py qihoo360/360Zhinao-7B-Chat-4K ./360Zhinao-7B-Chat-4K-snapshot
+
+and point MODEL_NAME_OR_PATH at it. A snapshot holds the weights as safetensors shards
+in their final dtype, the tokenizer and generation config, and the remote-code modules
+vendored next to them, so loading needs no hub lookups and no conversion. On a single
+device the shards are mmapped straight onto it.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.generation.utils import GenerationConfig
+
+SNAPSHOT_MARKER = "zhinao_snapshot.json"
+
+
+class StartupTimer:
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        yield
+        self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.phases)
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        print(f"startup: {phases}, total {total:.2f}s", flush=True)
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_MARKER))
+
+
+def _remote_code_dir(model_name_or_path):
+    if os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_name_or_path, allow_patterns=["*.py"])
+
+
+def create_snapshot(model_name_or_path, output_dir, torch_dtype="bfloat16", max_shard_size="2GB"):
+    timer = StartupTimer()
+    with timer.phase("load"):
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name_or_path,
+            torch_dtype=getattr(torch, torch_dtype),
+            low_cpu_mem_usage=True,
+            trust_remote_code=True
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=False, trust_remote_code=True)
+        generation_config = GenerationConfig.from_pretrained(model_name_or_path)
+
+    with timer.phase("save"):
+        os.makedirs(output_dir, exist_ok=True)
+        model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+        tokenizer.save_pretrained(output_dir)
+        generation_config.save_pretrained(output_dir)
+        # vendor the remote code so loading never has to resolve it from the hub
+        for filename in glob.glob(os.path.join(_remote_code_dir(model_name_or_path), "*.py")):
+            shutil.copy(filename, output_dir)
+        with open(os.path.join(output_dir, SNAPSHOT_MARKER), "w") as f:
+            json.dump({"source": model_name_or_path, "torch_dtype": torch_dtype, "created": int(time.time())}, f, indent=2)
+    timer.report()
+
+
+def _default_device():
+    if torch.cuda.is_available():
+        return torch.device("cuda", 0)
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def _load_snapshot_weights(path, torch_dtype, device):
+    from accelerate import init_empty_weights
+    from accelerate.utils import set_module_tensor_to_device
+    from safetensors import safe_open
+
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    # parameters stay on the meta device until their tensor is read from the shard
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype, trust_remote_code=True)
+
+    for filename in sorted(glob.glob(os.path.join(path, "*.safetensors"))):
+        with safe_open(filename, framework="pt", device=str(device)) as f:
+            for name in f.keys():
+                set_module_tensor_to_device(model, name, device, value=f.get_tensor(name))
+
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise RuntimeError(f"snapshot {path} is missing weights: {missing[:5]}")
+    # buffers such as rotary frequencies were created on the CPU
+    return model.to(device).eval()
+
+
+def load_model_tokenizer(model_name_or_path):
+    timer = StartupTimer()
+    snapshot = is_snapshot(model_name_or_path)
+
+    with timer.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=False, trust_remote_code=True)
+
+    with timer.phase("weights"):
+        if snapshot and torch.cuda.device_count() <= 1:
+            with open(os.path.join(model_name_or_path, SNAPSHOT_MARKER)) as f:
+                torch_dtype = getattr(torch, json.load(f)["torch_dtype"])
+            model = _load_snapshot_weights(model_name_or_path, torch_dtype, _default_device())
+        else:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name_or_path,
+                device_map="auto",
+                torch_dtype="auto" if snapshot else None,
+                trust_remote_code=True
+            )
+
+    with timer.phase("generation_config"):
+        generation_config = GenerationConfig.from_pretrained(model_name_or_path)
+
+    timer.report()
+    return model, tokenizer, generation_config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a fast-loading local snapshot of a 360Zhinao model.")
+    parser.add_argument("model_name_or_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--torch-dtype", default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--max-shard-size", default="2GB")
+    args = parser.parse_args()
+
+    if is_snapshot(args.output_dir):
+        print(f"{args.output_dir} already holds a snapshot", file=sys.stderr)
+        sys.exit(1)
+    create_snapshot(args.model_name_or_path, args.output_dir, args.torch_dtype, args.max_shard_size)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts at the root and the files under vllm/ are plain modules, not a package
+for path in (ROOT, os.path.join(ROOT, "vllm")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,322 @@
+"""Minimal CPU stand-ins for the vLLM modules the files under vllm/ import.
+
+Only what the tests exercise is real: the parallel layers have single-GPU
+shapes and weight loaders, the OpenAI protocol models have vLLM 0.4's fields,
+and everything else is an empty shell. `install()` registers the modules in
+sys.modules, replacing any installed vLLM.
+"""
+import logging
+import sys
+import types
+import uuid
+from typing import List, Optional
+
+import torch
+from pydantic import BaseModel, Field
+from torch import nn
+from torch.nn import Parameter
+
+
+def _set_weight_attrs(weight, attrs):
+    for key, value in attrs.items():
+        setattr(weight, key, value)
+
+
+def default_weight_loader(param, loaded_weight):
+    assert param.size() == loaded_weight.size(), (param.size(), loaded_weight.size())
+    param.data.copy_(loaded_weight)
+
+
+class _Linear(nn.Module):
+
+    # vLLM < 0.4.2 passes `linear_method`, later releases `quant_config`
+    def __init__(self, input_size, output_size, bias=True, linear_method=None, quant_config=None):
+        super().__init__()
+        self.weight = Parameter(torch.empty(output_size, input_size), requires_grad=False)
+        _set_weight_attrs(self.weight, {"input_dim": 1, "output_dim": 0, "weight_loader": self.weight_loader})
+        if bias:
+            self.bias = Parameter(torch.empty(output_size), requires_grad=False)
+            _set_weight_attrs(self.bias, {"output_dim": 0, "weight_loader": self.weight_loader})
+        else:
+            self.register_parameter("bias", None)
+
+    def weight_loader(self, param, loaded_weight, loaded_shard_id=None):
+        default_weight_loader(param, loaded_weight)
+
+
+class RowParallelLinear(_Linear):
+    pass
+
+
+class MergedColumnParallelLinear(_Linear):
+
+    def __init__(self, input_size, output_sizes, bias=True, linear_method=None, quant_config=None):
+        self.output_sizes = output_sizes
+        super().__init__(input_size, sum(output_sizes), bias)
+
+    def weight_loader(self, param, loaded_weight, loaded_shard_id=None):
+        if loaded_shard_id is None:
+            return default_weight_loader(param, loaded_weight)
+        offset = sum(self.output_sizes[:loaded_shard_id])
+        default_weight_loader(param.data.narrow(0, offset, self.output_sizes[loaded_shard_id]), loaded_weight)
+
+
+class QKVParallelLinear(_Linear):
+
+    def __init__(self, hidden_size, head_size, total_num_heads, total_num_kv_heads=None, bias=True,
+                 linear_method=None, quant_config=None):
+        total_num_kv_heads = total_num_kv_heads or total_num_heads
+        super().__init__(hidden_size, (total_num_heads + 2 * total_num_kv_heads) * head_size, bias)
+
+
+class VocabParallelEmbedding(nn.Module):
+
+    def __init__(self, num_embeddings, embedding_dim, org_num_embeddings=None, padding_size=64):
+        super().__init__()
+        padded = (num_embeddings + padding_size - 1) // padding_size * padding_size
+        self.weight = Parameter(torch.zeros(padded, embedding_dim), requires_grad=False)
+        _set_weight_attrs(self.weight, {"weight_loader": self.weight_loader})
+
+    def weight_loader(self, param, loaded_weight):
+        param.data[:loaded_weight.shape[0]].copy_(loaded_weight)
+
+
+class ParallelLMHead(VocabParallelEmbedding):
+
+    def __init__(self, num_embeddings, embedding_dim, bias=False, org_num_embeddings=None, padding_size=64):
+        super().__init__(num_embeddings, embedding_dim, org_num_embeddings, padding_size)
+
+
+class RMSNorm(nn.Module):
+
+    def __init__(self, hidden_size, eps=1e-6):
+        super().__init__()
+        self.weight = Parameter(torch.ones(hidden_size), requires_grad=False)
+
+
+class _Shell(nn.Module):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+
+class SiluAndMul(_Shell):
+    pass
+
+
+class Sampler(_Shell):
+    pass
+
+
+class LogitsProcessor(_Shell):
+    pass
+
+
+class Attention(_Shell):
+
+    def forward(self, query, key, value, kv_cache, attn_metadata):
+        raise NotImplementedError
+
+
+def get_rope(*args, **kwargs):
+    return _Shell()
+
+
+class _Empty:
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    module.__path__ = []
+    return module
+
+
+# checkpoint tensors yielded by the weight iterators of vLLM <= 0.4.0
+CHECKPOINTS = {}
+
+
+def hf_model_weights_iterator(model_name_or_path, cache_dir=None, load_format="auto", revision=None):
+    yield from CHECKPOINTS[model_name_or_path].items()
+
+
+def prepare_hf_model_weights(model_name_or_path, cache_dir=None, load_format="auto", revision=None):
+    return model_name_or_path, [], False
+
+
+class CompletionOutput:
+
+    def __init__(self, index, text, token_ids, cumulative_logprob=0.0, logprobs=None, finish_reason=None):
+        self.index = index
+        self.text = text
+        self.token_ids = token_ids
+        self.cumulative_logprob = cumulative_logprob
+        self.logprobs = logprobs
+        self.finish_reason = finish_reason
+
+
+class RequestOutput:
+
+    def __init__(self, request_id, prompt, prompt_token_ids, prompt_logprobs, outputs, finished):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+        self.prompt_logprobs = prompt_logprobs
+        self.outputs = outputs
+        self.finished = finished
+
+
+class OpenAIServing:
+
+    def __init__(self, engine, served_model, lora_modules=None):
+        self.engine = engine
+        self.served_model = served_model
+        self.lora_requests = []
+        self.tokenizer = _Empty(chat_template=None)
+
+    def create_error_response(self, message, err_type="BadRequestError", status_code=400):
+        return ErrorResponse(message=message, type=err_type, code=status_code)
+
+
+async def get_guided_decoding_logits_processor(request, tokenizer):
+    return None
+
+
+# vLLM 0.4's OpenAI protocol, the fields serving_chat.py sets
+class ErrorResponse(BaseModel):
+    object: str = "error"
+    message: str
+    type: str
+    param: Optional[str] = None
+    code: int
+
+
+class UsageInfo(BaseModel):
+    prompt_tokens: int = 0
+    total_tokens: int = 0
+    completion_tokens: Optional[int] = 0
+
+
+class ChatCompletionRequest(BaseModel):
+    model: str
+    messages: List[dict]
+    n: Optional[int] = 1
+    best_of: Optional[int] = None
+    stream: Optional[bool] = False
+    echo: Optional[bool] = False
+    logprobs: Optional[bool] = False
+    add_generation_prompt: Optional[bool] = True
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatCompletionResponseChoice(BaseModel):
+    index: int
+    message: ChatMessage
+    logprobs: Optional[dict] = None
+    finish_reason: Optional[str] = None
+
+
+class ChatCompletionResponse(BaseModel):
+    id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex}")
+    object: str = "chat.completion"
+    created: int = 0
+    model: str
+    choices: List[ChatCompletionResponseChoice]
+    usage: UsageInfo
+
+
+class DeltaMessage(BaseModel):
+    role: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ChatCompletionResponseStreamChoice(BaseModel):
+    index: int
+    delta: DeltaMessage
+    logprobs: Optional[dict] = None
+    finish_reason: Optional[str] = None
+
+
+class ChatCompletionStreamResponse(BaseModel):
+    id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex}")
+    object: str = "chat.completion.chunk"
+    created: int = 0
+    model: str
+    choices: List[ChatCompletionResponseStreamChoice]
+    usage: Optional[UsageInfo] = Field(default=None)
+
+
+PROTOCOL = [
+    "ErrorResponse", "UsageInfo", "ChatCompletionRequest", "ChatMessage", "ChatCompletionResponseChoice",
+    "ChatCompletionResponse", "DeltaMessage", "ChatCompletionResponseStreamChoice", "ChatCompletionStreamResponse",
+]
+
+
+def _parallel_state():
+    return dict(get_tensor_model_parallel_rank=lambda: 0, get_tensor_model_parallel_world_size=lambda: 1)
+
+
+def modules():
+    weight_utils = dict(default_weight_loader=default_weight_loader, kv_cache_scales_loader=None,
+                        hf_model_weights_iterator=hf_model_weights_iterator,
+                        prepare_hf_model_weights=prepare_hf_model_weights)
+    return {
+        "vllm": dict(__fake__=True, EngineArgs=_Empty, LLMEngine=_Empty, SamplingParams=_Empty),
+        "vllm.attention": dict(Attention=Attention, AttentionMetadata=_Empty),
+        "vllm.config": dict(LoRAConfig=_Empty),
+        "vllm.engine": {},
+        "vllm.engine.async_llm_engine": dict(AsyncLLMEngine=_Empty),
+        "vllm.entrypoints": {},
+        "vllm.entrypoints.openai": {},
+        "vllm.entrypoints.openai.protocol": {name: globals()[name] for name in PROTOCOL},
+        "vllm.entrypoints.openai.serving_engine": dict(OpenAIServing=OpenAIServing, LoRA=_Empty),
+        "vllm.distributed": _parallel_state(),
+        "vllm.logger": dict(init_logger=logging.getLogger),
+        "vllm.model_executor": {},
+        "vllm.model_executor.guided_decoding": dict(
+            get_guided_decoding_logits_processor=get_guided_decoding_logits_processor),
+        "vllm.model_executor.layers": {},
+        "vllm.model_executor.layers.activation": dict(SiluAndMul=SiluAndMul),
+        "vllm.model_executor.layers.layernorm": dict(RMSNorm=RMSNorm),
+        "vllm.model_executor.layers.linear": dict(LinearMethodBase=_Empty,
+                                                  MergedColumnParallelLinear=MergedColumnParallelLinear,
+                                                  QKVParallelLinear=QKVParallelLinear,
+                                                  RowParallelLinear=RowParallelLinear),
+        "vllm.model_executor.layers.logits_processor": dict(LogitsProcessor=LogitsProcessor),
+        "vllm.model_executor.layers.quantization": {},
+        "vllm.model_executor.layers.quantization.base_config": dict(QuantizationConfig=_Empty),
+        "vllm.model_executor.layers.rotary_embedding": dict(get_rope=get_rope),
+        "vllm.model_executor.layers.sampler": dict(Sampler=Sampler),
+        "vllm.model_executor.layers.vocab_parallel_embedding": dict(DEFAULT_VOCAB_PADDING_SIZE=64,
+                                                                    ParallelLMHead=ParallelLMHead,
+                                                                    VocabParallelEmbedding=VocabParallelEmbedding),
+        "vllm.model_executor.model_loader": {},
+        "vllm.model_executor.model_loader.weight_utils": weight_utils,
+        "vllm.model_executor.parallel_utils": {},
+        "vllm.model_executor.parallel_utils.parallel_state": _parallel_state(),
+        "vllm.model_executor.sampling_metadata": dict(SamplingMetadata=_Empty),
+        "vllm.model_executor.weight_utils": weight_utils,
+        "vllm.outputs": dict(CompletionOutput=CompletionOutput, RequestOutput=RequestOutput),
+        "vllm.sequence": dict(SamplerOutput=_Empty),
+        "vllm.utils": dict(is_hip=lambda: False, random_uuid=lambda: uuid.uuid4().hex),
+    }
+
+
+def install():
+    if getattr(sys.modules.get("vllm"), "__fake__", False):
+        return
+    for name, attrs in modules().items():
+        sys.modules[name] = _module(name, **attrs)
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, sys.modules[name])
+    # deployed next to serving_chat.py
+    import zhinao_pot
+    sys.modules["vllm.entrypoints.openai.zhinao_pot"] = zhinao_pot
@@ -0,0 +1,97 @@
+"""chat_engine's AdmissionController and BatchScheduler queue handling, without a model."""
+import threading
+import time
+
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+from transformers import GenerationConfig  # noqa: E402
+
+from chat_engine import AdmissionController, BatchScheduler, GenerationJob, SchedulerStats  # noqa: E402
+
+CONFIG = GenerationConfig(max_new_tokens=16, eos_token_id=2)
+
+
+class SlowScheduler:
+    """Enqueues after a pause, so concurrent requests overlap between the check and the enqueue."""
+
+    def __init__(self):
+        self.stats = SchedulerStats()
+
+    def submit(self, input_ids, generation_config=None, stream=False):
+        time.sleep(0.01)
+        job = GenerationJob(input_ids, generation_config, stream=stream)
+        job.work = len(input_ids)
+        self.stats.on_submit(job)
+        return job
+
+
+def test_burst_respects_max_queue_depth():
+    admission = AdmissionController(SlowScheduler(), max_queue_depth=4)
+    results = []
+
+    def request():
+        results.append(admission.submit([1, 2, 3], CONFIG))
+
+    threads = [threading.Thread(target=request) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(job is not None for job, _ in results) == 4
+    assert [rejection[0] for _, rejection in results if rejection is not None] == [503] * 16
+    assert admission.admitted == 4 and admission.rejected_queue_full == 16
+
+
+def test_explicit_deadline_is_not_replaced_by_the_default():
+    scheduler = SlowScheduler()
+    scheduler.stats.tokens_per_second = 100.0
+    admission = AdmissionController(scheduler, default_deadline_s=60)
+    job, rejection = admission.submit([1] * 50, CONFIG, deadline_s=0.1)
+    assert job is None and rejection[0] == 429
+    job, rejection = admission.submit([1] * 50, CONFIG)
+    assert rejection is None and job.deadline_s == 60
+
+
+class Tokenizer:
+    pad_token_id = 0
+    im_end_id = 2
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return " ".join(map(str, token_ids))
+
+
+class BlockingModel:
+    """generate() appends token 7, holding the first batch until released."""
+
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.batches = []
+
+    def generate(self, input_ids, attention_mask, generation_config, streamer, stopping_criteria,
+                 return_dict_in_generate):
+        self.batches.append(input_ids.shape[0])
+        self.release.wait(10)
+        return torch.cat([input_ids, torch.full((input_ids.shape[0], 1), 7)], dim=1)
+
+
+def test_jobs_cancelled_in_the_queue_are_not_run():
+    model = BlockingModel()
+    scheduler = BatchScheduler(model, Tokenizer(), CONFIG, max_batch_size=1)
+    first = scheduler.submit([1, 2])
+    while not model.batches:
+        time.sleep(0.01)
+    queued = scheduler.submit([3, 4])
+    with pytest.raises(TimeoutError):
+        queued.wait(0.05)
+    queued.cancel()
+    model.release.set()
+    assert first.wait(10) == "7"
+    with pytest.raises(RuntimeError, match="cancelled"):
+        queued.wait(10)
+    assert model.batches == [1]
+    assert scheduler.stats.queue_depth == 0 and scheduler.stats.outstanding_tokens == 0
@@ -0,0 +1,93 @@
+"""Runs vllm/batch_infer.py's BatchRunner against a scripted LLMEngine."""
+import argparse
+import asyncio
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("transformers")
+
+import fake_vllm  # noqa: E402
+
+fake_vllm.install()
+import batch_infer  # noqa: E402
+from vllm.outputs import CompletionOutput, RequestOutput  # noqa: E402
+
+
+class Tokenizer:
+    im_start_id = 1
+    im_end_id = 2
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+
+class FakeEngine:
+    """Finishes each request after as many steps as its prompt has characters.
+
+    The outputs carry the indexes vLLM gives the n best of `best_of` candidates.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.model_config = argparse.Namespace(max_model_len=4096)
+        self.running = {}
+        self.steps = 0
+        self.done = threading.Event()
+
+    def get_tokenizer(self):
+        return Tokenizer()
+
+    def add_request(self, request_id, prompt, params, prompt_token_ids=None):
+        text = "".join(map(chr, prompt_token_ids)).split("user\n")[1].split(chr(2))[0]
+        self.running[request_id] = (len(text), prompt_token_ids, text)
+
+    def step(self):
+        self.steps += 1
+        outputs = []
+        for request_id, (steps, prompt_ids, text) in list(self.running.items()):
+            if steps > 1:
+                self.running[request_id] = (steps - 1, prompt_ids, text)
+                continue
+            del self.running[request_id]
+            outputs.append(RequestOutput(request_id, None, prompt_ids, None, [
+                CompletionOutput(index, f"{text} {index}", [0, 0], finish_reason="stop") for index in self.indexes
+            ], True))
+        if not self.running:
+            self.done.set()
+        return outputs
+
+
+def run(tmp_path, texts, engine, no_pot):
+    input_file, output_file = tmp_path / "chats.jsonl", tmp_path / "results.jsonl"
+    input_file.write_text("".join(json.dumps({"id": text, "messages": [{"role": "user", "content": text}]}) + "\n"
+                                  for text in texts))
+    args = argparse.Namespace(input_file=str(input_file), output_file=str(output_file), max_tokens=16, window=100,
+                              max_inflight=100, checkpoint_every=1000, resume=False, no_pot=no_pot)
+    batch_infer.BatchRunner(engine, args).run()
+    return [json.loads(line) for line in output_file.read_text().splitlines()]
+
+
+def test_results_in_input_order_with_choices_numbered_from_zero(tmp_path):
+    texts = ["ccc", "a", "bbbbb", "dd"]
+    results = run(tmp_path, texts, FakeEngine(indexes=[3, 1]), no_pot=True)
+    assert [result["id"] for result in results] == texts
+    assert [result["index"] for result in results] == [0, 1, 2, 3]
+    assert [(c["index"], c["text"]) for c in results[0]["choices"]] == [(0, "ccc 3"), (1, "ccc 1")]
+    assert results[0]["usage"]["completion_tokens"] == 4
+
+
+def test_pot_does_not_hold_up_the_engine(tmp_path, monkeypatch):
+    engine = FakeEngine(indexes=[0])
+
+    async def parse_pot(text, executor):
+        # only returns once the engine has finished every request
+        assert await asyncio.get_running_loop().run_in_executor(None, engine.done.wait, 10)
+        return text.upper()
+
+    monkeypatch.setattr(batch_infer, "parse_pot", parse_pot)
+    texts = ["ab", "abcdef", "abcd"]
+    results = run(tmp_path, texts, engine, no_pot=False)
+    assert [result["choices"][0]["text"] for result in results] == ["AB 0", "ABCDEF 0", "ABCD 0"]
+    assert engine.steps == 6
@@ -0,0 +1,65 @@
+"""bench_serving.send_request against in-process SSE endpoints."""
+import argparse
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from bench_serving import send_request  # noqa: E402
+
+
+def chunk(data):
+    return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def content(text):
+    return chunk({"choices": [{"index": 0, "delta": {"content": text}}]})
+
+
+STREAMS = {
+    "ok": [content("Hel"), content("lo"), b"data: [DONE]\n\n"],
+    # openai_api.py, after a generation failure
+    "openai_api_error": [content("Hel"), chunk({"error": {"message": "CUDA out of memory", "type": "RuntimeError",
+                                                          "code": 500}}), b"data: [DONE]\n\n"],
+    # vLLM's streaming ErrorResponse
+    "vllm_error": [chunk({"object": "error", "message": "engine died", "type": "BadRequestError", "code": 400}),
+                   b"data: [DONE]\n\n"],
+}
+
+
+def send(name):
+
+    async def stream(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for event in STREAMS[name]:
+            await response.write(event)
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", stream)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            args = argparse.Namespace(url=str(server.make_url("/v1/chat/completions")), stream=True)
+            return await send_request(session, args, {"messages": [], "stream": True})
+
+    return asyncio.run(main())
+
+
+def test_stream_counts_chunks():
+    result = send("ok")
+    assert result.ok and result.error is None
+    assert result.text == "Hello" and result.chunks == 2
+
+
+@pytest.mark.parametrize("name, message", [("openai_api_error", "CUDA out of memory"), ("vllm_error", "engine died")])
+def test_error_event_fails_the_request(name, message):
+    result = send(name)
+    assert not result.ok
+    assert message in result.error
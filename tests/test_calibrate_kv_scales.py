@@ -0,0 +1,30 @@
+"""Calibration prompts of vllm/calibrate_kv_scales.py."""
+import json
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from calibrate_kv_scales import load_calibration_set  # noqa: E402
+from chat_engine import make_chat_input_ids  # noqa: E402
+
+
+class Tokenizer:
+    im_start_id = 1
+    im_end_id = 2
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+
+def test_conversations_use_the_serving_layout(tmp_path):
+    conversations = [{"from": "user", "value": "1 + 1 = ?"}, {"from": "assistant", "value": "2"}]
+    path = tmp_path / "calibration.jsonl"
+    path.write_text(json.dumps({"conversations": conversations}) + "\n" + json.dumps({"text": "plain"}) + "\n")
+    tokenizer = Tokenizer()
+    samples = load_calibration_set(str(path), tokenizer, max_samples=10, max_length=1000)
+    assert samples == [
+        make_chat_input_ids(tokenizer, [{"role": "user", "content": "1 + 1 = ?"}, {"role": "assistant", "content": "2"}]),
+        tokenizer.encode("plain"),
+    ]
+    assert load_calibration_set(str(path), tokenizer, max_samples=1, max_length=5) == [samples[0][:5]]
@@ -0,0 +1,62 @@
+import asyncio
+import random
+
+import pytest
+
+from zhinao_pot import POT_ERROR_MESSAGE, IncrementalPoTParser, eval_pot_span, parse_pot_no_stream
+
+
+class InlineExecutor:
+    """PoTExecutor stand-in that evaluates spans in-process."""
+
+    async def evaluate(self, k):
+        return eval_pot_span(k)
+
+
+# sympy-free spans; variables are used after their span, as PoT answers are written
+TEXTS = [
+    "No spans here, just a < and a > and a <b> tag.",
+    "Each box holds <<per_box = 3 * 4>>per_box apples, so 5 boxes hold <<total = per_box * 5>>total apples.",
+    "The cost is <<price = 19.99 + 0.01>>price yuan; a half share is <<half_price = price / 2>>half_price.",
+    "<<side_a, side_b = def func():\n    return 6 * 2, 25 ** 0.5\n>>side_a and side_b, so together <<total_len = side_a + side_b>>total_len.",
+    "Roots: <<r = def func():\n    return math.sqrt(16)\n>>r, then <<q = r ** 2>>q<<w = q - 1>>w.",
+    "Unclosed at the end <<never = 1 +",
+    "Almost a span < <not = 1>> and <<ok_value = 7 - 2>>ok_value< trailing",
+    "Multi-byte 中文 <<n = 2 ** 10>>n 个，结束。",
+]
+
+
+def chunkings(text, rng, count):
+    yield [text]
+    yield list(text)
+    for _ in range(count):
+        cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(1, 12))))
+        yield [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+async def stream(chunks):
+    parser = IncrementalPoTParser(InlineExecutor())
+    text = ""
+    out = []
+    for chunk in chunks:
+        text += chunk
+        out.append(await parser.feed(text))
+    out.append(await parser.feed(text, final=True))
+    return "".join(out)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_stream_matches_no_stream(text):
+    expected = parse_pot_no_stream(text)
+    rng = random.Random(text)
+    for chunks in chunkings(text, rng, 200):
+        assert asyncio.run(stream(chunks)) == expected, chunks
+
+
+def test_failed_span_reports_once():
+    # the text before the span is already sent, so it stays; the rest is dropped
+    text = "Done <<four = 2 + 2>>four, then it fails <<bad = 1 / 0>>bad and <<x = 1>>x."
+    assert parse_pot_no_stream(text) == POT_ERROR_MESSAGE
+    rng = random.Random(text)
+    for chunks in chunkings(text, rng, 200):
+        assert asyncio.run(stream(chunks)) == "Done 4, then it fails " + POT_ERROR_MESSAGE, chunks
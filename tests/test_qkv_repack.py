@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+import fake_vllm
+
+fake_vllm.install()
+import zhinao  # noqa: E402
+from convert_qkv import repack_qkv  # noqa: E402
+
+NUM_HEADS, NUM_KV_HEADS, HEAD_DIM, HIDDEN = 8, 2, 3, 5
+
+
+def interleaved_qkv(inner=()):
+    """(q, k, v, the HF layout): per kv head its query heads, then k, then v."""
+    q = torch.randn(NUM_HEADS, HEAD_DIM, *inner)
+    k = torch.randn(NUM_KV_HEADS, HEAD_DIM, *inner)
+    v = torch.randn(NUM_KV_HEADS, HEAD_DIM, *inner)
+    group = NUM_HEADS // NUM_KV_HEADS
+    blocks = []
+    for g in range(NUM_KV_HEADS):
+        blocks += [q[g * group:(g + 1) * group], k[g:g + 1], v[g:g + 1]]
+    flat = lambda t: t.reshape(-1, *inner)  # noqa: E731
+    return flat(q), flat(k), flat(v), flat(torch.cat(blocks))
+
+
+def check(repacked, q, k, v, output_dim):
+    q_size, kv_size = NUM_HEADS * HEAD_DIM, NUM_KV_HEADS * HEAD_DIM
+    wq, wk, wv = repacked.split([q_size, kv_size, kv_size], dim=output_dim)
+    torch.testing.assert_close(wq, q.movedim(0, output_dim), rtol=0, atol=0)
+    torch.testing.assert_close(wk, k.movedim(0, output_dim), rtol=0, atol=0)
+    torch.testing.assert_close(wv, v.movedim(0, output_dim), rtol=0, atol=0)
+
+
+REPACKS = {
+    "zhinao": lambda w, dim: zhinao._repack_qkv(w, NUM_HEADS, NUM_KV_HEADS, dim),
+    "convert_qkv": lambda w, dim: repack_qkv(w, NUM_HEADS, NUM_KV_HEADS, dim),
+}
+
+
+@pytest.mark.parametrize("repack", REPACKS.values(), ids=REPACKS.keys())
+def test_weight(repack):
+    q, k, v, weight = interleaved_qkv((HIDDEN,))
+    check(repack(weight, 0), q, k, v, 0)
+
+
+@pytest.mark.parametrize("repack", REPACKS.values(), ids=REPACKS.keys())
+def test_bias(repack):
+    q, k, v, bias = interleaved_qkv()
+    check(repack(bias, 0), q, k, v, 0)
+
+
+@pytest.mark.parametrize("repack", REPACKS.values(), ids=REPACKS.keys())
+def test_output_dim_1(repack):
+    # quantized layers store their output dim second, e.g. GPTQ scales
+    q, k, v, weight = interleaved_qkv((HIDDEN,))
+    check(repack(weight.t().contiguous(), 1), q, k, v, 1)
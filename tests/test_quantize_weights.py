@@ -0,0 +1,70 @@
+"""vllm/quantize_weights.py's export, read back the way --check does."""
+import json
+
+import pytest
+import torch
+from safetensors.torch import save_file
+from torch import nn
+
+from quantize_weights import _dequantized_state_dict, export, load_export
+
+NUM_HEADS, NUM_KV_HEADS, HEAD_DIM, HIDDEN, INTERMEDIATE = 4, 2, 8, 32, 64
+BITS, GROUP_SIZE = 4, 16
+
+
+def make_checkpoint(path, **config):
+    torch.manual_seed(0)
+    prefix = "model.layers.0"
+    tensors = {
+        "model.embed_tokens.weight": torch.randn(100, HIDDEN),
+        f"{prefix}.self_attn.qkv_proj.weight": torch.randn((NUM_HEADS + 2 * NUM_KV_HEADS) * HEAD_DIM, HIDDEN),
+        f"{prefix}.self_attn.o_proj.weight": torch.randn(HIDDEN, NUM_HEADS * HEAD_DIM),
+        f"{prefix}.mlp.gate_proj.weight": torch.randn(INTERMEDIATE, HIDDEN),
+        f"{prefix}.mlp.up_proj.weight": torch.randn(INTERMEDIATE, HIDDEN),
+        f"{prefix}.mlp.down_proj.weight": torch.randn(HIDDEN, INTERMEDIATE),
+        f"{prefix}.input_layernorm.weight": torch.ones(HIDDEN),
+    }
+    path.mkdir()
+    save_file(tensors, str(path / "model.safetensors"))
+    (path / "config.json").write_text(json.dumps(dict(
+        num_attention_heads=NUM_HEADS, num_key_value_heads=NUM_KV_HEADS, **config)))
+    (path / "tokenizer.model").write_text("vocab")
+    return tensors
+
+
+def test_export_reads_back_within_half_a_step(tmp_path):
+    tensors = make_checkpoint(tmp_path / "model")
+    export(str(tmp_path / "model"), str(tmp_path / "w4"), BITS, GROUP_SIZE)
+    config = json.loads((tmp_path / "w4" / "config.json").read_text())
+    assert config["quantization_config"]["bits"] == BITS and config["qkv_prepacked"]
+    assert (tmp_path / "w4" / "tokenizer.model").read_text() == "vocab"
+
+    state_dict = _dequantized_state_dict(str(tmp_path / "w4"), BITS, NUM_HEADS, NUM_KV_HEADS)
+    assert state_dict.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        if name.endswith("proj.weight"):
+            # symmetric round-to-nearest, the step is 2 * absmax / 15 per group of input channels
+            step = tensor.reshape(tensor.shape[0], -1, GROUP_SIZE).abs().amax(-1) * 2 / (2 ** BITS - 1)
+            error = (state_dict[name] - tensor).abs().reshape(step.shape + (GROUP_SIZE,))
+            assert (error <= step[..., None] / 2 + 1e-2).all(), name
+        else:
+            torch.testing.assert_close(state_dict[name], tensor.half().float())
+
+
+@pytest.mark.parametrize("config", [dict(qkv_prepacked=True), dict(quantization_config={"quant_method": "gptq"})])
+def test_export_refuses_converted_checkpoints(tmp_path, config):
+    make_checkpoint(tmp_path / "model", **config)
+    with pytest.raises(ValueError):
+        export(str(tmp_path / "model"), str(tmp_path / "w4"), BITS, GROUP_SIZE)
+    assert not (tmp_path / "w4").exists()
+
+
+def test_load_export_needs_every_parameter():
+    model = nn.Linear(2, 2)
+    # persistent buffers such as rotary inv_freq are not exported
+    model.register_buffer("inv_freq", torch.ones(1))
+    load_export(model, {"weight": torch.zeros(2, 2), "bias": torch.zeros(2)}, "w4")
+    with pytest.raises(RuntimeError, match="missing.*bias"):
+        load_export(model, {"weight": torch.zeros(2, 2)}, "w4")
+    with pytest.raises(RuntimeError, match="Unexpected"):
+        load_export(model, {"weight": torch.zeros(2, 2), "bias": torch.zeros(2), "scale": torch.ones(1)}, "w4")
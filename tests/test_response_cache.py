@@ -0,0 +1,70 @@
+"""The disk tier of response_cache.ResponseCache."""
+import os
+import time
+
+from response_cache import ResponseCache
+
+
+def cache_files(path):
+    return sorted(name for _, _, names in os.walk(path) for name in names)
+
+
+def test_disk_entries_survive_a_restart(tmp_path):
+    ResponseCache(cache_dir=str(tmp_path)).put("ab12", "hello")
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    assert cache.get("ab12") == "hello"
+    assert cache.disk_hits == 1
+
+
+def test_write_errors_do_not_fail_the_request(tmp_path, monkeypatch):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+
+    def replace(src, dst):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(os, "replace", replace)
+    cache.put("ab12", "hello")
+    assert cache.get("ab12") == "hello"
+    assert cache_files(tmp_path) == []
+    assert cache.disk_bytes == 0
+
+
+def test_unwritable_directory(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    # a file where the key's subdirectory should be
+    (tmp_path / "ab").write_text("")
+    cache.put("ab12", "hello")
+    assert cache.get("ab12") == "hello"
+
+
+def test_expired_files_are_deleted(tmp_path):
+    # too small to keep anything in memory, so every get() reads the disk
+    cache = ResponseCache(max_bytes=1, ttl=60, cache_dir=str(tmp_path))
+    cache.put("ab12", "hello")
+    assert cache.get("ab12") == "hello"
+    cache.ttl = -1
+    assert cache.get("ab12") is None
+    assert cache_files(tmp_path) == []
+    assert cache.disk_bytes == 0
+
+
+def test_expired_files_are_deleted_on_start(tmp_path):
+    ResponseCache(cache_dir=str(tmp_path)).put("ab12", "hello")
+    path = tmp_path / "ab" / "ab12.json"
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    cache = ResponseCache(ttl=60, cache_dir=str(tmp_path))
+    assert cache_files(tmp_path) == []
+    assert cache.disk_bytes == 0
+
+
+def test_disk_size_is_bounded(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path), disk_max_bytes=250)
+    for key in ("aa01", "bb02", "cc03"):
+        cache.put(key, "x" * 50)
+    # each file is about 100 bytes, the oldest one went
+    assert cache_files(tmp_path) == ["bb02.json", "cc03.json"]
+    assert cache.disk_bytes == sum(os.path.getsize(tmp_path / key[:2] / f"{key}.json") for key in ("bb02", "cc03"))
+    # a restart keeps the bound
+    cache = ResponseCache(cache_dir=str(tmp_path), disk_max_bytes=120)
+    assert cache_files(tmp_path) == ["cc03.json"]
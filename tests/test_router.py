@@ -0,0 +1,108 @@
+"""router.py against an in-process backend that checks the api key like vLLM's --api-key."""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from router import Backend, Router  # noqa: E402
+
+API_KEY = "sk-test"
+
+
+def make_backend_app(seen):
+
+    @web.middleware
+    async def check_key(request, handler):
+        if request.headers.get("Authorization") != f"Bearer {API_KEY}":
+            return web.json_response({"error": "Unauthorized"}, status=401)
+        return await handler(request)
+
+    async def models(request):
+        return web.json_response({"data": [{"id": "zhinao", "max_model_len": 4096}]})
+
+    async def chat(request):
+        data = await request.json()
+        seen.append((request.headers.copy(), data))
+        if data["messages"][0]["content"] == "drop":
+            # promise a longer body than is sent, then close the connection
+            response = web.StreamResponse(headers={"Content-Type": "application/json", "Content-Length": "1000"})
+            await response.prepare(request)
+            await response.write(b'{"choices": [')
+            request.transport.close()
+            return response
+        return web.json_response({"choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}}]})
+
+    app = web.Application(middlewares=[check_key])
+    app.router.add_get("/v1/models", models)
+    app.router.add_post("/v1/chat/completions", chat)
+    return app
+
+
+def run(scenario, backend_api_key=API_KEY):
+    seen = []
+
+    async def main():
+        async with TestServer(make_backend_app(seen)) as backend:
+            router = Router([Backend(str(backend.make_url("")))], backend_api_key=backend_api_key)
+            async with TestClient(TestServer(router.make_app())) as client:
+                return await scenario(client, router)
+
+    return asyncio.run(main()), seen
+
+
+def test_forwards_client_headers():
+
+    async def scenario(client, router):
+        response = await client.post("/v1/chat/completions", headers={
+            "Authorization": f"Bearer {API_KEY}", "X-Request-Id": "abc", "Connection": "keep-alive, X-Hop",
+            "X-Hop": "1"}, json={"messages": [{"role": "user", "content": "hello"}], "max_tokens": 16})
+        return router.backends[0].healthy, response.status, await response.json()
+
+    (healthy, status, body), seen = run(scenario)
+    assert healthy
+    assert status == 200 and body["choices"][0]["message"]["content"] == "hi"
+    [(headers, data)] = seen
+    assert headers["Authorization"] == f"Bearer {API_KEY}"
+    assert headers["X-Request-Id"] == "abc"
+    assert "X-Hop" not in headers
+    assert data["model"] == "zhinao"
+
+
+def test_backend_rejects_requests_without_the_key():
+
+    async def scenario(client, router):
+        response = await client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "hi"}]})
+        return response.status
+
+    status, seen = run(scenario)
+    assert status == 401 and not seen
+
+
+@pytest.mark.parametrize("max_tokens", ["16", 1.5, [16], -1, True])
+def test_rejects_invalid_max_tokens(max_tokens):
+
+    async def scenario(client, router):
+        response = await client.post("/v1/chat/completions", headers={"Authorization": f"Bearer {API_KEY}"},
+                                     json={"messages": [{"role": "user", "content": "hi"}], "max_tokens": max_tokens})
+        return response.status, await response.json()
+
+    (status, body), seen = run(scenario)
+    assert status == 400 and body["status_code"] == 400 and "max_tokens" in body["msg"]
+    assert not seen
+
+
+def test_backend_dropping_mid_body_is_a_502():
+
+    async def scenario(client, router):
+        response = await client.post("/v1/chat/completions", headers={"Authorization": f"Bearer {API_KEY}"},
+                                     json={"messages": [{"role": "user", "content": "drop"}]})
+        return response.status, await response.json(), router.backends[0]
+
+    (status, body, backend), seen = run(scenario)
+    assert status == 502 and body["status_code"] == 502
+    assert len(seen) == 1
+    assert not backend.healthy and backend.failures == 1
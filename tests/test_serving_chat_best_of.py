@@ -0,0 +1,141 @@
+"""Replays engine outputs through serving_chat.py to check how n and best_of shape the choices."""
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("prometheus_client")
+
+import fake_vllm  # noqa: E402
+
+fake_vllm.install()
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest  # noqa: E402
+from vllm.outputs import CompletionOutput, RequestOutput  # noqa: E402
+from serving_chat import OpenAIServingChat  # noqa: E402
+
+PROMPT_IDS = [1, 2, 3]
+
+
+class FakeEngine:
+    """AsyncLLMEngine stand-in whose generate() replays a fixed list of steps.
+
+    Each step maps output index -> (text, finish_reason) for the sequences the
+    engine reports at that step; token ids are one per character.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.aborted = []
+
+    async def generate(self, prompt, sampling_params, request_id, prompt_token_ids=None, lora_request=None):
+        for step, outputs in enumerate(self.steps):
+            finished = step == len(self.steps) - 1
+            yield RequestOutput(request_id, prompt, PROMPT_IDS, None, [
+                CompletionOutput(index, text, list(range(len(text))), finish_reason=finish_reason)
+                for index, (text, finish_reason) in outputs.items()
+            ], finished)
+            await asyncio.sleep(0)
+
+    async def abort(self, request_id):
+        self.aborted.append(request_id)
+
+
+class RawRequest:
+
+    async def is_disconnected(self):
+        return False
+
+
+def make_request(n, best_of=None, stream=False):
+    return ChatCompletionRequest(model="zhinao", messages=[{"role": "user", "content": "hi"}], n=n,
+                                 best_of=best_of, stream=stream)
+
+
+def replay_stream(engine, request):
+    serving = OpenAIServingChat(engine, "zhinao", "assistant")
+
+    async def collect():
+        stream = serving.chat_completion_stream_generator(request, engine.generate(None, None, "cmpl-1"), "cmpl-1",
+                                                          RawRequest())
+        return [chunk async for chunk in stream]
+
+    chunks = asyncio.run(collect())
+    assert chunks[-1] == "data: [DONE]\n\n"
+    return [json.loads(chunk[len("data: "):]) for chunk in chunks[:-1]]
+
+
+def replay_full(engine, request):
+    serving = OpenAIServingChat(engine, "zhinao", "assistant")
+    return asyncio.run(serving.chat_completion_full_generator(request, RawRequest(),
+                                                              engine.generate(None, None, "cmpl-1"), "cmpl-1"))
+
+
+def content_by_index(events):
+    texts, finish = {}, {}
+    for event in events:
+        for choice in event["choices"]:
+            texts[choice["index"]] = texts.get(choice["index"], "") + (choice["delta"].get("content") or "")
+            if choice.get("finish_reason"):
+                assert choice["index"] not in finish
+                finish[choice["index"]] = choice["finish_reason"]
+    return texts, finish
+
+
+def test_stream_n_without_best_of_streams_each_choice():
+    engine = FakeEngine([
+        {0: ("Hel", None), 1: ("Good", None)},
+        {0: ("Hello", None), 1: ("Good day", None)},
+        {0: ("Hello!", "stop"), 1: ("Good day.", "length")},
+    ])
+    events = replay_stream(engine, make_request(n=2, stream=True))
+    texts, finish = content_by_index(events)
+    assert texts == {0: "Hello!", 1: "Good day."}
+    assert finish == {0: "stop", 1: "length"}
+    # content arrived before the end
+    assert any(choice["delta"].get("content") == "Hel" for event in events for choice in event["choices"])
+
+
+def test_stream_best_of_is_sent_at_the_end():
+    # the engine reports all best_of candidates while running, then only the n best
+    engine = FakeEngine([
+        {0: ("A", None), 1: ("B", None), 2: ("C", None)},
+        {0: ("Ab", None), 1: ("Bc", None), 2: ("Cd", None)},
+        {2: ("Cde", "stop")},
+    ])
+    events = replay_stream(engine, make_request(n=1, best_of=3, stream=True))
+    role_events, content_events = events[:1], events[1:]
+    assert [choice["delta"] for event in role_events for choice in event["choices"]] == [{"role": "assistant"}]
+    # one chunk, for choice 0, carrying the whole text
+    assert len(content_events) == 1
+    [choice] = content_events[0]["choices"]
+    assert choice["index"] == 0
+    assert choice["delta"]["content"] == "Cde"
+    assert choice["finish_reason"] == "stop"
+    assert content_events[0]["usage"]["completion_tokens"] == 3
+
+
+def test_stream_best_of_numbers_choices_from_zero():
+    engine = FakeEngine([
+        {i: ("x" * i, None) for i in range(4)},
+        {3: ("three", "stop"), 1: ("one", "length")},
+    ])
+    texts, finish = content_by_index(replay_stream(engine, make_request(n=2, best_of=4, stream=True)))
+    assert texts == {0: "three", 1: "one"}
+    assert finish == {0: "stop", 1: "length"}
+
+
+def test_full_best_of_numbers_choices_from_zero():
+    engine = FakeEngine([
+        {0: ("a", None), 1: ("b", None), 2: ("c", None)},
+        {2: ("chosen", "stop")},
+    ])
+    response = replay_full(engine, make_request(n=1, best_of=3))
+    assert [(c.index, c.message.content, c.finish_reason) for c in response.choices] == [(0, "chosen", "stop")]
+    assert response.usage.completion_tokens == len("chosen")
+
+
+def test_full_n_keeps_engine_indexes():
+    engine = FakeEngine([{0: ("first", "stop"), 1: ("second", "stop")}])
+    response = replay_full(engine, make_request(n=2))
+    assert [(c.index, c.message.content) for c in response.choices] == [(0, "first"), (1, "second")]
@@ -0,0 +1,165 @@
+"""The merged vllm/zhinao.py loads weights exactly like the per-release files it replaced.
+
+zhinao_040.py, zhinao_041.py and zhinao_042.py were deleted when they were
+merged; their sources are read back from git history.
+"""
+import os
+import subprocess
+import types
+
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import PretrainedConfig
+
+import fake_vllm
+
+fake_vllm.install()
+import zhinao  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEGACY_FILES = ["vllm/zhinao_040.py", "vllm/zhinao_041.py", "vllm/zhinao_042.py"]
+
+
+def git(*args):
+    return subprocess.run(["git", *args], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+
+
+def load_legacy(path):
+    try:
+        deleted_in = git("log", "--diff-filter=D", "--format=%H", "-1", "--", path).strip()
+        source = git("show", f"{deleted_in}^:{path}")
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("needs a git checkout with the history of vllm/")
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = types.ModuleType(name)
+    module.__file__ = path
+    exec(compile(source, path, "exec"), module.__dict__)
+    return module
+
+
+def make_config(**kwargs):
+    # the old files repacked qkv with num_kv_heads == num_heads, as in the released checkpoints;
+    # pad_token_id is set explicitly, transformers 5 no longer gives every config one
+    return PretrainedConfig(hidden_size=16, num_attention_heads=4, num_key_value_heads=4, intermediate_size=24,
+                            num_hidden_layers=2, vocab_size=100, rms_norm_eps=1e-6, hidden_act="silu",
+                            max_position_embeddings=64, pad_token_id=None, **kwargs)
+
+
+def random_checkpoint(model):
+    """A checkpoint with HF names for every parameter of `model`."""
+    torch.manual_seed(0)
+    checkpoint = {}
+    for name, param in model.named_parameters():
+        if "embed_tokens" in name or "lm_head" in name:
+            checkpoint[name] = torch.randn(model.config.vocab_size, param.shape[1])
+        elif "gate_up_proj" in name:
+            gate, up = torch.randn(param.shape).chunk(2)
+            checkpoint[name.replace("gate_up_proj", "gate_proj")] = gate
+            checkpoint[name.replace("gate_up_proj", "up_proj")] = up
+        else:
+            checkpoint[name] = torch.randn(param.shape)
+    # skipped by every loader
+    checkpoint["model.layers.0.self_attn.rotary_emb.inv_freq"] = torch.randn(4)
+    return checkpoint
+
+
+def loaded_params(module, config, checkpoint):
+    model = module.ZhinaoForCausalLM(config)
+    model.load_weights(iter(checkpoint.items()))
+    return dict(model.named_parameters())
+
+
+@pytest.mark.parametrize("prepacked", [False, True], ids=["interleaved", "prepacked"])
+@pytest.mark.parametrize("legacy_file", LEGACY_FILES)
+def test_load_weights_parity(legacy_file, prepacked, monkeypatch):
+    monkeypatch.setenv("ZHINAO_LOAD_THREADS", "0")
+    legacy = load_legacy(legacy_file)
+    config = make_config(qkv_prepacked=prepacked)
+    checkpoint = random_checkpoint(zhinao.ZhinaoForCausalLM(config))
+
+    expected = loaded_params(legacy, config, checkpoint)
+    actual = loaded_params(zhinao, config, checkpoint)
+    assert actual.keys() == expected.keys()
+    for name in expected:
+        torch.testing.assert_close(actual[name], expected[name], rtol=0, atol=0, msg=name)
+
+
+def test_load_weights_from_path(monkeypatch):
+    # vLLM <= 0.4.0 hands load_weights the checkpoint location instead of tensors
+    monkeypatch.setenv("ZHINAO_LOAD_THREADS", "0")
+    config = make_config()
+    checkpoint = random_checkpoint(zhinao.ZhinaoForCausalLM(config))
+    monkeypatch.setitem(fake_vllm.CHECKPOINTS, "/models/zhinao", checkpoint)
+
+    expected = loaded_params(load_legacy(LEGACY_FILES[0]), config, checkpoint)
+    model = zhinao.ZhinaoForCausalLM(config)
+    model.load_weights("/models/zhinao")
+    for name, param in model.named_parameters():
+        torch.testing.assert_close(param, expected[name], rtol=0, atol=0, msg=name)
+
+
+def safetensors_weights_iterator(hf_weights_files):
+    # named like vLLM >= 0.4.2's, whose files load_weights reads in parallel
+    for path in hf_weights_files:
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+
+
+def pt_weights_iterator(hf_weights_files):
+    for path in hf_weights_files:
+        yield from torch.load(path).items()
+
+
+def write_shards(directory, checkpoint, suffix):
+    directory.mkdir()
+    names = sorted(checkpoint)
+    paths = []
+    for i, shard in enumerate([names[::2], names[1::2]]):
+        path = str(directory / f"model-{i}{suffix}")
+        tensors = {name: checkpoint[name].clone().contiguous() for name in shard}
+        if suffix == ".safetensors":
+            save_file(tensors, path)
+        else:
+            torch.save(tensors, path)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("iterator, suffix, parallel", [
+    (safetensors_weights_iterator, ".safetensors", True),
+    (pt_weights_iterator, ".bin", False),
+], ids=["safetensors", "pt"])
+def test_load_weights_reads_the_files_vllm_chose(tmp_path, monkeypatch, iterator, suffix, parallel):
+    monkeypatch.setenv("ZHINAO_LOAD_THREADS", "2")
+    calls = []
+    parallel_weights_iterator = zhinao._parallel_weights_iterator
+    monkeypatch.setattr(zhinao, "_parallel_weights_iterator",
+                        lambda files, num_threads: calls.append(files) or parallel_weights_iterator(files, num_threads))
+    # _name_or_path holds other weights, e.g. a different revision than vLLM downloaded
+    config = make_config()
+    other = random_checkpoint(zhinao.ZhinaoForCausalLM(config))
+    other = {name: tensor + 1 for name, tensor in other.items()}
+    config._name_or_path = str(tmp_path / "name_or_path")
+    write_shards(tmp_path / "name_or_path", other, ".safetensors")
+    checkpoint = random_checkpoint(zhinao.ZhinaoForCausalLM(config))
+    paths = write_shards(tmp_path / "download_dir", checkpoint, suffix)
+
+    expected = loaded_params(zhinao, config, checkpoint)
+    model = zhinao.ZhinaoForCausalLM(config)
+    model.load_weights(iterator(paths))
+    assert calls == ([paths] if parallel else [])
+    for name, param in model.named_parameters():
+        torch.testing.assert_close(param, expected[name], rtol=0, atol=0, msg=name)
+
+
+def test_started_iterators_are_consumed_as_given(tmp_path):
+    checkpoint = {"a": torch.zeros(1), "b": torch.ones(1)}
+    paths = write_shards(tmp_path / "model", checkpoint, ".safetensors")
+    weights = safetensors_weights_iterator(paths)
+    assert zhinao._iterator_safetensors_files(weights) == paths
+    next(weights)
+    assert zhinao._iterator_safetensors_files(weights) == []
+    assert zhinao._iterator_safetensors_files(iter(checkpoint.items())) == []
@@ -0,0 +1,299 @@
+"""Offline batch chat inference over a JSONL file with the vLLM engine.
+
+Every input line is a chat request in the OpenAI format, at least
+``{"messages": [{"role": ..., "content": ...}]}``; ``max_tokens``, ``n``,
+``temperature``, ``top_p``, ``top_k``, ``stop``, the penalties and ``seed``
+are honoured, and ``id``/``custom_id`` is copied to the result:
+
+    python vllm/batch_infer.py chats.jsonl results.jsonl \\
+        --model qihoo360/360Zhinao-7B-Chat-4K --trust-remote-code \\
+        --max-model-len 4096
+
+The input is read as a stream, a window of lines at a time. Each window is
+sorted by prompt length, longest first, and fed to the engine so that it
+always has ``--max-inflight`` requests to batch, without an HTTP server in
+between. Results are written in input order, one line per input line (with
+an ``"error"`` instead of ``"choices"`` for a line that cannot be served).
+
+Progress is checkpointed to ``<output>.progress`` every
+``--checkpoint-every`` lines; ``--resume`` truncates the output to the last
+checkpoint and continues from the next input line.
+
+Prompts are laid out by chat_engine.make_chat_input_ids, like the
+transformers servers do, and the program-of-thought spans of every choice are
+evaluated by the sandboxed workers of zhinao_pot.py, like the vLLM api server
+does; ``--no-pot`` writes the generated text as is.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from vllm import EngineArgs, LLMEngine, SamplingParams
+from zhinao_pot import PoTExecutor, parse_pot
+
+# chat_engine.py lives in the repository root, next to finetune.py.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chat_engine import make_chat_input_ids  # noqa: E402
+
+SAMPLING_KEYS = ("n", "best_of", "temperature", "top_p", "top_k",
+                 "presence_penalty", "frequency_penalty",
+                 "repetition_penalty", "seed")
+
+
+def read_lines(path: str, skip: int) -> Iterator[Tuple[int, str]]:
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(islice(f, skip, None), start=skip):
+            yield index, line
+
+
+def make_sampling_params(record: dict, prompt_len: int, max_model_len: int,
+                         default_max_tokens: int,
+                         stop_token_ids: List[int]) -> SamplingParams:
+    room = max_model_len - prompt_len
+    if room <= 0:
+        raise ValueError(f"prompt has {prompt_len} tokens, the maximum "
+                         f"context length is {max_model_len}")
+    stop = record.get("stop") or []
+    if isinstance(stop, str):
+        stop = [stop]
+    kwargs = {key: record[key] for key in SAMPLING_KEYS if key in record}
+    return SamplingParams(max_tokens=min(
+        record.get("max_tokens") or default_max_tokens, room),
+                          stop=list(stop),
+                          stop_token_ids=stop_token_ids,
+                          **kwargs)
+
+
+class ProgressFile:
+    """Number of input lines done and the output size they take up."""
+
+    def __init__(self, output_file: str):
+        self.path = output_file + ".progress"
+
+    def load(self) -> Tuple[int, int]:
+        try:
+            with open(self.path) as f:
+                progress = json.load(f)
+        except FileNotFoundError:
+            return 0, 0
+        return progress["completed"], progress["offset"]
+
+    def save(self, completed: int, offset: int) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"completed": completed, "offset": offset}, f)
+        os.replace(tmp_path, self.path)
+
+
+class BatchRunner:
+
+    def __init__(self, engine: LLMEngine, args: argparse.Namespace):
+        self.engine = engine
+        self.tokenizer = engine.get_tokenizer()
+        self.max_model_len = engine.model_config.max_model_len
+        # Special tokens are not detokenized, so stop on their ids.
+        self.stop_token_ids = [
+            self.tokenizer.im_end_id, self.tokenizer.im_start_id
+        ]
+        self.args = args
+        # PoT spans are evaluated on an event loop in another thread, so
+        # engine.step() keeps running while the workers catch up.
+        self.pot_executor = None if args.no_pot else PoTExecutor()
+        self.pot_loop = asyncio.new_event_loop()
+        self.pot_thread = threading.Thread(target=self.pot_loop.run_forever,
+                                           daemon=True)
+        self.pot_thread.start()
+        # Finished lines, as result lines to come, waiting for the ones
+        # before them.
+        self.results: Dict[int, Future] = {}
+        self.records: Dict[int, dict] = {}
+        self.num_prompt_tokens = 0
+        self.num_generated_tokens = 0
+
+    def _prepare(self, window: List[Tuple[int, str]]) -> List[tuple]:
+        """Tokenize a window of lines, sorted so that pop() is the longest."""
+        requests = []
+        for index, line in window:
+            record = None
+            try:
+                record = json.loads(line)
+                prompt_ids = make_chat_input_ids(self.tokenizer,
+                                                 record["messages"])
+                params = make_sampling_params(record, len(prompt_ids),
+                                              self.max_model_len,
+                                              self.args.max_tokens,
+                                              self.stop_token_ids)
+            except Exception as e:
+                self._finish(index, record, error=f"{type(e).__name__}: {e}")
+                continue
+            self.records[index] = record
+            requests.append((len(prompt_ids), index, prompt_ids, params))
+        requests.sort(key=lambda request: request[:2])
+        return requests
+
+    async def _parse_pot(self, result: dict) -> str:
+        texts = await asyncio.gather(*(parse_pot(choice["text"],
+                                                 self.pot_executor)
+                                       for choice in result["choices"]))
+        for choice, text in zip(result["choices"], texts):
+            choice["text"] = text
+        return json.dumps(result, ensure_ascii=False) + "\n"
+
+    def _finish(self, index: int, record: Optional[dict], output=None,
+                error: Optional[str] = None) -> None:
+        result = {"index": index}
+        if isinstance(record, dict):
+            for key in ("id", "custom_id"):
+                if key in record:
+                    result[key] = record[key]
+        if error is not None:
+            result["error"] = error
+        else:
+            num_prompt_tokens = len(output.prompt_token_ids)
+            num_generated_tokens = sum(
+                len(choice.token_ids) for choice in output.outputs)
+            self.num_prompt_tokens += num_prompt_tokens
+            self.num_generated_tokens += num_generated_tokens
+            # With best_of > n the engine's indexes run up to best_of.
+            result["choices"] = [{
+                "index": i,
+                "text": choice.text,
+                "finish_reason": choice.finish_reason,
+            } for i, choice in enumerate(output.outputs)]
+            result["usage"] = {
+                "prompt_tokens": num_prompt_tokens,
+                "completion_tokens": num_generated_tokens,
+                "total_tokens": num_prompt_tokens + num_generated_tokens,
+            }
+        if error is None and self.pot_executor is not None:
+            self.results[index] = asyncio.run_coroutine_threadsafe(
+                self._parse_pot(result), self.pot_loop)
+        else:
+            self.results[index] = Future()
+            self.results[index].set_result(
+                json.dumps(result, ensure_ascii=False) + "\n")
+
+    def run(self) -> None:
+        args = self.args
+        progress = ProgressFile(args.output_file)
+        completed, offset = progress.load() if args.resume else (0, 0)
+        if args.resume and os.path.exists(args.output_file):
+            # Drop whatever was written after the last checkpoint.
+            with open(args.output_file, "r+b") as f:
+                f.truncate(offset)
+        out = open(args.output_file, "a" if args.resume else "w",
+                   encoding="utf-8")
+        if not args.resume:
+            progress.save(0, 0)
+        if completed:
+            print(f"resuming after {completed} lines")
+
+        lines = read_lines(args.input_file, completed)
+        next_index = read_index = completed
+        start_index, start = completed, time.monotonic()
+        pending: List[tuple] = []
+        num_inflight = 0
+        exhausted = False
+        while True:
+            # A slow request holds back every result after it, so stop
+            # reading once the reorder buffer spans two windows.
+            while (num_inflight < args.max_inflight
+                   and (pending or not exhausted)):
+                if not pending:
+                    if read_index - next_index >= 2 * args.window:
+                        break
+                    window = list(islice(lines, args.window))
+                    if not window:
+                        exhausted = True
+                        break
+                    read_index = window[-1][0] + 1
+                    pending = self._prepare(window)
+                    continue
+                _, index, prompt_ids, params = pending.pop()
+                self.engine.add_request(str(index),
+                                        None,
+                                        params,
+                                        prompt_token_ids=prompt_ids)
+                num_inflight += 1
+
+            if num_inflight:
+                for output in self.engine.step():
+                    if output.finished:
+                        index = int(output.request_id)
+                        self._finish(index, self.records.pop(index), output)
+                        num_inflight -= 1
+
+            while next_index in self.results:
+                if num_inflight and not self.results[next_index].done():
+                    # Wait for PoT only once the engine has nothing to do.
+                    break
+                out.write(self.results.pop(next_index).result())
+                next_index += 1
+                if next_index % args.checkpoint_every == 0:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    progress.save(next_index, out.tell())
+                    elapsed = time.monotonic() - start
+                    print(f"{next_index} lines done, "
+                          f"{(next_index - start_index) / elapsed:.1f} "
+                          f"lines/s, {self.num_generated_tokens / elapsed:.0f}"
+                          f" generated tokens/s")
+
+            if exhausted and not num_inflight and not pending:
+                break
+
+        out.flush()
+        os.fsync(out.fileno())
+        progress.save(next_index, out.tell())
+        out.close()
+        if self.pot_executor is not None:
+            asyncio.run_coroutine_threadsafe(self.pot_executor.close(),
+                                             self.pot_loop).result()
+        self.pot_loop.call_soon_threadsafe(self.pot_loop.stop)
+        self.pot_thread.join()
+        self.pot_loop.close()
+        elapsed = time.monotonic() - start
+        print(f"processed {next_index - start_index} lines in {elapsed:.1f}s: "
+              f"{self.num_prompt_tokens} prompt tokens, "
+              f"{self.num_generated_tokens} generated tokens "
+              f"({self.num_generated_tokens / elapsed:.0f} tokens/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run chat requests from a JSONL file through the vLLM "
+        "engine and write the results in input order.")
+    parser.add_argument("input_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--max-tokens",
+                        type=int,
+                        default=512,
+                        help="default max_tokens of lines that set none")
+    parser.add_argument("--window",
+                        type=int,
+                        default=10000,
+                        help="input lines read and sorted by prompt length "
+                        "at a time")
+    parser.add_argument("--max-inflight",
+                        type=int,
+                        default=1024,
+                        help="requests kept in the engine for batching")
+    parser.add_argument("--checkpoint-every", type=int, default=1000)
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="continue from <output_file>.progress")
+    parser.add_argument("--no-pot",
+                        action="store_true",
+                        help="write the generated text without evaluating "
+                        "its <<...>> program-of-thought spans")
+    parser = EngineArgs.add_cli_args(parser)
+    args = parser.parse_args()
+    engine = LLMEngine.from_engine_args(EngineArgs.from_cli_args(args))
+    BatchRunner(engine, args).run()
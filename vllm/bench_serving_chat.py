@@ -0,0 +1,84 @@
+"""Microbenchmark of the per-token SSE chunk serialization in serving_chat.py.
+
+Compares building ChatCompletionStreamResponse objects and calling
+model_dump_json, which the stream generator did for every token, with the
+StreamChunkTemplate fast path, and checks both produce the same bytes.
+
+    python vllm/bench_serving_chat.py --num-chunks 200000
+
+Needs the vLLM install serving_chat.py is deployed into.
+"""
+import argparse
+import random
+import time
+
+from vllm.entrypoints.openai.protocol import (
+    ChatCompletionResponseStreamChoice, ChatCompletionStreamResponse,
+    DeltaMessage)
+
+from serving_chat import StreamChunkTemplate
+
+SAMPLE_DELTAS = [
+    "The", " answer", " is", " 42", ".", "\n", "你好", "，", "世界", "\"",
+    "\\", "\t", " <", "<", "😀", "",
+]
+
+
+def pydantic_chunk(request_id: str, created: int, model_name: str,
+                   index: int, text: str) -> str:
+    choice_data = ChatCompletionResponseStreamChoice(
+        index=index,
+        delta=DeltaMessage(content=text),
+        logprobs=None,
+        finish_reason=None)
+    chunk = ChatCompletionStreamResponse(id=request_id,
+                                         object="chat.completion.chunk",
+                                         created=created,
+                                         choices=[choice_data],
+                                         model=model_name)
+    data = chunk.model_dump_json(exclude_unset=True)
+    return f"data: {data}\n\n"
+
+
+def main(args: argparse.Namespace):
+    random.seed(0)
+    request_id = "cmpl-0123456789abcdef0123456789abcdef"
+    created = int(time.monotonic())
+    deltas = [(random.randrange(args.n), random.choice(SAMPLE_DELTAS))
+              for _ in range(args.num_chunks)]
+    template = StreamChunkTemplate(request_id, created, args.model)
+
+    for index, text in deltas[:10000]:
+        expected = pydantic_chunk(request_id, created, args.model, index, text)
+        actual = template.content(index, text)
+        if expected != actual:
+            raise AssertionError(f"chunk mismatch:\n{expected!r}\n{actual!r}")
+
+    start = time.perf_counter()
+    for index, text in deltas:
+        pydantic_chunk(request_id, created, args.model, index, text)
+    pydantic_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index, text in deltas:
+        template.content(index, text)
+    template_seconds = time.perf_counter() - start
+
+    for name, seconds in (("pydantic", pydantic_seconds),
+                          ("template", template_seconds)):
+        print(f"{name:>9}: {seconds * 1e6 / args.num_chunks:.2f} us/chunk "
+              f"({args.num_chunks / seconds:.0f} chunks/s)")
+    print(f"speedup: {pydantic_seconds / template_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark SSE chunk serialization of chat streaming.")
+    parser.add_argument("--num-chunks", type=int, default=100000)
+    parser.add_argument("--n",
+                        type=int,
+                        default=1,
+                        help="number of choices the chunks are spread over")
+    parser.add_argument("--model", type=str, default="360Zhinao-7B-Chat-4K")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,253 @@
+"""Calibrate per-layer FP8 KV cache scaling factors for Zhinao checkpoints.
+
+Runs a calibration set through the HF model, records the absolute maximum of
+the keys and values every layer writes to the KV cache and stores
+``scale = amax / 448`` (the float8_e4m3fn maximum) in the JSON format
+ZhinaoForCausalLM.load_kv_cache_scales reads:
+
+    python vllm/calibrate_kv_scales.py /path/to/360Zhinao-7B-Chat-4K \\
+        data/calibration.json kv_cache_scales.json --tp-size 2
+
+    python -m vllm.entrypoints.openai.api_server ... --kv-cache-dtype fp8 \\
+        --quantization-param-path kv_cache_scales.json
+
+The calibration file uses the finetune data format (a JSON list, or JSON
+lines, of ``{"conversations": [{"from": ..., "value": ...}]}``); records with
+a ``"text"`` field are tokenized as plain text. The tensor parallel size has
+to match the one used for serving, since each rank gets the scale of the kv
+heads it holds. After calibration a second pass over the same data reports
+the error FP8 quantization with these scales would cause in every layer.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from typing import Dict, List
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+# chat_engine.py lives in the repository root, next to finetune.py.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chat_engine import make_chat_input_ids  # noqa: E402
+
+FP8_E4M3_MAX = 448.0
+
+
+def load_calibration_set(path: str, tokenizer, max_samples: int,
+                         max_length: int) -> List[List[int]]:
+    with open(path, encoding="utf-8") as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        records = json.loads(content)
+    else:
+        records = [json.loads(line) for line in content.splitlines() if line]
+
+    samples = []
+    for record in records[:max_samples]:
+        if "text" in record:
+            input_ids = tokenizer.encode(record["text"])
+        else:
+            # The prompt layout of serving, so the cached keys and values
+            # look like the ones seen there.
+            input_ids = make_chat_input_ids(tokenizer, [{
+                "role": message["from"],
+                "content": message["value"]
+            } for message in record["conversations"]])
+        if input_ids:
+            samples.append(input_ids[:max_length])
+    if not samples:
+        raise ValueError(f"No calibration samples found in {path}")
+    return samples
+
+
+def _split_kv(qkv: torch.Tensor, num_heads: int, num_kv_heads: int):
+    # HF Zhinao checkpoints interleave qkv_proj per kv head as
+    # [q heads..., k, v]. Returns keys and values as (tokens, kv_heads, dim).
+    num_query_heads_per_kv_head = num_heads // num_kv_heads
+    qkv = qkv.reshape(-1, num_kv_heads, num_query_heads_per_kv_head + 2,
+                      qkv.shape[-1] //
+                      (num_kv_heads * (num_query_heads_per_kv_head + 2)))
+    k = qkv[:, :, num_query_heads_per_kv_head].float()
+    v = qkv[:, :, num_query_heads_per_kv_head + 1].float()
+    return k, v
+
+
+def _rotary_bound(k: torch.Tensor) -> torch.Tensor:
+    # The cache holds keys after the rotary embedding, which rotates the
+    # element pairs (i, i + dim / 2). Any rotation of a pair stays within its
+    # norm, so the pair norm bounds the rotated values at every position.
+    half = k.shape[-1] // 2
+    pair_norm = torch.sqrt(k[..., :half]**2 + k[..., half:]**2)
+    return torch.cat([pair_norm, pair_norm], dim=-1)
+
+
+def _fp8_round_trip(x: torch.Tensor, scale: float) -> torch.Tensor:
+    # vLLM's convention: quantized_value * scaling_factor ~= true_value.
+    quantized = (x / scale).clamp(-FP8_E4M3_MAX, FP8_E4M3_MAX)
+    return quantized.to(torch.float8_e4m3fn).float() * scale
+
+
+class KVCacheObserver:
+    """Forward hooks on every layer's qkv_proj that track K/V statistics."""
+
+    def __init__(self, model, num_heads: int, num_kv_heads: int):
+        self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads
+        self.k_amax: Dict[int, torch.Tensor] = {}
+        self.v_amax: Dict[int, torch.Tensor] = {}
+        self.scales = None
+        self.errors: Dict[int, Dict[str, float]] = {}
+        self.handles = []
+        for name, module in model.named_modules():
+            match = re.search(r"layers\.(\d+)\.self_attn\.qkv_proj$", name)
+            if match:
+                self.handles.append(
+                    module.register_forward_hook(
+                        self._hook(int(match.group(1)))))
+        if not self.handles:
+            raise ValueError("Model has no layers.*.self_attn.qkv_proj")
+
+    def _hook(self, layer_idx: int):
+
+        def hook(module, inputs, output):
+            k, v = _split_kv(output, self.num_heads, self.num_kv_heads)
+            if self.scales is None:
+                self._observe(layer_idx, _rotary_bound(k), v)
+            else:
+                # Measured on the keys before the rotary embedding, which
+                # share their pair norms with the cached ones.
+                self._measure(layer_idx, k, v)
+
+        return hook
+
+    def _observe(self, layer_idx: int, k: torch.Tensor, v: torch.Tensor):
+        # Per kv head, so the amax can be split across tensor parallel ranks.
+        k_amax = k.abs().amax(dim=(0, 2)).cpu()
+        v_amax = v.abs().amax(dim=(0, 2)).cpu()
+        if layer_idx in self.k_amax:
+            k_amax = torch.maximum(self.k_amax[layer_idx], k_amax)
+            v_amax = torch.maximum(self.v_amax[layer_idx], v_amax)
+        self.k_amax[layer_idx] = k_amax
+        self.v_amax[layer_idx] = v_amax
+
+    def _measure(self, layer_idx: int, k: torch.Tensor, v: torch.Tensor):
+        scale = self.scales[layer_idx]
+        errors = self.errors.setdefault(layer_idx, {
+            "k_err": 0.0,
+            "k_norm": 0.0,
+            "v_err": 0.0,
+            "v_norm": 0.0,
+        })
+        for prefix, x in (("k", k), ("v", v)):
+            errors[f"{prefix}_err"] += (
+                (_fp8_round_trip(x, scale) - x)**2).sum().item()
+            errors[f"{prefix}_norm"] += (x**2).sum().item()
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def rank_kv_heads(tp_rank: int, tp_size: int, num_kv_heads: int) -> List[int]:
+    """The kv heads QKVParallelLinear places on a tensor parallel rank."""
+    if num_kv_heads >= tp_size:
+        per_rank = num_kv_heads // tp_size
+        return list(range(tp_rank * per_rank, (tp_rank + 1) * per_rank))
+    # Fewer kv heads than ranks: every head is replicated on several ranks.
+    return [tp_rank * num_kv_heads // tp_size]
+
+
+@torch.no_grad()
+def _run(model, samples: List[List[int]]):
+    for input_ids in samples:
+        model(input_ids=torch.tensor([input_ids], device=model.device))
+
+
+def calibrate(model_dir: str, calibration_file: str, output_file: str,
+              tp_size: int, max_samples: int, max_length: int,
+              device: str) -> None:
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", num_heads)
+    if num_kv_heads % tp_size != 0 and tp_size % num_kv_heads != 0:
+        raise ValueError(f"{num_kv_heads} kv heads cannot be split across "
+                         f"{tp_size} tensor parallel ranks")
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir,
+                                              use_fast=False,
+                                              trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_dir,
+        torch_dtype=torch.float32 if device == "cpu" else "auto",
+        trust_remote_code=True).to(device).eval()
+    samples = load_calibration_set(calibration_file, tokenizer, max_samples,
+                                   max_length)
+
+    observer = KVCacheObserver(model, num_heads, num_kv_heads)
+    _run(model, samples)
+
+    num_layers = config.num_hidden_layers
+    scaling_factor = {}
+    for tp_rank in range(tp_size):
+        heads = rank_kv_heads(tp_rank, tp_size, num_kv_heads)
+        scaling_factor[tp_rank] = {
+            layer_idx:
+            max(observer.k_amax[layer_idx][heads].max().item(),
+                observer.v_amax[layer_idx][heads].max().item(), 1e-6) /
+            FP8_E4M3_MAX
+            for layer_idx in range(num_layers)
+        }
+    with open(output_file, "w") as f:
+        json.dump(
+            {
+                "model_type": config.model_type,
+                "kv_cache": {
+                    "dtype": "float8_e4m3fn",
+                    "scaling_factor": scaling_factor,
+                },
+            },
+            f,
+            indent=2)
+    print(f"wrote scales for {num_layers} layers and {tp_size} tensor "
+          f"parallel rank(s) to {output_file}")
+
+    # The report uses a single scale per layer, the largest over all ranks,
+    # which is what a tp_size=1 deployment would get.
+    observer.scales = {
+        layer_idx: max(scaling_factor[tp_rank][layer_idx]
+                       for tp_rank in range(tp_size))
+        for layer_idx in range(num_layers)
+    }
+    _run(model, samples)
+    observer.remove()
+
+    print(f"{'layer':>5} {'k_amax':>10} {'v_amax':>10} {'scale':>10} "
+          f"{'k_rel_err':>10} {'v_rel_err':>10}")
+    for layer_idx in range(num_layers):
+        errors = observer.errors[layer_idx]
+        k_rel = (errors["k_err"] / max(errors["k_norm"], 1e-12))**0.5
+        v_rel = (errors["v_err"] / max(errors["v_norm"], 1e-12))**0.5
+        print(f"{layer_idx:>5} "
+              f"{observer.k_amax[layer_idx].max().item():>10.4f} "
+              f"{observer.v_amax[layer_idx].max().item():>10.4f} "
+              f"{observer.scales[layer_idx]:>10.6f} "
+              f"{k_rel:>10.5f} {v_rel:>10.5f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate FP8 KV cache scaling factors for a Zhinao "
+        "checkpoint.")
+    parser.add_argument("model_dir")
+    parser.add_argument("calibration_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--tp-size", type=int, default=1)
+    parser.add_argument("--max-samples", type=int, default=512)
+    parser.add_argument("--max-length", type=int, default=4096)
+    parser.add_argument("--device",
+                        default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    calibrate(args.model_dir, args.calibration_file, args.output_file,
+              args.tp_size, args.max_samples, args.max_length, args.device)
@@ -0,0 +1,138 @@
+"""Offline repack of Zhinao qkv_proj weights into vLLM's q|k|v layout.
+
+HF Zhinao checkpoints store the fused qkv_proj interleaved per kv head
+([q heads..., k, v] for every kv head), which ZhinaoForCausalLM.load_weights
+has to undo on every start-up. This tool does it once, writes safetensors
+shards and sets ``qkv_prepacked`` in the output config so that
+load_weights skips the repack.
+
+    python vllm/convert_qkv.py /path/to/360Zhinao-7B-Chat-4K /path/to/output
+
+The output is meant for vLLM only: the HF remote code still expects the
+interleaved layout. Quantized (GPTQ/AWQ) checkpoints are refused, their
+packed qweight/qzeros/scales are repacked by load_weights instead.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+from typing import Callable, Dict
+
+import torch
+from safetensors.torch import load_file, save_file
+
+
+def repack_qkv(weight: torch.Tensor,
+               num_heads: int,
+               num_kv_heads: int,
+               output_dim: int = 0) -> torch.Tensor:
+    """Turn the per-kv-head [q..., k, v] interleaving into q|k|v."""
+    num_query_heads_per_kv_head = num_heads // num_kv_heads
+    shape = weight.shape
+    weight = weight.view(shape[:output_dim] +
+                         (num_kv_heads, num_query_heads_per_kv_head + 2, -1) +
+                         shape[output_dim + 1:])
+    wq = weight.narrow(output_dim + 1, 0, num_query_heads_per_kv_head).reshape(
+        *shape[:output_dim], -1, *shape[output_dim + 1:])
+    wk = weight.narrow(output_dim + 1, num_query_heads_per_kv_head,
+                       1).reshape(*shape[:output_dim], -1,
+                                  *shape[output_dim + 1:])
+    wv = weight.narrow(output_dim + 1, num_query_heads_per_kv_head + 1,
+                       1).reshape(*shape[:output_dim], -1,
+                                  *shape[output_dim + 1:])
+    return torch.cat([wq, wk, wv], dim=output_dim)
+
+
+def checkpoint_files(model_dir: str):
+    files = sorted(glob.glob(os.path.join(model_dir, "*.safetensors")))
+    if files:
+        return files
+    files = sorted(glob.glob(os.path.join(model_dir, "pytorch_model*.bin")))
+    if not files:
+        raise FileNotFoundError(f"No checkpoint shards found in {model_dir}")
+    return files
+
+
+def load_shard(path: str):
+    if path.endswith(".safetensors"):
+        return load_file(path)
+    # .bin checkpoints may share storage between tensors, which safetensors
+    # refuses to save.
+    state_dict = torch.load(path, map_location="cpu")
+    return {name: tensor.clone() for name, tensor in state_dict.items()}
+
+
+def load_config(model_dir: str) -> dict:
+    """config.json of an unquantized checkpoint in the interleaved layout."""
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    if config.get("qkv_prepacked", False):
+        raise ValueError(f"{model_dir} is already in the q|k|v layout")
+    if "quantization_config" in config:
+        # qweight/qzeros/scales are packed and transposed differently, a
+        # plain dim-0 repack would corrupt them.
+        raise ValueError(f"{model_dir} is a quantized checkpoint, only "
+                         f"unquantized ones can be converted")
+    return config
+
+
+def write_checkpoint(model_dir: str, output_dir: str, config: dict,
+                     transform: Callable[[Dict[str, torch.Tensor]],
+                                         Dict[str, torch.Tensor]],
+                     verb: str) -> None:
+    """Write transform() of every shard as safetensors, with an index if
+    there are several, the model's other files and the given config."""
+    os.makedirs(output_dir, exist_ok=True)
+    shard_files = checkpoint_files(model_dir)
+    weight_map = {}
+    for path in shard_files:
+        tensors = transform(load_shard(path))
+        out_name = os.path.basename(path).replace("pytorch_model", "model")
+        out_name = out_name.replace(".bin", ".safetensors")
+        save_file(tensors, os.path.join(output_dir, out_name),
+                  metadata={"format": "pt"})
+        weight_map.update({name: out_name for name in tensors})
+        print(f"{verb} {os.path.basename(path)} -> {out_name}")
+
+    if len(shard_files) > 1:
+        with open(os.path.join(output_dir, "model.safetensors.index.json"),
+                  "w") as f:
+            json.dump({"metadata": {}, "weight_map": weight_map}, f, indent=2)
+
+    skip = set(shard_files)
+    for path in glob.glob(os.path.join(model_dir, "*")):
+        name = os.path.basename(path)
+        if (path in skip or name.endswith(".index.json")
+                or name == "config.json" or not os.path.isfile(path)):
+            continue
+        shutil.copy(path, output_dir)
+
+    with open(os.path.join(output_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+
+
+def convert(model_dir: str, output_dir: str) -> None:
+    config = load_config(model_dir)
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads", num_heads)
+
+    def transform(tensors):
+        for name, tensor in tensors.items():
+            if "qkv_proj" in name:
+                tensor = repack_qkv(tensor, num_heads, num_kv_heads)
+            tensors[name] = tensor.contiguous()
+        return tensors
+
+    config["qkv_prepacked"] = True
+    write_checkpoint(model_dir, output_dir, config, transform, "converted")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a Zhinao checkpoint with qkv_proj in vLLM's "
+        "q|k|v layout.")
+    parser.add_argument("model_dir")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    convert(args.model_dir, args.output_dir)
@@ -0,0 +1,257 @@
+"""Weight-only int8/int4 export of Zhinao checkpoints in the GPTQ layout.
+
+The linear layers of every decoder layer are quantized per group of input
+channels with symmetric round-to-nearest and written as GPTQ tensors
+(qweight, qzeros, scales, g_idx), which vLLM's gptq quantization loads:
+
+    python vllm/quantize_weights.py /path/to/360Zhinao-7B-Chat-4K \\
+        /path/to/360Zhinao-7B-Chat-4K-w4 --bits 4 --group-size 128
+
+qkv_proj is repacked into vLLM's q|k|v layout before it is quantized, so the
+output is marked ``qkv_prepacked`` and, like convert_qkv.py's output, is
+meant for vLLM only. Everything else is stored in float16, the activation
+dtype vLLM's gptq kernels need. As with convert_qkv.py, whose shard writing
+this reuses, quantized or already repacked checkpoints are refused.
+
+With ``--check`` the exported checkpoint is read back, dequantized on the
+CPU and loaded into the HF model, whose logits on a few prompts are compared
+with the original model's. Use a small model or enough host memory for two
+float32 copies.
+"""
+import argparse
+import glob
+import json
+import os
+from typing import Dict, Tuple
+
+import torch
+from safetensors.torch import load_file
+
+from convert_qkv import load_config, repack_qkv, write_checkpoint
+
+QUANTIZED_LAYERS = ("qkv_proj", "o_proj", "gate_proj", "up_proj",
+                    "down_proj")
+CHECK_PROMPTS = [
+    "The capital of France is",
+    "def fibonacci(n):",
+    "请介绍一下360智脑。",
+]
+
+
+def pack(values: torch.Tensor, bits: int, dim: int) -> torch.Tensor:
+    """Pack 32 // bits unsigned values along `dim` into each int32."""
+    pack_factor = 32 // bits
+    shifts = torch.arange(0, 32, bits, dtype=torch.int64)
+    values = values.to(torch.int64).movedim(dim, -1)
+    packed = (values.unflatten(-1, (-1, pack_factor)) << shifts).sum(dim=-1)
+    packed = torch.where(packed >= 2**31, packed - 2**32, packed)
+    return packed.to(torch.int32).movedim(-1, dim).contiguous()
+
+
+def unpack(packed: torch.Tensor, bits: int, dim: int) -> torch.Tensor:
+    shifts = torch.arange(0, 32, bits, dtype=torch.int64)
+    packed = packed.to(torch.int64).movedim(dim, -1)
+    values = ((packed.unsqueeze(-1) >> shifts) & ((1 << bits) - 1)).flatten(-2)
+    return values.to(torch.int32).movedim(-1, dim)
+
+
+def quantize(weight: torch.Tensor, bits: int,
+             group_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric per-group round-to-nearest of a [out, in] linear weight.
+
+    Returns the unsigned integer weight as [in, out] and the float16 scales
+    as [in / group_size, out]; the zero point is 2 ** (bits - 1). A group
+    size of -1 uses one group per output channel.
+    """
+    w = weight.float().t()
+    in_features, out_features = w.shape
+    if group_size == -1:
+        group_size = in_features
+    if in_features % group_size != 0:
+        raise ValueError(f"{in_features} input features are not a multiple "
+                         f"of group size {group_size}")
+    maxq = 2**bits - 1
+    groups = w.reshape(in_features // group_size, group_size, out_features)
+    scales = (2 * groups.abs().amax(dim=1) / maxq).half()
+    scales[scales == 0] = 1
+    intweight = torch.round(groups / scales.float()[:, None]) + (maxq + 1) // 2
+    intweight = intweight.clamp(0, maxq).to(torch.int32)
+    return intweight.reshape(in_features, out_features), scales
+
+
+def dequantize(qweight: torch.Tensor, qzeros: torch.Tensor,
+               scales: torch.Tensor, g_idx: torch.Tensor,
+               bits: int) -> torch.Tensor:
+    """Reference GPTQ dequantization back to a [out, in] float32 weight."""
+    intweight = unpack(qweight, bits, dim=0)
+    # GPTQ stores zero points minus one.
+    zeros = unpack(qzeros, bits, dim=1) + 1
+    g_idx = g_idx.long()
+    weight = scales.float()[g_idx] * (intweight - zeros[g_idx]).float()
+    return weight.t()
+
+
+def unrepack_qkv(weight: torch.Tensor, num_heads: int, num_kv_heads: int,
+                 output_dim: int) -> torch.Tensor:
+    """Inverse of repack_qkv: q|k|v back to the per-kv-head interleaving."""
+    num_query_heads_per_kv_head = num_heads // num_kv_heads
+    weight = weight.movedim(output_dim, 0)
+    head_dim = weight.shape[0] // (num_heads + 2 * num_kv_heads)
+    q, k, v = weight.split([
+        num_heads * head_dim, num_kv_heads * head_dim, num_kv_heads * head_dim
+    ])
+    q = q.reshape(num_kv_heads, num_query_heads_per_kv_head * head_dim,
+                  *weight.shape[1:])
+    k = k.reshape(num_kv_heads, head_dim, *weight.shape[1:])
+    v = v.reshape(num_kv_heads, head_dim, *weight.shape[1:])
+    weight = torch.cat([q, k, v], dim=1).flatten(0, 1)
+    return weight.movedim(0, output_dim)
+
+
+def _quantize_shard(tensors: Dict[str, torch.Tensor], bits: int,
+                    group_size: int, num_heads: int,
+                    num_kv_heads: int) -> Dict[str, torch.Tensor]:
+    out = {}
+    for name, tensor in tensors.items():
+        prefix, _, suffix = name.rpartition(".")
+        layer = prefix.rpartition(".")[2]
+        if layer in QUANTIZED_LAYERS and suffix == "weight":
+            intweight, scales = quantize(tensor, bits, group_size)
+            zeros = torch.full_like(intweight[:scales.shape[0]],
+                                    2**(bits - 1))
+            if layer == "qkv_proj":
+                # Quantization is per output channel, so repacking the
+                # integer weight and the scales is exact.
+                intweight = repack_qkv(intweight, num_heads, num_kv_heads, 1)
+                scales = repack_qkv(scales, num_heads, num_kv_heads, 1)
+            in_features, num_groups = intweight.shape[0], scales.shape[0]
+            out[f"{prefix}.qweight"] = pack(intweight, bits, dim=0)
+            out[f"{prefix}.qzeros"] = pack(zeros - 1, bits, dim=1)
+            out[f"{prefix}.scales"] = scales.contiguous()
+            out[f"{prefix}.g_idx"] = (torch.arange(in_features) //
+                                      (in_features // num_groups)).to(
+                                          torch.int32)
+            continue
+        if layer == "qkv_proj":
+            tensor = repack_qkv(tensor, num_heads, num_kv_heads)
+        if tensor.is_floating_point():
+            tensor = tensor.half()
+        out[name] = tensor.contiguous()
+    return out
+
+
+def export(model_dir: str, output_dir: str, bits: int,
+           group_size: int) -> None:
+    config = load_config(model_dir)
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads", num_heads)
+
+    quantization_config = {
+        "quant_method": "gptq",
+        "bits": bits,
+        "group_size": group_size,
+        "desc_act": False,
+        "sym": True,
+    }
+    config["quantization_config"] = quantization_config
+    config["torch_dtype"] = "float16"
+    config["qkv_prepacked"] = True
+    write_checkpoint(
+        model_dir, output_dir, config, lambda tensors: _quantize_shard(
+            tensors, bits, group_size, num_heads, num_kv_heads), "quantized")
+    with open(os.path.join(output_dir, "quantize_config.json"), "w") as f:
+        json.dump(quantization_config, f, indent=2)
+
+
+def _dequantized_state_dict(output_dir: str, bits: int, num_heads: int,
+                            num_kv_heads: int) -> Dict[str, torch.Tensor]:
+    tensors = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, "*.safetensors"))):
+        tensors.update(load_file(path))
+    state_dict = {}
+    for name, tensor in tensors.items():
+        prefix, _, suffix = name.rpartition(".")
+        if suffix in ("qzeros", "scales", "g_idx"):
+            continue
+        if suffix == "qweight":
+            tensor = dequantize(tensor, tensors[f"{prefix}.qzeros"],
+                                tensors[f"{prefix}.scales"],
+                                tensors[f"{prefix}.g_idx"], bits)
+            name = f"{prefix}.weight"
+            if prefix.endswith("qkv_proj"):
+                tensor = unrepack_qkv(tensor, num_heads, num_kv_heads, 0)
+        elif prefix.endswith("qkv_proj"):
+            tensor = unrepack_qkv(tensor, num_heads, num_kv_heads, 0)
+        state_dict[name] = tensor.float()
+    return state_dict
+
+
+def load_export(model: torch.nn.Module, state_dict: Dict[str, torch.Tensor],
+                output_dir: str) -> None:
+    """Load the dequantized export, which must cover every parameter."""
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected:
+        raise RuntimeError(f"Unexpected tensors in {output_dir}: "
+                           f"{unexpected[:5]}")
+    # A parameter the export lacks would keep its original weights and make
+    # the comparison pass; non-persistent buffers are not exported.
+    parameters = {name for name, _ in model.named_parameters()}
+    missing = [name for name in missing if name in parameters]
+    if missing:
+        raise RuntimeError(f"Tensors missing from {output_dir}: "
+                           f"{missing[:5]}")
+
+
+@torch.no_grad()
+def check(model_dir: str, output_dir: str, bits: int) -> None:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir,
+                                              use_fast=False,
+                                              trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(model_dir,
+                                                 torch_dtype=torch.float32,
+                                                 trust_remote_code=True).eval()
+    num_heads = model.config.num_attention_heads
+    num_kv_heads = getattr(model.config, "num_key_value_heads", num_heads)
+    inputs = [torch.tensor([tokenizer.encode(p)]) for p in CHECK_PROMPTS]
+    reference = [model(input_ids=input_ids).logits for input_ids in inputs]
+
+    state_dict = _dequantized_state_dict(output_dir, bits, num_heads,
+                                         num_kv_heads)
+    load_export(model, state_dict, output_dir)
+    print(f"{'prompt':>6} {'max_abs':>10} {'mean_abs':>10} {'kl':>10} "
+          f"{'top1':>6}")
+    for i, (input_ids, ref) in enumerate(zip(inputs, reference)):
+        logits = model(input_ids=input_ids).logits[0]
+        ref = ref[0]
+        diff = (logits - ref).abs()
+        kl = torch.nn.functional.kl_div(logits.log_softmax(-1),
+                                        ref.log_softmax(-1),
+                                        log_target=True,
+                                        reduction="batchmean").item()
+        top1 = (logits.argmax(-1) == ref.argmax(-1)).float().mean().item()
+        print(f"{i:>6} {diff.max().item():>10.4f} "
+              f"{diff.mean().item():>10.4f} {kl:>10.5f} {top1:>6.2%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a weight-only int8/int4 GPTQ-layout checkpoint "
+        "of a Zhinao model for vLLM.")
+    parser.add_argument("model_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--bits", type=int, default=4, choices=[4, 8])
+    parser.add_argument("--group-size",
+                        type=int,
+                        default=128,
+                        help="input channels per scale, -1 for one group "
+                        "per output channel")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="compare the logits of the dequantized export "
+                        "with the original model on the CPU")
+    args = parser.parse_args()
+    export(args.model_dir, args.output_dir, args.bits, args.group_size)
+    if args.check:
+        check(args.model_dir, args.output_dir, args.bits)
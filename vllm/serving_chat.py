@@ -1,6 +1,12 @@
+import os
+import json
 import time
 import codecs
+import hashlib
+import asyncio
+from collections import OrderedDict
 from fastapi import Request
+from prometheus_client import Counter, Histogram
 from typing import AsyncGenerator, AsyncIterator, Optional, List, Union
 from vllm.logger import init_logger
 from vllm.utils import random_uuid
@@ -13,73 +19,198 @@ from vllm.entrypoints.openai.protocol import (
 from vllm.outputs import RequestOutput
 from vllm.entrypoints.openai.serving_engine import OpenAIServing, LoRA
 from vllm.model_executor.guided_decoding import get_guided_decoding_logits_processor
+from vllm.entrypoints.openai.zhinao_pot import (IncrementalPoTParser,
+                                                  PoTExecutor, parse_pot)
 
 logger = init_logger(__name__)
 
-from scipy.optimize import minimize
-import sympy
-import re
-import math
-def parse_pot_no_stream(inputs):
+# Exposed on the api server's /metrics next to vLLM's own metrics.
+counter_aborted_streams = Counter(
+    "vllm:chat_stream_aborted",
+    "Streaming chat completions aborted because the client disconnected.")
+counter_aborted_stream_tokens = Counter(
+    "vllm:chat_stream_aborted_generation_tokens",
+    "Tokens generated for streaming chat completions whose client disconnected.")
+counter_prompt_cache_queries = Counter(
+    "vllm:chat_prompt_cache_queries",
+    "Chat messages looked up in the rendered prompt cache.")
+counter_prompt_cache_hits = Counter(
+    "vllm:chat_prompt_cache_hits",
+    "Chat messages whose rendered and tokenized block came from the cache.")
+histogram_prompt_encode_time = Histogram(
+    "vllm:chat_prompt_encode_seconds",
+    "Time spent rendering the chat template and tokenizing a chat prompt.",
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0])
+# How often a stream checks for a disconnect the server has not reported yet.
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+
+class StreamChunkTemplate:
+    """Pre-rendered SSE event for the content-only chunks of one request.
+
+    `content` returns the same bytes as building the chunk's
+    ChatCompletionStreamResponse and calling model_dump_json(exclude_unset=True):
+    one choice with a content delta, no logprobs and no finish reason. Only the
+    index and the delta text are serialized per token.
+    """
+
+    def __init__(self, request_id, created, model_name):
+        self.prefix = (
+            'data: {"id":' + json.dumps(request_id, ensure_ascii=False) +
+            ',"object":"chat.completion.chunk","created":' + str(int(created)) +
+            ',"model":' + json.dumps(model_name, ensure_ascii=False) +
+            ',"choices":[{"index":')
+
+    def content(self, index, text):
+        return (f'{self.prefix}{index},"delta":{{"content":'
+                f'{json.dumps(text, ensure_ascii=False)}}},'
+                f'"logprobs":null,"finish_reason":null}}]}}\n\n')
+
+
+def _special_tokens(tokenizer):
+    tokens = set(getattr(tokenizer, "all_special_tokens", None) or [])
     try:
-        s = re.findall(r'<<(.*?)>>', inputs, re.DOTALL)
-        if not s:
-            #print("err inputs: ", origin_inputs, flush=True)
-            return inputs
+        tokens.update(tokenizer.get_added_vocab())
+    except (AttributeError, NotImplementedError):
+        pass
+    return tuple(token for token in tokens if token)
+
+
+class ChatPromptCache:
+    """LRU cache of rendered and tokenized chat messages shared across requests.
+
+    ChatML-style templates like Zhinao's render a conversation as one block per
+    message, each opening with a special token, followed by the generation
+    prompt. Tokenization cannot merge across a special token, so the prompt's
+    token ids are the concatenation of the blocks' ids. Every block is cached
+    under a hash chained over the messages up to and including it, so requests
+    sharing a system prompt or few-shot turns only render and tokenize the
+    messages after the shared prefix. Blocks are evicted least recently used
+    once the cache holds more than `max_tokens` token ids.
+
+    Whether the template renders message by message is checked once against
+    probe conversations; if it does not, every prompt is rendered and
+    tokenized whole, as before.
+    """
+
+    def __init__(self, max_tokens=None):
+        if max_tokens is None:
+            max_tokens = int(os.environ.get("ZHINAO_PROMPT_CACHE_TOKENS", str(1 << 20)))
+        self.max_tokens = max_tokens
+        self.num_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._tokenizer = None
+        self._incremental = False
+
+    def _render(self, messages, add_generation_prompt=False):
+        return self._tokenizer.apply_chat_template(
+            conversation=messages,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt)
+
+    def _tokenize(self, text):
+        return self._tokenizer(text, add_special_tokens=False).input_ids
+
+    def _probe(self):
+        system = {"role": "system", "content": "You are a helpful assistant."}
+        user = {"role": "user", "content": "1 + 1 = ?"}
+        assistant = {"role": "assistant", "content": "1 + 1 = 2."}
+        self._specials = _special_tokens(self._tokenizer)
+        self._base_ids = self._tokenizer("").input_ids
+        user_block = self._render([user])
+        prompt = self._render([user], add_generation_prompt=True)
+        if not self._specials or not prompt.startswith(user_block):
+            return False
+        generation_prompt = prompt[len(user_block):]
+        self._generation_prompt = (generation_prompt, self._tokenize(generation_prompt))
+        for conversation in ([system, user, assistant, user], [user, assistant]):
+            for add_generation_prompt in (False, True):
+                blocks = [self._render([message]) for message in conversation]
+                if add_generation_prompt:
+                    blocks.append(generation_prompt)
+                prompt = self._render(conversation, add_generation_prompt)
+                if prompt != "".join(blocks) or not all(
+                        block.startswith(self._specials) for block in blocks if block):
+                    return False
+                token_ids = list(self._base_ids)
+                for block in blocks:
+                    token_ids += self._tokenize(block)
+                if token_ids != self._tokenizer(prompt).input_ids:
+                    return False
+        return True
+
+    def _set_tokenizer(self, tokenizer):
+        self._tokenizer = tokenizer
+        self._blocks.clear()
+        self.num_tokens = 0
+        try:
+            self._incremental = self._probe()
+        except Exception as e:
+            logger.warning(f"Chat template probe failed: {e}")
+            self._incremental = False
+        if not self._incremental:
+            logger.info("Chat template does not render message by message; "
+                        "chat prompts are tokenized without the prompt cache.")
+
+    def _insert(self, key, block):
+        num_tokens = len(block[1])
+        if num_tokens > self.max_tokens:
+            return
+        self._blocks[key] = block
+        self.num_tokens += num_tokens
+        while self.num_tokens > self.max_tokens:
+            _, (_, token_ids) = self._blocks.popitem(last=False)
+            self.num_tokens -= len(token_ids)
+
+    def _encode_whole(self, messages, add_generation_prompt):
+        prompt = self._render(messages, add_generation_prompt)
+        return prompt, self._tokenizer(prompt).input_ids
+
+    def _encode(self, messages, add_generation_prompt):
+        if not self._incremental:
+            return self._encode_whole(messages, add_generation_prompt)
+        texts = []
+        token_ids = list(self._base_ids)
+        key = b""
+        hits = 0
+        for message in messages:
+            key = hashlib.sha1(key + json.dumps(
+                message, ensure_ascii=False, sort_keys=True).encode("utf-8")).digest()
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                hits += 1
+            else:
+                text = self._render([message])
+                if not text.startswith(self._specials):
+                    # e.g. a message whose role or content the template drops
+                    return self._encode_whole(messages, add_generation_prompt)
+                block = (text, self._tokenize(text))
+                self._insert(key, block)
+            texts.append(block[0])
+            token_ids += block[1]
+        if add_generation_prompt:
+            texts.append(self._generation_prompt[0])
+            token_ids += self._generation_prompt[1]
+        self.hits += hits
+        self.misses += len(messages) - hits
+        counter_prompt_cache_queries.inc(len(messages))
+        counter_prompt_cache_hits.inc(hits)
+        return "".join(texts), token_ids
+
+    def encode(self, tokenizer, messages, add_generation_prompt):
+        """Return the rendered prompt and its token ids for a list of messages."""
+        start = time.perf_counter()
+        if tokenizer is not self._tokenizer:
+            self._set_tokenizer(tokenizer)
+        try:
+            return self._encode(messages, add_generation_prompt)
+        finally:
+            histogram_prompt_encode_time.observe(time.perf_counter() - start)
 
-        index = 0
-        for k in s:
-            try:
-                if "func" in k:
-                    var = k.split("=", 1)
-                    try:
-                        var[1] = var[1].strip(" ")
-                        exec(var[1], globals())
-                        ans = func()
-                    except:
-                        if 'sympy' in var[1]:
-                            var[1] = var[1].replace('res[x]', 'res[0][0]').replace('res[y]', 'res[0][1]')
-                            exec(var[1], globals())
-                            ans = func()
-                        pass
-                    var_list = [c.strip(" ") for c in var[0].split(",")]
-                    if len(var_list) == 1:
-                        ans = [ans]
-
-                    for i in range(len(ans)):
-                        try:
-                            ans[i] = float(ans[i])
-                            if abs(ans[i] - int(ans[i])) < 1e-10:
-                                ans[i] = str(int(ans[i]))
-                        except:
-                            pass
-
-                    inputs = inputs.replace("<<"+k+">>", "")
-                    for i in range(len(var_list)):
-                        inputs = inputs.replace(var_list[i], str(ans[i]))
-                    index += 1
-                    for c in range(index, len(s)):
-                        for i in range(len(var_list)):
-                            s[c] = s[c].replace(var_list[i], str(ans[i]))
-                else:
-                    var = k.replace(" ", "").split("=")
-                    var[1] = var[1].replace("eval", "")
-                    ans = round(eval(var[1]), 10)
-                    ans = float(ans)
-                    if abs(ans - int(ans)) < 1e-10:
-                        ans = str(int(ans))
-                    inputs = inputs.replace("<<"+k+">>", "").replace(var[0], str(ans))
-                    index += 1
-                    for c in range(index, len(s)):
-                        s[c] = s[c].replace(var[0], str(ans))
-            except:
-                #print("err inputs: ", origin_inputs, flush=True)
-                return "抱歉！你的问题无法回答，请重新输入！"
-    except Exception as e:
-        #print("err inputs: ", origin_inputs, flush=True)
-        return "抱歉！你的问题无法回答，请重新输入！"
-
-    return inputs
 
 class OpenAIServingChat(OpenAIServing):
 
@@ -93,6 +224,8 @@ class OpenAIServingChat(OpenAIServing):
                          served_model=served_model,
                          lora_modules=lora_modules)
         self.response_role = response_role
+        self.pot_executor = PoTExecutor()
+        self.prompt_cache = ChatPromptCache()
         self._load_chat_template(chat_template)
 
     async def create_chat_completion(
@@ -112,10 +245,9 @@ class OpenAIServingChat(OpenAIServing):
             return error_check_ret
 
         try:
-            prompt = self.tokenizer.apply_chat_template(
-                conversation=request.messages,
-                tokenize=False,
-                add_generation_prompt=request.add_generation_prompt)
+            prompt, prompt_ids = self.prompt_cache.encode(
+                self.tokenizer, request.messages,
+                request.add_generation_prompt)
         except Exception as e:
             logger.error(
                 f"Error in applying chat template from request: {str(e)}")
@@ -123,8 +255,8 @@ class OpenAIServingChat(OpenAIServing):
 
         request_id = f"cmpl-{random_uuid()}"
         try:
-            token_ids = self._validate_prompt_and_tokenize(request,
-                                                           prompt=prompt)
+            token_ids = self._validate_prompt_and_tokenize(
+                request, prompt_ids=prompt_ids)
             sampling_params = request.to_sampling_params()
             lora_request = self._maybe_get_lora(request)
             guided_decode_logits_processor = (
@@ -144,7 +276,7 @@ class OpenAIServingChat(OpenAIServing):
         # Streaming response
         if request.stream:
             return self.chat_completion_stream_generator(
-                request, result_generator, request_id)
+                request, result_generator, request_id, raw_request)
         else:
             return await self.chat_completion_full_generator(
                 request, raw_request, result_generator, request_id)
@@ -157,12 +289,60 @@ class OpenAIServingChat(OpenAIServing):
 
     async def chat_completion_stream_generator(
             self, request: ChatCompletionRequest,
-            result_generator: AsyncIterator[RequestOutput], request_id: str
+            result_generator: AsyncIterator[RequestOutput], request_id: str,
+            raw_request: Optional[Request] = None
     ) -> Union[ErrorResponse, AsyncGenerator[str, None]]:
+        """Stream the chunks, aborting the engine request if the client goes away.
+
+        A disconnect reaches us either as the server cancelling or closing this
+        generator, or through the periodic raw_request check, so the request's
+        KV-cache blocks and decode slot are freed without waiting for max_tokens.
+        """
+        last_res = None
+
+        async def tracked_results():
+            nonlocal last_res
+            async for res in result_generator:
+                last_res = res
+                yield res
+
+        completed = disconnected = False
+        next_disconnect_check = time.monotonic() + DISCONNECT_CHECK_INTERVAL
+        try:
+            async for data in self._chat_completion_stream(
+                    request, tracked_results(), request_id):
+                yield data
+                if (raw_request is not None
+                        and time.monotonic() >= next_disconnect_check):
+                    next_disconnect_check = (time.monotonic() +
+                                             DISCONNECT_CHECK_INTERVAL)
+                    if await raw_request.is_disconnected():
+                        disconnected = True
+                        return
+            completed = True
+        except (asyncio.CancelledError, GeneratorExit):
+            disconnected = True
+            raise
+        finally:
+            if not completed:
+                await self.engine.abort(request_id)
+            if disconnected and not completed:
+                counter_aborted_streams.inc()
+                if last_res is not None:
+                    counter_aborted_stream_tokens.inc(
+                        sum(len(output.token_ids)
+                            for output in last_res.outputs))
+
+    async def _chat_completion_stream(
+            self, request: ChatCompletionRequest,
+            result_generator: AsyncIterator[RequestOutput], request_id: str
+    ) -> AsyncGenerator[str, None]:
 
         model_name = request.model
         created_time = int(time.monotonic())
         chunk_object_type = "chat.completion.chunk"
+        chunk_template = StreamChunkTemplate(request_id, created_time,
+                                             model_name)
 
         # Send first response for each request.n (index) with the role
         role = self.get_chat_request_role(request)
@@ -206,16 +386,28 @@ class OpenAIServingChat(OpenAIServing):
                     yield f"data: {data}\n\n"
 
         # Send response for each token for each request.n (index)
-        previous_texts = [""] * request.n
-        previous_num_tokens = [0] * request.n
-        finish_reason_sent = [False] * request.n
+        # Per-choice state is keyed by choice index and created on first use.
+        previous_texts = {}
+        previous_num_tokens = {}
+        finish_reason_sent = set()
+        pot_parsers = {}
+        # With best_of > n the engine's output.index runs up to best_of - 1
+        # and which sequences are the n best is only settled once they finish,
+        # so such requests are sent in one piece at the end, indexed 0..n-1.
+        best_of_pending = (request.best_of or request.n) > request.n
         async for res in result_generator:
             res: RequestOutput
-            for output in res.outputs:
-                i = output.index
+            if best_of_pending and not res.finished:
+                continue
+            for choice_index, output in enumerate(res.outputs):
+                i = choice_index if best_of_pending else output.index
 
-                if finish_reason_sent[i]:
+                if i in finish_reason_sent:
                     continue
+                if i not in pot_parsers:
+                    previous_texts[i] = ""
+                    previous_num_tokens[i] = 0
+                    pot_parsers[i] = IncrementalPoTParser(self.pot_executor)
 
                 delta_token_ids = output.token_ids[previous_num_tokens[i]:]
                 top_logprobs = output.logprobs[
@@ -231,27 +423,15 @@ class OpenAIServingChat(OpenAIServing):
                 else:
                     logprobs = None
 
-                #delta_text = output.text[len(previous_texts[i]):]
-                #previous_texts[i] = output.text
-                if not "<<" in output.text:
-                    delta_text = output.text[len(previous_texts[i]):]
-                    previous_texts[i] = output.text
-                else :
-                    if not ">>" in output.text:
-                        delta_text = ""
-                        previous_texts[i] = previous_texts[i-1]
-                    else :
-                        pot_text = parse_pot_no_stream(output.text)
-                        if "var" in pot_text[-6:]:
-                            delta_text = ""
-                            previous_texts[i] = previous_texts[i-1]
-                        else :
-                            delta_text = pot_text[len(previous_texts[i]):]
-                            previous_texts[i] = pot_text
+                delta_text = await pot_parsers[i].feed(
+                    output.text, final=output.finish_reason is not None)
+                previous_texts[i] = output.text
 
                 previous_num_tokens[i] = len(output.token_ids)
-                if output.finish_reason is None:
+                if output.finish_reason is None and logprobs is None:
                     # Send token-by-token response for each request.n
+                    yield chunk_template.content(i, delta_text)
+                elif output.finish_reason is None:
                     choice_data = ChatCompletionResponseStreamChoice(
                         index=i,
                         delta=DeltaMessage(content=delta_text),
@@ -289,7 +469,7 @@ class OpenAIServingChat(OpenAIServing):
                     data = chunk.model_dump_json(exclude_unset=True,
                                                  exclude_none=True)
                     yield f"data: {data}\n\n"
-                    finish_reason_sent[i] = True
+                    finish_reason_sent.add(i)
         # Send the final done message after all response.n are finished
         yield "data: [DONE]\n\n"
 
@@ -313,7 +493,9 @@ class OpenAIServingChat(OpenAIServing):
         choices = []
 
         role = self.get_chat_request_role(request)
-        for output in final_res.outputs:
+        # output.index can reach best_of - 1; choices are numbered 0..n-1
+        best_of_pending = (request.best_of or request.n) > request.n
+        for choice_index, output in enumerate(final_res.outputs):
             token_ids = output.token_ids
             top_logprobs = output.logprobs
 
@@ -327,8 +509,8 @@ class OpenAIServingChat(OpenAIServing):
                 logprobs = None
 
             choice_data = ChatCompletionResponseChoice(
-                index=output.index,
-                message=ChatMessage(role=role, content=parse_pot_no_stream(output.text)),
+                index=choice_index if best_of_pending else output.index,
+                message=ChatMessage(role=role, content=await parse_pot(output.text, self.pot_executor)),
                 logprobs=logprobs,
                 finish_reason=output.finish_reason,
             )
@@ -1,6 +1,7 @@
 # coding=utf-8
 # Adapted from
 # https://github.com/huggingface/transformers/blob/v4.28.0/src/transformers/models/llama/modeling_llama.py
+# Copyright 2024 The Zhinao team.
 # Copyright 2023 The vLLM team.
 # Copyright 2022 EleutherAI and the HuggingFace Inc. team. All rights reserved.
 #
@@ -20,34 +21,204 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Inference-only Zhinao model compatible with HuggingFace weights."""
-from typing import Any, Dict, List, Optional, Tuple
+"""Inference-only Zhinao model compatible with HuggingFace weights.
+
+One implementation serves vLLM 0.3.3 through 0.4.2. The model API differences
+between those releases (InputMetadata vs AttentionMetadata, LinearMethodBase
+vs QuantizationConfig, in-sampler vs separate logits computation, how weights
+are handed to load_weights) are resolved once at import time below.
+"""
+import functools
+import inspect
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
 
 import torch
+from safetensors import safe_open
 from torch import nn
-from transformers import LlamaConfig
+from transformers import PretrainedConfig
 
 from vllm.config import LoRAConfig
-from vllm.model_executor.input_metadata import InputMetadata
+from vllm.logger import init_logger
 from vllm.model_executor.layers.activation import SiluAndMul
-from vllm.model_executor.layers.attention import PagedAttention
 from vllm.model_executor.layers.layernorm import RMSNorm
-from vllm.model_executor.layers.linear import (LinearMethodBase,
-                                               MergedColumnParallelLinear,
+from vllm.model_executor.layers.linear import (MergedColumnParallelLinear,
                                                QKVParallelLinear,
                                                RowParallelLinear)
+from vllm.model_executor.layers.quantization.base_config import (
+    QuantizationConfig)
 from vllm.model_executor.layers.rotary_embedding import get_rope
 from vllm.model_executor.layers.sampler import Sampler
 from vllm.model_executor.layers.vocab_parallel_embedding import (
-    VocabParallelEmbedding, ParallelLMHead, DEFAULT_VOCAB_PADDING_SIZE)
-from vllm.model_executor.parallel_utils.parallel_state import (
-    get_tensor_model_parallel_world_size)
+    DEFAULT_VOCAB_PADDING_SIZE, ParallelLMHead, VocabParallelEmbedding)
 from vllm.model_executor.sampling_metadata import SamplingMetadata
-from vllm.model_executor.weight_utils import (default_weight_loader,
-                                              hf_model_weights_iterator)
 from vllm.sequence import SamplerOutput
+from vllm.utils import is_hip
+
+# vLLM version compatibility.
+try:
+    # vLLM >= 0.4.0: one kv cache tensor per layer, AttentionMetadata.
+    from vllm.attention import Attention, AttentionMetadata
+    _PAGED_ATTENTION = False
+except ImportError:
+    # vLLM 0.3.x: separate key/value caches, InputMetadata.
+    from vllm.model_executor.input_metadata import (
+        InputMetadata as AttentionMetadata)
+    from vllm.model_executor.layers.attention import (
+        PagedAttention as Attention)
+    _PAGED_ATTENTION = True
+try:
+    from vllm.distributed import (get_tensor_model_parallel_rank,
+                                  get_tensor_model_parallel_world_size)
+except ImportError:
+    from vllm.model_executor.parallel_utils.parallel_state import (
+        get_tensor_model_parallel_rank, get_tensor_model_parallel_world_size)
+try:
+    # vLLM >= 0.4.0 computes logits outside the sampler.
+    from vllm.model_executor.layers.logits_processor import LogitsProcessor
+except ImportError:
+    LogitsProcessor = None
+try:
+    from vllm.model_executor.model_loader.weight_utils import (
+        default_weight_loader, kv_cache_scales_loader)
+except ImportError:
+    from vllm.model_executor.weight_utils import default_weight_loader
+    kv_cache_scales_loader = None
+
+# vLLM >= 0.4.2 builds linear layers from a QuantizationConfig, older
+# releases from a LinearMethodBase passed as `linear_method`.
+_QUANT_KWARG = ("quant_config" if "quant_config" in inspect.signature(
+    QKVParallelLinear.__init__).parameters else "linear_method")
+# vLLM >= 0.4.1 takes the fp8 kv cache scaling factor in Attention.forward.
+_ATTN_KV_SCALE = (not _PAGED_ATTENTION and "kv_scale" in inspect.signature(
+    Attention.forward).parameters)
+
+# A tensor for vLLM >= 0.4.0, a (key_cache, value_cache) tuple before.
+KVCache = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
+
+logger = init_logger(__name__)
+
+
+def _quant_kwargs(quant_config: Optional[Any]) -> Dict[str, Any]:
+    return {_QUANT_KWARG: quant_config}
+
+
+def _repack_qkv(loaded_weight: torch.Tensor, total_num_heads: int,
+                total_num_kv_heads: int, output_dim: int) -> torch.Tensor:
+    # HF Zhinao checkpoints interleave qkv_proj per kv head as
+    # [q heads..., k, v]; vLLM expects q|k|v.
+    num_query_heads_per_kv_head = total_num_heads // total_num_kv_heads
+    shape = loaded_weight.shape
+    outer, inner = shape[:output_dim], shape[output_dim + 1:]
+    loaded_weight = loaded_weight.view(
+        outer + (total_num_kv_heads, num_query_heads_per_kv_head + 2, -1) +
+        inner)
+    wq = loaded_weight.narrow(output_dim + 1, 0,
+                              num_query_heads_per_kv_head).reshape(
+                                  *outer, -1, *inner)
+    wk = loaded_weight.narrow(output_dim + 1, num_query_heads_per_kv_head,
+                              1).reshape(*outer, -1, *inner)
+    wv = loaded_weight.narrow(output_dim + 1, num_query_heads_per_kv_head + 1,
+                              1).reshape(*outer, -1, *inner)
+    return torch.cat([wq, wk, wv], dim=output_dim)
+
+
+def _repack_packed_qkv(loaded_weight: torch.Tensor, total_num_heads: int,
+                       total_num_kv_heads: int, output_dim: int,
+                       pack_factor: int) -> torch.Tensor:
+    # Quantized checkpoints (GPTQ qzeros) pack `pack_factor` values along the
+    # output dim into each int32: unpack, repack the heads, pack again.
+    bits = 32 // pack_factor
+    shifts = torch.arange(0,
+                          32,
+                          bits,
+                          dtype=torch.int64,
+                          device=loaded_weight.device)
+    packed = loaded_weight.to(torch.int64).movedim(output_dim, -1)
+    values = ((packed.unsqueeze(-1) >> shifts) & ((1 << bits) - 1)).flatten(-2)
+    values = _repack_qkv(values, total_num_heads, total_num_kv_heads,
+                         values.dim() - 1)
+    packed = (values.unflatten(-1, (-1, pack_factor)) << shifts).sum(dim=-1)
+    packed = torch.where(packed >= 2**31, packed - 2**32, packed)
+    return packed.to(torch.int32).movedim(-1, output_dim).contiguous()
+
+
+def _iterator_safetensors_files(weights: Iterable) -> List[str]:
+    """The shards behind vLLM's own safetensors iterator, else [].
 
-KVCache = Tuple[torch.Tensor, torch.Tensor]
+    vLLM >= 0.4.2 hands load_weights a safetensors_weights_iterator over the
+    files it resolved for the load format, download dir and revision; any
+    other iterator (pt, npcache, already started or wrapped) is consumed as
+    given.
+    """
+    if (not inspect.isgenerator(weights)
+            or weights.gi_code.co_name != "safetensors_weights_iterator"
+            or inspect.getgeneratorstate(weights) != inspect.GEN_CREATED):
+        return []
+    shard_files = list(weights.gi_frame.f_locals.get("hf_weights_files")
+                       or [])
+    if not all(
+            str(path).endswith(".safetensors") and os.path.isfile(path)
+            for path in shard_files):
+        return []
+    return shard_files
+
+
+def _parallel_weights_iterator(
+        shard_files: List[str],
+        num_threads: int) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Read safetensors shards concurrently and yield their tensors.
+
+    Shards are mmapped by a pool of reader threads that feed a bounded queue,
+    so the consumer's host-to-device copies overlap with reading. Per-shard
+    read times are logged once all shards are done.
+    """
+    tensors: queue.Queue = queue.Queue(maxsize=4 * num_threads)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> None:
+        while not stop.is_set():
+            try:
+                tensors.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read_shard(path: str) -> Tuple[str, int, float]:
+        start = time.perf_counter()
+        num_bytes = 0
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                if stop.is_set():
+                    break
+                tensor = f.get_tensor(name)
+                num_bytes += tensor.numel() * tensor.element_size()
+                put((name, tensor))
+        return path, num_bytes, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = [pool.submit(read_shard, path) for path in shard_files]
+        threading.Thread(target=lambda: (wait(futures), put(done)),
+                         daemon=True).start()
+        try:
+            while True:
+                item = tensors.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+        for future in futures:
+            path, num_bytes, seconds = future.result()
+            logger.info(f"Read {os.path.basename(path)}: "
+                        f"{num_bytes / 2**30:.2f} GiB in {seconds:.2f}s "
+                        f"({num_bytes / 2**30 / max(seconds, 1e-6):.2f} GiB/s)")
 
 
 class ZhinaoMLP(nn.Module):
@@ -57,17 +228,17 @@ class ZhinaoMLP(nn.Module):
         hidden_size: int,
         intermediate_size: int,
         hidden_act: str,
-        linear_method: Optional[LinearMethodBase] = None,
+        quant_config: Optional[QuantizationConfig] = None,
     ) -> None:
         super().__init__()
         self.gate_up_proj = MergedColumnParallelLinear(
             hidden_size, [intermediate_size] * 2,
             bias=False,
-            linear_method=linear_method)
+            **_quant_kwargs(quant_config))
         self.down_proj = RowParallelLinear(intermediate_size,
                                            hidden_size,
                                            bias=False,
-                                           linear_method=linear_method)
+                                           **_quant_kwargs(quant_config))
         if hidden_act != "silu":
             raise ValueError(f"Unsupported activation: {hidden_act}. "
                              "Only silu is supported for now.")
@@ -90,7 +261,7 @@ class ZhinaoAttention(nn.Module):
         rope_theta: float = 10000,
         rope_scaling: Optional[Dict[str, Any]] = None,
         max_position_embeddings: int = 8192,
-        linear_method: Optional[LinearMethodBase] = None,
+        quant_config: Optional[QuantizationConfig] = None,
         bias: bool = False,
         sliding_window: Optional[int] = None,
     ) -> None:
@@ -117,19 +288,28 @@ class ZhinaoAttention(nn.Module):
         self.rope_theta = rope_theta
         self.max_position_embeddings = max_position_embeddings
 
+        # This will be overwritten by model initialization if we are using it.
+        # N.B. currently we only support per tensor scalar scaling factors
+        # & only applicable to ROCm (AMD GPU).
+        # The scaling factor convention we are assuming is
+        # quantized_value * scaling_factor ~= true_value
+        # which is consistent with the practice of setting
+        # scaling_factor = tensor_amax / FPtype_max
+        self.kv_scale = 1.0
+
         self.qkv_proj = QKVParallelLinear(
             hidden_size,
             self.head_dim,
             self.total_num_heads,
             self.total_num_kv_heads,
             bias=True,
-            linear_method=linear_method,
+            **_quant_kwargs(quant_config),
         )
         self.o_proj = RowParallelLinear(
             self.total_num_heads * self.head_dim,
             hidden_size,
             bias=bias,
-            linear_method=linear_method,
+            **_quant_kwargs(quant_config),
         )
 
         self.rotary_emb = get_rope(
@@ -139,24 +319,30 @@ class ZhinaoAttention(nn.Module):
             base=rope_theta,
             rope_scaling=rope_scaling,
         )
-        self.attn = PagedAttention(self.num_heads,
-                                   self.head_dim,
-                                   self.scaling,
-                                   num_kv_heads=self.num_kv_heads,
-                                   sliding_window=sliding_window)
+        self.attn = Attention(self.num_heads,
+                              self.head_dim,
+                              self.scaling,
+                              num_kv_heads=self.num_kv_heads,
+                              sliding_window=sliding_window)
 
     def forward(
         self,
         positions: torch.Tensor,
         hidden_states: torch.Tensor,
         kv_cache: KVCache,
-        input_metadata: InputMetadata,
+        attn_metadata: AttentionMetadata,
     ) -> torch.Tensor:
         qkv, _ = self.qkv_proj(hidden_states)
         q, k, v = qkv.split([self.q_size, self.kv_size, self.kv_size], dim=-1)
         q, k = self.rotary_emb(positions, q, k)
-        k_cache, v_cache = kv_cache
-        attn_output = self.attn(q, k, v, k_cache, v_cache, input_metadata)
+        if _PAGED_ATTENTION:
+            k_cache, v_cache = kv_cache
+            attn_output = self.attn(q, k, v, k_cache, v_cache, attn_metadata)
+        elif _ATTN_KV_SCALE:
+            attn_output = self.attn(q, k, v, kv_cache, attn_metadata,
+                                    self.kv_scale)
+        else:
+            attn_output = self.attn(q, k, v, kv_cache, attn_metadata)
         output, _ = self.o_proj(attn_output)
         return output
 
@@ -165,8 +351,8 @@ class ZhinaoDecoderLayer(nn.Module):
 
     def __init__(
         self,
-        config: LlamaConfig,
-        linear_method: Optional[LinearMethodBase] = None,
+        config: PretrainedConfig,
+        quant_config: Optional[QuantizationConfig] = None,
     ) -> None:
         super().__init__()
         self.hidden_size = config.hidden_size
@@ -175,6 +361,10 @@ class ZhinaoDecoderLayer(nn.Module):
         max_position_embeddings = getattr(config, "max_position_embeddings",
                                           8192)
         sliding_window = getattr(config, "sliding_window", None)
+        # Support abacusai/Smaug-72B-v0.1 with attention_bias
+        # Support internlm/internlm-7b with bias
+        attention_bias = getattr(config, "attention_bias", False) or getattr(
+            config, "bias", False)
         self.self_attn = ZhinaoAttention(
             hidden_size=self.hidden_size,
             num_heads=config.num_attention_heads,
@@ -183,15 +373,15 @@ class ZhinaoDecoderLayer(nn.Module):
             rope_theta=rope_theta,
             rope_scaling=rope_scaling,
             max_position_embeddings=max_position_embeddings,
-            linear_method=linear_method,
-            bias=getattr(config, "bias", False),
+            quant_config=quant_config,
+            bias=attention_bias,
             sliding_window=sliding_window,
         )
         self.mlp = ZhinaoMLP(
             hidden_size=self.hidden_size,
             intermediate_size=config.intermediate_size,
             hidden_act=config.hidden_act,
-            linear_method=linear_method,
+            quant_config=quant_config,
         )
         self.input_layernorm = RMSNorm(config.hidden_size,
                                        eps=config.rms_norm_eps)
@@ -203,7 +393,7 @@ class ZhinaoDecoderLayer(nn.Module):
         positions: torch.Tensor,
         hidden_states: torch.Tensor,
         kv_cache: KVCache,
-        input_metadata: InputMetadata,
+        attn_metadata: AttentionMetadata,
         residual: Optional[torch.Tensor],
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # Self Attention
@@ -217,7 +407,7 @@ class ZhinaoDecoderLayer(nn.Module):
             positions=positions,
             hidden_states=hidden_states,
             kv_cache=kv_cache,
-            input_metadata=input_metadata,
+            attn_metadata=attn_metadata,
         )
 
         # Fully Connected
@@ -231,8 +421,8 @@ class ZhinaoModel(nn.Module):
 
     def __init__(
         self,
-        config: LlamaConfig,
-        linear_method: Optional[LinearMethodBase] = None,
+        config: PretrainedConfig,
+        quant_config: Optional[QuantizationConfig] = None,
         lora_config: Optional[LoRAConfig] = None,
     ) -> None:
         super().__init__()
@@ -248,19 +438,26 @@ class ZhinaoModel(nn.Module):
             org_num_embeddings=config.vocab_size,
         )
         self.layers = nn.ModuleList([
-            ZhinaoDecoderLayer(config, linear_method)
+            ZhinaoDecoderLayer(config, quant_config)
             for _ in range(config.num_hidden_layers)
         ])
         self.norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
+    def get_input_embeddings(self, input_ids: torch.Tensor) -> torch.Tensor:
+        return self.embed_tokens(input_ids)
+
     def forward(
         self,
-        input_ids: torch.Tensor,
+        input_ids: Optional[torch.Tensor],
         positions: torch.Tensor,
         kv_caches: List[KVCache],
-        input_metadata: InputMetadata,
+        attn_metadata: AttentionMetadata,
+        inputs_embeds: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        hidden_states = self.embed_tokens(input_ids)
+        if inputs_embeds is not None:
+            hidden_states = inputs_embeds
+        else:
+            hidden_states = self.get_input_embeddings(input_ids)
         residual = None
         for i in range(len(self.layers)):
             layer = self.layers[i]
@@ -268,7 +465,7 @@ class ZhinaoModel(nn.Module):
                 positions,
                 hidden_states,
                 kv_caches[i],
-                input_metadata,
+                attn_metadata,
                 residual,
             )
         hidden_states, _ = self.norm(hidden_states, residual)
@@ -300,14 +497,18 @@ class ZhinaoForCausalLM(nn.Module):
 
     def __init__(
         self,
-        config: LlamaConfig,
-        linear_method: Optional[LinearMethodBase] = None,
+        config: PretrainedConfig,
+        linear_method: Optional[Any] = None,
         lora_config: Optional[LoRAConfig] = None,
+        quant_config: Optional[QuantizationConfig] = None,
     ) -> None:
         super().__init__()
         self.config = config
-        self.linear_method = linear_method
-        self.model = ZhinaoModel(config, linear_method, lora_config=lora_config)
+        # vLLM < 0.4.2 passes a LinearMethodBase positionally, later releases
+        # a QuantizationConfig by keyword; either ends up in the linear layers.
+        if quant_config is None:
+            quant_config = linear_method
+        self.model = ZhinaoModel(config, quant_config, lora_config=lora_config)
         self.unpadded_vocab_size = config.vocab_size
         if lora_config:
             self.unpadded_vocab_size += lora_config.lora_extra_vocab_size
@@ -320,44 +521,102 @@ class ZhinaoForCausalLM(nn.Module):
             # compatibility
             if not lora_config else lora_config.lora_vocab_padding_size,
         )
-        self.sampler = Sampler(self.unpadded_vocab_size, config.vocab_size)
+
+        if LogitsProcessor is None:
+            self.logits_processor = None
+            self.sampler = Sampler(self.unpadded_vocab_size, config.vocab_size)
+        else:
+            logit_scale = getattr(config, "logit_scale", 1.0)
+            self.logits_processor = LogitsProcessor(self.unpadded_vocab_size,
+                                                    config.vocab_size,
+                                                    logit_scale)
+            self.sampler = Sampler()
 
     def forward(
         self,
         input_ids: torch.Tensor,
         positions: torch.Tensor,
         kv_caches: List[KVCache],
-        input_metadata: InputMetadata,
+        attn_metadata: Optional[AttentionMetadata] = None,
+        input_metadata: Optional[AttentionMetadata] = None,
     ) -> torch.Tensor:
+        # vLLM 0.3.x passes the metadata as `input_metadata`.
+        if attn_metadata is None:
+            attn_metadata = input_metadata
         hidden_states = self.model(input_ids, positions, kv_caches,
-                                   input_metadata)
+                                   attn_metadata)
         return hidden_states
 
+    def compute_logits(self, hidden_states: torch.Tensor,
+                       sampling_metadata: SamplingMetadata) -> torch.Tensor:
+        logits = self.logits_processor(self.lm_head.weight, hidden_states,
+                                       sampling_metadata)
+        return logits
+
     def sample(
         self,
-        hidden_states: torch.Tensor,
-        sampling_metadata: SamplingMetadata,
+        logits: Optional[torch.Tensor] = None,
+        sampling_metadata: Optional[SamplingMetadata] = None,
+        hidden_states: Optional[torch.Tensor] = None,
     ) -> Optional[SamplerOutput]:
-        next_tokens = self.sampler(self.lm_head.weight, hidden_states,
-                                   sampling_metadata)
+        if hidden_states is not None:
+            # vLLM 0.3.x samples from hidden states and applies lm_head in
+            # the sampler.
+            return self.sampler(self.lm_head.weight, hidden_states,
+                                sampling_metadata)
+        next_tokens = self.sampler(logits, sampling_metadata)
         return next_tokens
 
-    def load_weights(self,
-                     model_name_or_path: str,
-                     cache_dir: Optional[str] = None,
-                     load_format: str = "auto",
-                     revision: Optional[str] = None):
+    def _weight_dispatch_table(
+        self
+    ) -> Dict[str, Tuple[nn.Parameter, Optional[int], Optional[Callable]]]:
+        """Map checkpoint tensor names to (param, shard_id, transform)."""
         stacked_params_mapping = [
             # (param_name, shard_name, shard_id)
             ("gate_up_proj", "gate_proj", 0),
             ("gate_up_proj", "up_proj", 1),
         ]
         total_num_heads = self.config.num_attention_heads
-        total_num_kv_heads = self.config.num_attention_heads
-        num_query_heads_per_kv_head = total_num_heads // total_num_kv_heads
-        params_dict = dict(self.named_parameters())
-        for name, loaded_weight in hf_model_weights_iterator(
-                model_name_or_path, cache_dir, load_format, revision):
+        total_num_kv_heads = getattr(self.config, "num_key_value_heads",
+                                     total_num_heads)
+        # Checkpoints written by convert_qkv.py already store qkv_proj as
+        # q|k|v, so the per-kv-head interleaving does not need undoing.
+        qkv_prepacked = getattr(self.config, "qkv_prepacked", False)
+        table = {}
+        for name, param in self.named_parameters():
+            stacked = [(param_name, weight_name, shard_id)
+                       for (param_name, weight_name,
+                            shard_id) in stacked_params_mapping
+                       if param_name in name]
+            for (param_name, weight_name, shard_id) in stacked:
+                table[name.replace(param_name,
+                                   weight_name)] = (param, shard_id, None)
+            if not stacked:
+                transform = None
+                output_dim = getattr(param, "output_dim", None)
+                if ("qkv_proj" in name and not qkv_prepacked
+                        and output_dim is not None):
+                    transform = functools.partial(
+                        _repack_qkv,
+                        total_num_heads=total_num_heads,
+                        total_num_kv_heads=total_num_kv_heads,
+                        output_dim=output_dim)
+                    if getattr(param, "packed_dim", None) == output_dim:
+                        transform = functools.partial(
+                            _repack_packed_qkv,
+                            total_num_heads=total_num_heads,
+                            total_num_kv_heads=total_num_kv_heads,
+                            output_dim=output_dim,
+                            pack_factor=param.pack_factor)
+                table[name] = (param, None, transform)
+        return table
+
+    def _load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]):
+        table = self._weight_dispatch_table()
+        start = time.perf_counter()
+        loader_seconds = 0.0
+        num_tensors = 0
+        for name, loaded_weight in weights:
             if "rotary_emb.inv_freq" in name:
                 continue
             if ("rotary_emb.cos_cached" in name
@@ -365,45 +624,89 @@ class ZhinaoForCausalLM(nn.Module):
                 # Models trained using ColossalAI may include these tensors in
                 # the checkpoint. Skip them.
                 continue
-            for (param_name, weight_name, shard_id) in stacked_params_mapping:
-                if weight_name not in name:
-                    continue
-                name = name.replace(weight_name, param_name)
+            if name not in table:
                 # Skip loading extra bias for GPTQ models.
-                if name.endswith(".bias") and name not in params_dict:
+                if name.endswith(".bias"):
                     continue
-                param = params_dict[name]
-                weight_loader = param.weight_loader
-                weight_loader(param, loaded_weight, shard_id)
-                break
-            else:
-                # Skip loading extra bias for GPTQ models.
-                if name.endswith(".bias") and name not in params_dict:
-                    continue
-                param = params_dict[name]
-                if "qkv_proj" in name:
-                    output_dim = getattr(param, "output_dim", None)
-                    loaded_weight_shape = loaded_weight.shape
-                    if output_dim is not None:
-                        loaded_weight = loaded_weight.view(
-                            loaded_weight_shape[:output_dim] +
-                            (total_num_kv_heads, num_query_heads_per_kv_head + 2,
-                             -1) + loaded_weight_shape[output_dim + 1:])
-                        wq = loaded_weight.narrow(
-                            output_dim + 1, 0,
-                            num_query_heads_per_kv_head).reshape(
-                                *loaded_weight_shape[:output_dim], -1,
-                                *loaded_weight_shape[output_dim + 1:])
-                        wk = loaded_weight.narrow(
-                            output_dim + 1, num_query_heads_per_kv_head,
-                            1).reshape(*loaded_weight_shape[:output_dim], -1,
-                                       *loaded_weight_shape[output_dim + 1:])
-                        wv = loaded_weight.narrow(
-                            output_dim + 1, num_query_heads_per_kv_head + 1,
-                            1).reshape(*loaded_weight_shape[:output_dim], -1,
-                                       *loaded_weight_shape[output_dim + 1:])
-                        loaded_weight = torch.cat([wq, wk, wv], dim=output_dim)
-                weight_loader = getattr(param, "weight_loader",
-                                        default_weight_loader)
+                raise KeyError(f"Unexpected weight {name} in checkpoint")
+            param, shard_id, transform = table[name]
+            loader_start = time.perf_counter()
+            if transform is not None:
+                loaded_weight = transform(loaded_weight)
+            weight_loader = getattr(param, "weight_loader",
+                                    default_weight_loader)
+            if shard_id is None:
                 weight_loader(param, loaded_weight)
+            else:
+                weight_loader(param, loaded_weight, shard_id)
+            loader_seconds += time.perf_counter() - loader_start
+            num_tensors += 1
+        logger.info(f"Loaded {num_tensors} tensors in "
+                    f"{time.perf_counter() - start:.2f}s "
+                    f"({loader_seconds:.2f}s in weight loaders)")
+
+    def load_weights(self,
+                     weights: Union[str, Iterable[Tuple[str, torch.Tensor]]],
+                     cache_dir: Optional[str] = None,
+                     load_format: str = "auto",
+                     revision: Optional[str] = None):
+        num_threads = int(os.environ.get("ZHINAO_LOAD_THREADS", "8"))
+        if isinstance(weights, str):
+            # vLLM <= 0.4.0 passes the checkpoint location and leaves reading
+            # it to the model.
+            self._load_weights(
+                self._checkpoint_weights(weights, cache_dir, load_format,
+                                         revision, num_threads))
+            return
+        # When vLLM is about to read safetensors shards, read the same files
+        # with a thread pool instead of consuming its serial iterator.
+        shard_files = _iterator_safetensors_files(weights)
+        if num_threads > 0 and shard_files:
+            weights.close()
+            weights = _parallel_weights_iterator(shard_files, num_threads)
+        self._load_weights(weights)
+
+    @staticmethod
+    def _checkpoint_weights(
+            model_name_or_path: str, cache_dir: Optional[str],
+            load_format: str, revision: Optional[str],
+            num_threads: int) -> Iterator[Tuple[str, torch.Tensor]]:
+        from vllm.model_executor.weight_utils import (
+            hf_model_weights_iterator, prepare_hf_model_weights)
+        if num_threads > 0 and load_format in ("auto", "safetensors"):
+            _, hf_weights_files, use_safetensors = prepare_hf_model_weights(
+                model_name_or_path,
+                cache_dir=cache_dir,
+                load_format=load_format,
+                revision=revision)
+            if use_safetensors:
+                return _parallel_weights_iterator(hf_weights_files,
+                                                  num_threads)
+        return hf_model_weights_iterator(model_name_or_path, cache_dir,
+                                         load_format, revision)
 
+    # If this function is called, it should always initialize KV cache scale
+    # factors (or else raise an exception). Thus, handled exceptions should
+    # make sure to leave KV cache scale factors in a known good (dummy) state
+    def load_kv_cache_scales(self, quantization_param_path: str) -> None:
+        if kv_cache_scales_loader is None:
+            raise RuntimeError("KV cache scaling factors need vLLM >= 0.4.1")
+        tp_size = get_tensor_model_parallel_world_size()
+        tp_rank = get_tensor_model_parallel_rank()
+        for layer_idx, scaling_factor in kv_cache_scales_loader(
+                quantization_param_path, tp_rank, tp_size,
+                self.config.num_hidden_layers,
+                self.config.__class__.model_type):
+            layer_self_attn = self.model.layers[layer_idx].self_attn
+
+            if is_hip():
+                # The scaling factor convention we are assuming is
+                # quantized_value * scaling_factor ~= true_value
+                # which is consistent with the practice of setting
+                # scaling_factor = tensor_amax / FPtype_max
+                scaling_factor *= 2
+            if hasattr(layer_self_attn, "kv_scale"):
+                layer_self_attn.kv_scale = scaling_factor
+            else:
+                raise RuntimeError("Self attention has no KV cache scaling "
+                                   "factor attribute!")
@@ -0,0 +1,366 @@
+"""Program-of-thought (PoT) evaluation for the Zhinao chat endpoint.
+
+The model writes computations as <<name = expression>> spans, or as
+<<a, b = func = ...>> spans defining a `func`, and refers to the results by
+name in the text around them. parse_pot_no_stream replaces them in one go;
+serving_chat.py evaluates spans with a PoTExecutor, whose workers run this
+file as a script. It must therefore not import vllm or torch: a worker only
+holds sympy and scipy, and its memory limit is counted from there.
+"""
+import os
+import re
+import sys
+import json
+import math
+import signal
+import asyncio
+import logging
+import resource
+import argparse
+from collections import OrderedDict
+
+from scipy.optimize import minimize
+import sympy
+
+logger = logging.getLogger(__name__)
+
+POT_ERROR_MESSAGE = "抱歉！你的问题无法回答，请重新输入！"
+
+
+def eval_pot_span(k):
+    """Evaluate the body of one <<...>> span, returning its [(name, value)] bindings.
+
+    The code runs in a fresh namespace that only provides the modules PoT
+    answers use, so spans cannot see or change each other's definitions.
+    """
+    namespace = {"math": math, "re": re, "sympy": sympy, "minimize": minimize}
+    if "func" in k:
+        var = k.split("=", 1)
+        try:
+            var[1] = var[1].strip(" ")
+            exec(var[1], namespace)
+            ans = namespace["func"]()
+        except:
+            if 'sympy' in var[1]:
+                var[1] = var[1].replace('res[x]', 'res[0][0]').replace('res[y]', 'res[0][1]')
+                exec(var[1], namespace)
+                ans = namespace["func"]()
+            pass
+        var_list = [c.strip(" ") for c in var[0].split(",")]
+        if len(var_list) == 1:
+            ans = [ans]
+
+        for i in range(len(ans)):
+            try:
+                ans[i] = float(ans[i])
+                if abs(ans[i] - int(ans[i])) < 1e-10:
+                    ans[i] = str(int(ans[i]))
+            except:
+                pass
+
+        return [(var_list[i], str(ans[i])) for i in range(len(var_list))]
+
+    var = k.replace(" ", "").split("=")
+    var[1] = var[1].replace("eval", "")
+    ans = round(eval(var[1], namespace), 10)
+    ans = float(ans)
+    if abs(ans - int(ans)) < 1e-10:
+        ans = str(int(ans))
+    return [(var[0], str(ans))]
+
+
+def parse_pot_no_stream(inputs):
+    try:
+        s = re.findall(r'<<(.*?)>>', inputs, re.DOTALL)
+        if not s:
+            #print("err inputs: ", origin_inputs, flush=True)
+            return inputs
+
+        index = 0
+        for k in s:
+            try:
+                bindings = eval_pot_span(k)
+                inputs = inputs.replace("<<"+k+">>", "")
+                for name, value in bindings:
+                    inputs = inputs.replace(name, value)
+                index += 1
+                for c in range(index, len(s)):
+                    for name, value in bindings:
+                        s[c] = s[c].replace(name, value)
+            except:
+                #print("err inputs: ", origin_inputs, flush=True)
+                return POT_ERROR_MESSAGE
+    except Exception as e:
+        #print("err inputs: ", origin_inputs, flush=True)
+        return POT_ERROR_MESSAGE
+
+    return inputs
+
+
+def _run_pot_span(k, timeout):
+    fired = []
+
+    def on_timeout(signum, frame):
+        fired.append(signum)
+        raise TimeoutError("PoT evaluation timed out")
+
+    # The timer keeps firing until it is cleared, so a bare `except:` in the
+    # evaluated code or in eval_pot_span cannot swallow the timeout for good,
+    # and whatever it turned the timeout into is reported as one.
+    signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout, 0.1)
+    try:
+        return eval_pot_span(k)
+    except BaseException:
+        if fired:
+            raise TimeoutError("PoT evaluation timed out") from None
+        raise
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _limit_memory(memory_limit):
+    # Counted from what the worker already maps after importing sympy and
+    # scipy, so the spans themselves get `memory_limit` bytes.
+    try:
+        with open("/proc/self/statm") as f:
+            baseline = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        # not Linux, where RLIMIT_AS is not enforced anyway
+        return
+    limit = baseline + memory_limit
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _serve_worker(timeout, memory_limit):
+    """Evaluate spans read as JSON lines from stdin, one JSON reply line each."""
+    requests = os.fdopen(os.dup(0), "r", encoding="utf-8")
+    replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    # model-written code may print or read input, keep it off the protocol
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    if memory_limit > 0:
+        _limit_memory(memory_limit)
+    for line in requests:
+        span = json.loads(line)["span"]
+        try:
+            reply = {"ok": True, "result": _run_pot_span(span, timeout)}
+        except TimeoutError as e:
+            reply = {"ok": False, "timeout": True, "error": str(e)}
+        except BaseException as e:
+            # exit() in the span included, it fails the span, not the worker
+            reply = {"ok": False, "timeout": False, "error": f"{type(e).__name__}: {e}"}
+        replies.write(json.dumps(reply, ensure_ascii=False) + "\n")
+        replies.flush()
+
+
+class _PoTWorker:
+    """One worker process, running a single span at a time."""
+
+    def __init__(self, process):
+        self.process = process
+
+    @classmethod
+    async def start(cls, timeout, memory_limit):
+        # one thread per worker, the limit is on the whole address space
+        env = dict(os.environ, OPENBLAS_NUM_THREADS="1", OMP_NUM_THREADS="1", MKL_NUM_THREADS="1")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            "--timeout", str(timeout), "--memory-limit", str(memory_limit),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env)
+        return cls(process)
+
+    async def run(self, span, deadline):
+        self.process.stdin.write((json.dumps({"span": span}, ensure_ascii=False) + "\n").encode("utf-8"))
+        await self.process.stdin.drain()
+        line = await asyncio.wait_for(self.process.stdout.readline(), deadline)
+        if not line:
+            raise EOFError(f"PoT worker exited with code {await self.process.wait()}")
+        return json.loads(line)
+
+    def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+
+
+class PoTExecutor:
+    """Evaluates PoT spans in worker processes, memoizing results by span text.
+
+    Each span gets `timeout` seconds of wall time, from when a worker picks it
+    up, and every worker may map `memory_limit` bytes beyond what it holds
+    after start-up, so model-written code cannot stall the event loop or
+    exhaust the server's memory. A worker that overruns its span or dies is
+    replaced; the others keep running. Errors the span raises are cached like
+    results, timeouts and lost workers are not, since a retry under less load
+    may succeed. Concurrent requests for the same span share one run.
+    """
+
+    def __init__(self, max_workers=None, timeout=None, memory_limit=None, maxsize=4096):
+        self.max_workers = max_workers or int(os.environ.get("ZHINAO_POT_WORKERS", "4"))
+        self.timeout = timeout or float(os.environ.get("ZHINAO_POT_TIMEOUT", "5"))
+        if memory_limit is None:
+            memory_limit = int(os.environ.get("ZHINAO_POT_MEMORY_MB", "1024")) * 1024 ** 2
+        self.memory_limit = memory_limit
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._pending = {}
+        self._idle = []
+        self._slots = None
+
+    async def _run(self, k):
+        """Return (ok, result or error, whether to cache it)."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        # waiting for a free worker does not count against the span's timeout
+        async with self._slots:
+            try:
+                worker = self._idle.pop() if self._idle else await _PoTWorker.start(self.timeout, self.memory_limit)
+            except Exception as e:
+                return False, e, False
+            try:
+                reply = await worker.run(k, self.timeout + 5)
+            except asyncio.TimeoutError:
+                # stuck in C code, where SIGALRM does not reach it
+                logger.warning(f"PoT worker did not stop after {self.timeout}s, restarting it")
+                worker.kill()
+                return False, TimeoutError("PoT evaluation timed out"), False
+            except (EOFError, OSError, ValueError) as e:
+                # died, e.g. killed by the OOM killer
+                worker.kill()
+                return False, e, False
+            except BaseException:
+                worker.kill()
+                raise
+            self._idle.append(worker)
+        if reply["ok"]:
+            return True, reply["result"], True
+        if reply["timeout"]:
+            return False, TimeoutError(reply["error"]), False
+        return False, RuntimeError(reply["error"]), True
+
+    async def evaluate(self, k):
+        """Bindings of span `k`; raises what eval_pot_span raised for it."""
+        if k in self._results:
+            self.hits += 1
+            self._results.move_to_end(k)
+            ok, result = self._results[k]
+        else:
+            self.misses += 1
+            pending = self._pending.get(k)
+            if pending is None:
+                pending = self._pending[k] = asyncio.ensure_future(self._run(k))
+                pending.add_done_callback(lambda _: self._pending.pop(k, None))
+            # shielded: a disconnecting client must not cancel a shared run
+            ok, result, cache = await asyncio.shield(pending)
+            if cache:
+                self._results[k] = (ok, result)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        if not ok:
+            raise result
+        return [tuple(binding) for binding in result]
+
+    async def close(self):
+        """Stop the idle workers, e.g. before closing the event loop."""
+        while self._idle:
+            worker = self._idle.pop()
+            worker.kill()
+            await worker.process.wait()
+
+
+async def parse_pot(inputs, executor):
+    """parse_pot_no_stream with the spans evaluated by a PoTExecutor."""
+    s = re.findall(r'<<(.*?)>>', inputs, re.DOTALL)
+    if not s:
+        return inputs
+
+    index = 0
+    for k in s:
+        try:
+            bindings = await executor.evaluate(k)
+        except Exception:
+            return POT_ERROR_MESSAGE
+        inputs = inputs.replace("<<"+k+">>", "")
+        for name, value in bindings:
+            inputs = inputs.replace(name, value)
+        index += 1
+        for c in range(index, len(s)):
+            for name, value in bindings:
+                s[c] = s[c].replace(name, value)
+
+    return inputs
+
+
+class IncrementalPoTParser:
+    """Streaming counterpart of parse_pot_no_stream for one choice.
+
+    `feed` takes the accumulated generated text and returns only the newly
+    settled part of the parsed output. Every <<...>> span is evaluated once,
+    when its closing >> arrives. Text that may still change is held back:
+    an unclosed span, a trailing "<" and, once variables are bound, a
+    trailing identifier. Text is emitted with the variables bound so far, so
+    variables are expected to be used after their span, which is how PoT
+    answers are written. After a failed span the error message is emitted
+    once and the rest of the output is dropped.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.bindings = []
+        self.pos = 0
+        self.failed = False
+
+    def _substitute(self, text):
+        for name, value in self.bindings:
+            text = text.replace(name, value)
+        return text
+
+    def _settled_end(self, text):
+        end = len(text) - 1 if text.endswith("<") else len(text)
+        if self.bindings:
+            # Variable names are ASCII identifiers, so no substitution crosses
+            # any other character: hold back the trailing identifier only.
+            end = self.pos + re.search(r"[A-Za-z0-9_]*$", text[self.pos:end]).start()
+        return end
+
+    async def feed(self, text, final=False):
+        if self.failed:
+            return ""
+        delta = []
+        while True:
+            start = text.find("<<", self.pos)
+            if start == -1:
+                break
+            delta.append(self._substitute(text[self.pos:start]))
+            self.pos = start
+            end = text.find(">>", start + 2)
+            if end == -1:
+                break
+            try:
+                self.bindings.extend(await self.executor.evaluate(self._substitute(text[start + 2:end])))
+            except Exception:
+                self.failed = True
+                delta.append(POT_ERROR_MESSAGE)
+                return "".join(delta)
+            self.pos = end + 2
+        if final:
+            # An unclosed span is not a span, parse_pot_no_stream keeps it as text.
+            end = len(text)
+        elif text.startswith("<<", self.pos):
+            end = self.pos
+        else:
+            end = self._settled_end(text)
+        delta.append(self._substitute(text[self.pos:end]))
+        self.pos = end
+        return "".join(delta)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PoT worker: evaluates spans read from stdin.")
+    parser.add_argument("--timeout", type=float, required=True)
+    parser.add_argument("--memory-limit", type=int, default=0, help="bytes on top of the start-up size, 0 for none")
+    args = parser.parse_args()
+    _serve_worker(args.timeout, args.memory_limit)
@@ -1,32 +1,97 @@
+import re
 import json
-import torch
+import time
+import uuid
+import threading
 import streamlit as st
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers.generation.utils import GenerationConfig
+from inference_worker import InferenceClient
 
 
 st.set_page_config(page_title="360智脑大模型")
 st.title("360智脑大模型")
 
-MODEL_NAME_OR_PATH = "qihoo360/360Zhinao-7B-Chat-4K"
 
 @st.cache_resource
-def load_model_tokenizer():
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        device_map="auto",
-        trust_remote_code=True
-    )
-    tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME_OR_PATH,
-        use_fast=False,
-        trust_remote_code=True
-    )
-    generation_config = GenerationConfig.from_pretrained(MODEL_NAME_OR_PATH)
-    return model, tokenizer, generation_config
+def load_inference_client():
+    # connects to (or starts) the shared inference worker that owns the model
+    return InferenceClient()
+
+
+def get_session_id():
+    # keys this conversation's KV cache in the worker
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def get_session_lock():
+    if "generation_lock" not in st.session_state:
+        st.session_state.generation_lock = threading.Lock()
+    return st.session_state.generation_lock
+
+
+# a list item, a table row or an indented continuation line
+LIST_OR_TABLE_LINE = re.compile(r"\s*([-*+]|\d+[.)])\s|\s*\||\s{2,}\S")
+
+
+class MarkdownStreamRenderer:
+    """Renders a growing markdown response at most `max_fps` times per second.
+
+    Finished blocks (split on blank lines outside code fences) are frozen into their
+    own element, so only the trailing, still-growing block is re-rendered. Lists and
+    tables may continue after a blank line, so they are not frozen. Once the response
+    is complete it is rendered again as one element, exactly as the history shows it.
+    """
+
+    def __init__(self, container, max_fps=10):
+        self.placeholder = container.empty()
+        self.container = self.placeholder.container()
+        self.min_interval = 1.0 / max_fps
+        self.tail = self.container.empty()
+        self.frozen_len = 0
+        self.last_render_time = 0.0
+        self.response = ""
+        self.rendered = ""
+
+    def update(self, response, force=False):
+        self.response = response
+        if response == self.rendered:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_render_time < self.min_interval:
+            return
+        self._render()
+        self.last_render_time = now
+        self.rendered = response
+
+    def finish(self):
+        self.placeholder.markdown(self.response)
+        self.rendered = self.response
+
+    def _render(self):
+        text = self.response[self.frozen_len:]
+        boundary = self._last_block_boundary(text)
+        if boundary > 0:
+            self.tail.markdown(text[:boundary])
+            self.tail = self.container.empty()
+            self.frozen_len += boundary
+            text = text[boundary:]
+        self.tail.markdown(text)
+
+    @staticmethod
+    def _last_block_boundary(text):
+        boundary = 0
+        pos = text.find("\n\n")
+        while pos != -1:
+            last_line = text[text.rfind("\n", 0, pos) + 1:pos]
+            if text.count("```", 0, pos) % 2 == 0 and not LIST_OR_TABLE_LINE.match(last_line):
+                boundary = pos + 2
+            pos = text.find("\n\n", pos + 2)
+        return boundary
 
 
 def clear_chat_messages():
+    load_inference_client().evict(get_session_id())
     del st.session_state.messages
 
 
@@ -50,32 +115,42 @@ top_p = st.sidebar.slider("top_p", 0.0, 1.0, 0.8, step=0.01)
 top_k = st.sidebar.slider("top_k", 0, 100, 50, step=1)
 temperature = st.sidebar.slider("temperature", 0.0, 2.0, 1.0, step=0.01)
 do_sample = st.sidebar.checkbox("do_sample", value=True)
+render_fps = st.sidebar.slider("render_fps", 1, 30, 10, step=1)
 
 def main():
-    model, tokenizer, generation_config = load_model_tokenizer()
+    with st.spinner("正在连接推理服务..."):
+        client = load_inference_client()
     messages = init_chat_messages()
 
     if prompt := st.chat_input("Shift + Enter 换行, Enter 发送"):
-        with st.chat_message("user", avatar='🧑‍💻'):
-            st.markdown(prompt)
-        with st.chat_message("assistant", avatar='🤖'):
-            placeholder = st.empty()
-            messages.append({"role": "user", "content": prompt})
-
-            generation_config.max_new_tokens = max_new_tokens
-            generation_config.top_p = top_p
-            generation_config.top_k = top_k
-            generation_config.temperature = temperature
-            generation_config.do_sample = do_sample
-            print("generation_config: ", generation_config)
-
-            for response in model.chat(tokenizer=tokenizer, messages=messages, stream=True, generation_config=generation_config):
-                placeholder.markdown(response)
-                if torch.backends.mps.is_available():
-                    torch.mps.empty_cache()
-        
-        messages.append({"role": "assistant", "content": response})
-        print("messages: ", json.dumps(messages, ensure_ascii=False), flush=True)
+        lock = get_session_lock()
+        if lock.acquire(timeout=5):
+            try:
+                with st.chat_message("user", avatar='🧑‍💻'):
+                    st.markdown(prompt)
+                with st.chat_message("assistant", avatar='🤖'):
+                    renderer = MarkdownStreamRenderer(st.container(), max_fps=render_fps)
+                    messages.append({"role": "user", "content": prompt})
+
+                    params = {
+                        "max_new_tokens": max_new_tokens,
+                        "top_p": top_p,
+                        "top_k": top_k,
+                        "temperature": temperature,
+                        "do_sample": do_sample,
+                    }
+                    print("generation params: ", params)
+
+                    for response in client.chat(messages, params, session_id=get_session_id()):
+                        renderer.update(response)
+                    renderer.finish()
+
+                messages.append({"role": "assistant", "content": response})
+                print("messages: ", json.dumps(messages, ensure_ascii=False), flush=True)
+            finally:
+                lock.release()
+        else:
+            st.warning("上一条回复仍在生成中，请稍后再试")
 
     st.button("清空对话", on_click=clear_chat_messages)
 